@@ -0,0 +1,237 @@
+"""Historical tables built from mergeable sufficient statistics.
+
+Each table is computed in two steps. A map step reduces one shard of the
+history (a season of plays, a chunk of field goal attempts) to counts and
+sums per key. Because these combine by addition, shards can be processed
+in any order, in separate processes or on separate machines, and merged
+with merge_stats. The derived rates, fills and interpolation then run
+once over the merged counts, so the tables do not depend on how the data
+was partitioned.
+"""
+from __future__ import division, print_function
+
+from multiprocessing import Pool
+
+import numpy as np
+
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+# Keys of the coarse historical comparisons of 4th down decisions
+DECISION_KEYS = ['down_by_td', 'up_by_td', 'yfog_bin', 'short', 'med',
+                 'long']
+
+DECISION_COLUMNS = ['proportion_went', 'sample_size', 'proportion_punted',
+                    'sample_size_punt', 'proportion_kicked',
+                    'sample_size_kick']
+
+
+def fg_stats(fgs, min_pid=473957):
+    """Field goal attempts (N) and makes by distance."""
+    fgs = fgs.loc[(fgs.fgxp == 'FG') & (fgs.pid >= min_pid)]
+    stats = fgs.groupby('dist')['good'].agg(['size', 'sum'])
+    return stats.rename(columns={'size': 'N', 'sum': 'made'})
+
+
+def punt_stats(punts):
+    """Punts (n) and total net yards by kicking field position."""
+    stats = punts.groupby('yfog')['pnet'].agg(['count', 'sum'])
+    return stats.rename(columns={'count': 'n', 'sum': 'pnet'})
+
+
+def first_down_stats(df_plays):
+    """Plays (N) and conversions by yfog, dwn & ytg."""
+    stats = (df_plays.groupby(['yfog', 'dwn', 'ytg'])['first_down']
+                     .agg(['size', 'sum']))
+    stats = stats.rename(columns={'size': 'N', 'sum': 'fd'})
+    stats['fd'] = stats.fd.astype(np.int64)
+    return stats
+
+
+def decision_stats(fourths):
+    """4th downs (N) and the number of times teams went for it, punted
+    and kicked, by score and field position bins."""
+
+    df = fourths[['score_diff', 'yfog', 'ytg', 'goforit', 'punt',
+                  'kick']].copy()
+    df['down_by_td'] = (df.score_diff <= -4).astype(np.uint8)
+    df['up_by_td'] = (df.score_diff >= 4).astype(np.uint8)
+    df['yfog_bin'] = df.yfog // 20
+    df['short'] = (df.ytg <= 3).astype(np.uint8)
+    df['med'] = ((df.ytg >= 4) & (df.ytg <= 7)).astype(np.uint8)
+    df['long'] = (df.ytg > 7).astype(np.uint8)
+
+    grouped = df.groupby(DECISION_KEYS)
+    stats = grouped[['goforit', 'punt', 'kick']].sum()
+    stats['N'] = grouped.size()
+    return stats
+
+
+def merge_stats(parts):
+    """Combine statistics from any number of shards."""
+    nonempty = [part for part in parts if part.shape[0]]
+    if not nonempty:
+        return parts[0]
+    merged = pd.concat(nonempty)
+    return merged.groupby(level=list(merged.index.names)).sum()
+
+
+def fg_table(stats):
+    """Success rate by field position from fg_stats."""
+    fgs_grouped = stats.reset_index()
+    fgs_grouped['average'] = fgs_grouped.made / fgs_grouped.N
+    fgs_grouped['yfog'] = 100 - (fgs_grouped.dist - 17)
+    return fgs_grouped[['dist', 'N', 'average', 'yfog']]
+
+
+def punt_table(stats):
+    """Average net punt distance by field position from punt_stats."""
+    punts_dist = stats.reset_index()
+    punts_dist['pnet'] = punts_dist.pnet / punts_dist.n
+    return punts_dist[['yfog', 'pnet']]
+
+
+def decision_table(stats):
+    """Proportion of 4th downs teams went for it, punted and kicked, and
+    the sample sizes, from decision_stats."""
+    decisions = pd.DataFrame(index=stats.index)
+    decisions['proportion_went'] = stats.goforit / stats.N
+    decisions['sample_size'] = stats.N
+    decisions['proportion_punted'] = stats.punt / stats.N
+    decisions['sample_size_punt'] = stats.N
+    decisions['proportion_kicked'] = stats.kick / stats.N
+    decisions['sample_size_kick'] = stats.N
+    return decisions[DECISION_COLUMNS]
+
+
+def first_down_table(stats, yfog):
+    """Mean 1st down success rate on 3rd and 4th down by segment of the
+    field, from first_down_stats.
+
+    Parameters
+    ----------
+    stats : DataFrame, from first_down_stats
+    yfog  : str, must be 'yfog' or 'yfog_bin'
+            If yfog, use the actual yards from own goal inside the 10
+            If yfog_bin, use the decile of the field instead.
+    """
+
+    downs = stats.reset_index()
+    if yfog == 'yfog_bin':
+        # Break the field into deciles
+        downs = downs.loc[downs.yfog < 90].copy()
+        downs[yfog] = downs.yfog // 10
+    else:
+        downs = downs.loc[downs.yfog >= 90].copy()
+
+    # For each segment, find the average first down rate by dwn & ytg
+    grouped = downs.groupby([yfog, 'dwn', 'ytg'])[['fd', 'N']].sum()
+    grouped['fdr'] = grouped.fd / grouped.N
+    grouped = grouped[['fdr', 'N']].reset_index()
+
+    # Just keep 3rd & 4th downs
+    grouped = grouped.loc[grouped.dwn >= 3].copy()
+    merged = grouped.merge(grouped, on=[yfog, 'ytg'], how='left')
+
+    # Note this will lose scenarios that have *only* ever seen a 4th down
+    # This matches to one play since 2001.
+    merged = merged.loc[(merged.dwn_x == 4) & (merged.dwn_y == 3)].copy()
+
+    # Compute a weighted mean of FDR on 3rd & 4th down to deal with sparsity
+    merged['weighted_N_x'] = (merged.fdr_x * merged.N_x)
+    merged['weighted_N_y'] = (merged.fdr_y * merged.N_y)
+    merged['weighted_total'] = (merged.weighted_N_x + merged.weighted_N_y)
+    merged['total_N'] = (merged.N_x + merged.N_y)
+    merged['weighted_fdr'] = (merged.weighted_total / merged.total_N)
+    merged = merged.drop(labels=['weighted_N_x', 'weighted_N_y',
+                                 'weighted_total', 'total_N'], axis='columns')
+    merged = merged.rename(columns={'dwn_x': 'dwn'})
+
+    # Need to fill in any missing combinations where possible
+    merged = merged.set_index([yfog, 'dwn', 'ytg'])
+    p = pd.MultiIndex.from_product(merged.index.levels,
+                                   names=merged.index.names)
+    merged = merged.reindex(p, fill_value=None).reset_index()
+    merged = merged.rename(columns={'weighted_fdr': 'fdr'})
+
+    # Eliminate impossible combinations
+    if yfog == 'yfog_bin':
+        # Sparse situations, just set to p(success) = 0.1
+        merged.loc[merged.ytg > 13, 'fdr'] = 0.10
+
+        # Missing values inside -10 because no one goes for it here
+        merged.loc[(merged.fdr_x.isnull()) & (merged.ytg <= 3),
+                   'fdr'] = .2
+        merged.loc[(merged.fdr_x.isnull()) & (merged.ytg > 3),
+                   'fdr'] = .1
+
+        # Fill in missing values
+        merged['fdr'] = merged['fdr'].interpolate()
+    else:
+        merged = merged.loc[(merged.yfog + merged.ytg <= 100)]
+        merged.loc[(merged.yfog == 99) & (merged.ytg == 1), 'fdr'] = (
+                merged.loc[(merged.yfog == 99) & (merged.ytg == 1), 'fdr_x'])
+        merged['fdr'] = merged['fdr'].interpolate()
+    return merged
+
+
+def season_stats(args):
+    """Map step for one season: first down, decision and punt stats."""
+    plays, fourths, punts = args
+    return (first_down_stats(plays), decision_stats(fourths),
+            punt_stats(punts))
+
+
+def fg_chunk_stats(args):
+    """Map step for a chunk of field goal attempts."""
+    fgs, min_pid = args
+    return fg_stats(fgs, min_pid)
+
+
+def historical_stats(plays, fourths, punts, fgs, min_pid=473957, jobs=1):
+    """Compute the stats behind every historical table, one shard per
+    season (field goal attempts, which have no season, are split into as
+    many row chunks) in a pool of jobs processes, and merge them.
+
+    Parameters
+    ----------
+    plays   : DataFrame of executed rush & pass plays, with seas, yfog,
+              dwn, ytg and first_down
+    fourths : DataFrame of coded 4th downs, with seas
+    punts   : DataFrame of punts with the kicking yfog and seas
+    fgs     : DataFrame, the Armchair Analysis FGXP table
+    min_pid : int, first play used for field goal rates
+    jobs    : int, worker processes. 1 runs in this process.
+
+    Returns
+    -------
+    stats   : dict of 'first_downs', 'decisions', 'punts' and 'fgs'
+    """
+
+    seasons = sorted(set(plays.seas.unique()) | set(fourths.seas.unique()) |
+                     set(punts.seas.unique()))
+    season_args = [(plays.loc[plays.seas == seas],
+                    fourths.loc[fourths.seas == seas],
+                    punts.loc[punts.seas == seas]) for seas in seasons]
+    fg_args = [(fgs.iloc[rows], min_pid) for rows in
+               np.array_split(np.arange(fgs.shape[0]), max(len(seasons), 1))]
+
+    if jobs == 1:
+        by_season = [season_stats(args) for args in season_args]
+        by_chunk = [fg_chunk_stats(args) for args in fg_args]
+    else:
+        pool = Pool(processes=jobs)
+        try:
+            by_season = pool.map(season_stats, season_args)
+            by_chunk = pool.map(fg_chunk_stats, fg_args)
+        finally:
+            pool.close()
+            pool.join()
+
+    first_downs, decisions, punt_parts = zip(*by_season)
+    return {'first_downs': merge_stats(first_downs),
+            'decisions': merge_stats(decisions),
+            'punts': merge_stats(punt_parts),
+            'fgs': merge_stats(by_chunk)}
@@ -0,0 +1,217 @@
+from __future__ import division, print_function
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from drive_ep import DriveEP
+from fg_table import FGTable
+from similar import FourthDownIndex
+from situation import FEATURES
+
+
+# Historical tables used by the decision code, keyed as in bot.load_data.
+TABLES = ('fgs', 'punts', 'fd_open_field', 'fd_inside_10',
+          'final_drives', 'decisions')
+
+
+class SharedScaler(object):
+    """StandardScaler stand-in whose parameters are read-only arrays."""
+
+    def __init__(self, mean, scale):
+        self.mean_ = mean
+        self.scale_ = scale
+
+    def transform(self, X):
+        return (np.asarray(X, dtype=np.float64) - self.mean_) / self.scale_
+
+
+class SharedLogit(object):
+    """Binary LogisticRegression stand-in whose coefficients are
+    read-only arrays."""
+
+    def __init__(self, coef, intercept):
+        self.coef_ = coef
+        self.intercept_ = intercept
+
+    def decision_function(self, X):
+        return np.dot(X, self.coef_[0]) + self.intercept_[0]
+
+    def predict_proba(self, X):
+        prob = 1 / (1 + np.exp(-self.decision_function(X)))
+        return np.column_stack([1 - prob, prob])
+
+    def predict(self, X):
+        return (self.decision_function(X) > 0).astype(np.int64)
+
+
+def scaler_params(scaler):
+    """Mean and scale of a fitted StandardScaler. Older scikit-learn
+    releases call the scale `std_`."""
+    scale = getattr(scaler, 'scale_', None)
+    if scale is None:
+        scale = scaler.std_
+    return np.asarray(scaler.mean_, dtype=np.float64), np.asarray(scale)
+
+
+def export_shared(data, model, directory, keep=2):
+    """Write the historical tables, scaler and model as .npy arrays that
+    can be memory-mapped by any number of processes.
+
+    Only numeric table columns are exported. Models other than a binary
+    linear classifier are pickled alongside and loaded normally. The field
+    goal tensor, the index of similar fourth downs and the expected drive
+    points are copied in when data has them.
+
+    Each export goes to a new version subdirectory, and directory/CURRENT
+    is switched to it by rename once it is complete. Processes still
+    reading an earlier version are never shown a half-written one; the
+    oldest versions beyond keep are removed.
+
+    Parameters
+    ----------
+    data      : dict, as returned by bot.load_data
+    model     : fitted classifier
+    directory : str
+    keep      : int, versions to keep, including this one
+
+    Returns
+    -------
+    manifest  : dict, also written to the version's manifest.json
+    """
+
+    root = directory
+    version = datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f')
+    directory = os.path.join(root, version)
+    os.makedirs(directory)
+
+    manifest = {'features': list(FEATURES), 'tables': {}}
+
+    for name in TABLES:
+        df = data[name].select_dtypes(include=[np.number, np.bool_])
+        np.save(os.path.join(directory, name + '.npy'),
+                df.values.astype(np.float64))
+        manifest['tables'][name] = [str(c) for c in df.columns]
+
+    mean, scale = scaler_params(data['scaler'])
+    np.save(os.path.join(directory, 'scaler_mean.npy'), mean)
+    np.save(os.path.join(directory, 'scaler_scale.npy'), scale)
+
+    coef = getattr(model, 'coef_', None)
+    if coef is not None and coef.shape[0] == 1:
+        np.save(os.path.join(directory, 'model_coef.npy'),
+                np.asarray(coef, dtype=np.float64))
+        np.save(os.path.join(directory, 'model_intercept.npy'),
+                np.asarray(model.intercept_, dtype=np.float64))
+        manifest['model'] = 'linear'
+    else:
+        from sklearn.externals import joblib
+        joblib.dump(model, os.path.join(directory, 'model.pkl'))
+        manifest['model'] = 'pickle'
+
+    fg_table = data.get('fg_table')
+    if fg_table is not None:
+        prefix = os.path.join(directory, 'fg_tensor')
+        np.asarray(fg_table.values).tofile(prefix + '.bin')
+        with open(prefix + '.json', 'w') as f:
+            json.dump(fg_table.header, f)
+        manifest['fg_table'] = True
+
+    fourths_index = data.get('fourths_index')
+    if fourths_index is not None:
+        for name, values in fourths_index.arrays.items():
+            np.save(os.path.join(directory, 'fourths_index_' + name + '.npy'),
+                    values)
+        manifest['fourths_index'] = sorted(fourths_index.arrays)
+
+    drive_table = data.get('drive_ep')
+    if drive_table is not None:
+        np.save(os.path.join(directory, 'drive_ep.npy'),
+                np.asarray(drive_table.values, dtype=np.float64))
+        manifest['drive_ep'] = True
+
+    digest = hashlib.sha1()
+    for fname in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, fname), 'rb') as f:
+            digest.update(f.read())
+    manifest['version'] = '{}-{}'.format(version, digest.hexdigest()[:8])
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    tmp_fname = os.path.join(root, 'CURRENT.tmp')
+    with open(tmp_fname, 'w') as f:
+        f.write(version + '\n')
+    os.rename(tmp_fname, os.path.join(root, 'CURRENT'))
+
+    versions = sorted(name for name in os.listdir(root)
+                      if os.path.isdir(os.path.join(root, name)))
+    for name in versions[:-keep]:
+        if name != version:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return manifest
+
+
+def current_directory(directory):
+    """The version directory export_shared last completed in directory,
+    or directory itself for artifacts exported before versioning."""
+    pointer = os.path.join(directory, 'CURRENT')
+    if not os.path.exists(pointer):
+        return directory
+    with open(pointer) as f:
+        return os.path.join(directory, f.read().strip())
+
+
+def load_shared(directory):
+    """Map the arrays written by export_shared read-only and wrap them
+    in the structures winprob expects. No table data is copied, so
+    processes forked after this call share the same pages.
+
+    Returns
+    -------
+    data  : dict, with the export's version as data['version']
+    model : SharedLogit, or the unpickled model
+    """
+
+    directory = current_directory(directory)
+
+    def mapped(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    if manifest['features'] != list(FEATURES):
+        raise ValueError('Artifacts in {} were exported with features {}, '
+                         'expected {}.'.format(directory,
+                                               manifest['features'],
+                                               list(FEATURES)))
+
+    data = {}
+    for name, columns in manifest['tables'].items():
+        data[name] = pd.DataFrame(mapped(name), columns=columns, copy=False)
+
+    data['scaler'] = SharedScaler(mapped('scaler_mean'),
+                                  mapped('scaler_scale'))
+    data['features'] = list(manifest['features'])
+    data['version'] = manifest.get('version', 'unversioned')
+
+    if manifest['model'] == 'linear':
+        model = SharedLogit(mapped('model_coef'), mapped('model_intercept'))
+    else:
+        from sklearn.externals import joblib
+        model = joblib.load(os.path.join(directory, 'model.pkl'))
+
+    if manifest.get('fg_table'):
+        data['fg_table'] = FGTable.load(os.path.join(directory, 'fg_tensor'))
+    if manifest.get('fourths_index'):
+        data['fourths_index'] = FourthDownIndex(dict(
+            (name, mapped('fourths_index_' + name))
+            for name in manifest['fourths_index']))
+    if manifest.get('drive_ep'):
+        data['drive_ep'] = DriveEP(mapped('drive_ep'))
+    return data, model
@@ -0,0 +1,126 @@
+from __future__ import division, print_function
+
+import json
+import os
+import time
+
+from multiprocessing import Pool
+
+import click
+import numpy as np
+import pandas as pd
+
+from sklearn.metrics import log_loss, roc_auc_score
+from sklearn.preprocessing import StandardScaler
+
+import model_train as mt
+
+from situation import FEATURES
+
+
+def source_stamp(fname):
+    stat = os.stat(fname)
+    return {'fname': os.path.abspath(fname), 'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+def build_feature_cache(pbp_fname, cache_dir):
+    """Derive the model features once and store them, with the target,
+    season and game id, as .npy arrays that every fold can map.
+
+    The cache is rebuilt when pbp_fname changes.
+    """
+
+    stamp_fname = os.path.join(cache_dir, 'source.json')
+    stamp = source_stamp(pbp_fname)
+    if os.path.exists(stamp_fname):
+        with open(stamp_fname) as f:
+            if json.load(f) == stamp:
+                return
+
+    click.echo('Building feature cache in {}.'.format(cache_dir))
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    df_plays = mt.load_plays(pbp_fname)
+    np.save(os.path.join(cache_dir, 'X.npy'),
+            df_plays[list(FEATURES)].values.astype(np.float64))
+    np.save(os.path.join(cache_dir, 'y.npy'),
+            df_plays['win'].values.astype(np.uint8))
+    np.save(os.path.join(cache_dir, 'seas.npy'),
+            df_plays['seas'].values.astype(np.int16))
+    np.save(os.path.join(cache_dir, 'gid.npy'),
+            df_plays['gid'].values.astype(np.int32))
+
+    with open(stamp_fname, 'w') as f:
+        json.dump(stamp, f)
+
+
+def run_fold(args):
+    """Train on every season before `season` and evaluate on it."""
+
+    season, cache_dir, model_name = args
+    start = time.time()
+
+    def mapped(name):
+        return np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+    X, y, seas = mapped('X'), mapped('y'), mapped('seas')
+    train = seas < season
+    test = seas == season
+
+    scaler = StandardScaler()
+    train_X = scaler.fit_transform(X[train])
+    model = mt.candidate_models()[model_name]
+    model.fit(train_X, y[train])
+
+    preds = model.predict_proba(scaler.transform(X[test]))[:, 1]
+    return {'season': season,
+            'n_train': int(train.sum()),
+            'n_test': int(test.sum()),
+            'auc': roc_auc_score(y[test], preds),
+            'log_loss': log_loss(y[test], preds),
+            'calibration_error': mt.calibration_error(preds, y[test]),
+            'wall_secs': time.time() - start}
+
+
+@click.command()
+@click.option('--pbp', 'pbp_fname', default='data/pbp_cleaned.csv')
+@click.option('--cache-dir', default='data/features')
+@click.option('--first-season', default=2002,
+              help='Earliest season to evaluate; earlier ones only train.')
+@click.option('--model', 'model_name', default='logit',
+              type=click.Choice(sorted(mt.candidate_models())))
+@click.option('--jobs', default=None, type=int,
+              help='Worker processes, defaults to one per core.')
+@click.option('--out', default='data/backtest.csv')
+def main(pbp_fname, cache_dir, first_season, model_name, jobs, out):
+    """Rolling-origin backtest: for each season, fit on all earlier
+    seasons and score that season."""
+
+    start = time.time()
+    build_feature_cache(pbp_fname, cache_dir)
+
+    seasons = np.unique(np.load(os.path.join(cache_dir, 'seas.npy'),
+                                mmap_mode='r'))
+    seasons = [int(s) for s in seasons if s >= first_season]
+    click.echo('Backtesting {} on {} seasons.'.format(model_name,
+                                                      len(seasons)))
+
+    pool = Pool(processes=jobs)
+    try:
+        folds = pool.map(run_fold, [(season, cache_dir, model_name)
+                                    for season in seasons])
+    finally:
+        pool.close()
+        pool.join()
+
+    results = pd.DataFrame(folds).set_index('season')
+    results = results[['n_train', 'n_test', 'auc', 'log_loss',
+                       'calibration_error', 'wall_secs']]
+    click.echo(results.to_string())
+    click.echo('Total wall time: {:.1f}s'.format(time.time() - start))
+    results.to_csv(out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from __future__ import division, print_function
+
+import os
+import subprocess
+import sys
+import time
+
+import click
+
+
+# Entry points run from cron and batch jobs, and the cold start target
+# for each in milliseconds.
+TARGETS = {'bot': 250, 'model_train': None, 'data_prep': 250,
+           'winprob': 250}
+
+
+def time_import(module, repeats):
+    """Median wall time in ms to start a fresh interpreter and import
+    module, minus the time for a bare interpreter."""
+
+    def run(code):
+        timings = []
+        for _ in range(repeats):
+            start = time.time()
+            subprocess.check_call([sys.executable, '-c', code])
+            timings.append(time.time() - start)
+        return 1000 * sorted(timings)[len(timings) // 2]
+
+    return run('import {}'.format(module)) - run('pass')
+
+
+def import_profile(module, top):
+    """The slowest top-level imports of module, as (cumulative ms, name),
+    from `python -X importtime` (Python 3.7+ only)."""
+
+    if sys.version_info < (3, 7):
+        return []
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import {}'.format(module)],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    _, stderr = proc.communicate()
+
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nesting is shown by two spaces per level; keep the modules
+        # imported directly by `module` (level 1).
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        if level == 1:
+            rows.append((int(cumulative) / 1000, name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+@click.command()
+@click.option('--repeats', default=5)
+@click.option('--top', default=5, help='Slowest imports to list per module.')
+def main(repeats, top):
+    """Measure cold start import time of each entry point and fail if
+    any is over its target."""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(here)
+
+    over = []
+    for module in sorted(TARGETS):
+        try:
+            elapsed = time_import(module, repeats)
+        except subprocess.CalledProcessError:
+            click.echo('{:<12} import failed'.format(module))
+            over.append(module)
+            continue
+        target = TARGETS[module]
+        status = ''
+        if target is not None:
+            status = 'ok' if elapsed <= target else 'OVER'
+            if elapsed > target:
+                over.append(module)
+        click.echo('{:<12} {:>7.0f} ms  target {:>5}  {}'.format(
+                module, elapsed, target or '-', status))
+        for cumulative, name in import_profile(module, top):
+            click.echo('    {:>7.0f} ms  {}'.format(cumulative, name))
+
+    if over:
+        raise click.ClickException('Over target: {}'.format(', '.join(over)))
+
+if __name__ == '__main__':
+    main()
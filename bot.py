@@ -1,16 +1,41 @@
-from collections import OrderedDict
+import atexit
+import threading
 
 import click
-import pandas as pd
-
-from sklearn.externals import joblib
-from Naked.toolshed.shell import muterun_js
 
 import winprob as wp
 
+from decision_log import DecisionLog
+from fg_client import FGModelProcess
+from situation import FEATURES, Situation
+
 
-def load_data():
+def load_data(artifact_dir=None):
+    """read_data, saying so first."""
     click.echo('Loading data and setting up model.')
+    return read_data(artifact_dir)
+
+def read_data(artifact_dir=None):
+    """Load the historical tables and model. pandas and scikit-learn are
+    imported here rather than at module level so the prompt comes up
+    without waiting on them. With artifact_dir, the memory-mapped
+    artifacts written by artifacts.export_shared are used instead of the
+    pickles, which avoids importing scikit-learn for a linear model.
+
+    The field goal tensor built by model-fg/build-tensor.js is loaded as
+    data['fg_table'] when it exists, as are the index of similar fourth
+    downs and the expected drive points written by data_prep, as
+    data['fourths_index'] and data['drive_ep']."""
+    if artifact_dir is not None:
+        import artifacts
+        return artifacts.load_shared(artifact_dir)
+
+    import pandas as pd
+    from drive_ep import DriveEP
+    from fg_table import FGTable
+    from similar import FourthDownIndex
+    from sklearn.externals import joblib
+
     data = {}
     data['fgs'] = pd.read_csv('data/fgs_grouped.csv')
     data['punts'] = pd.read_csv('data/punts_grouped.csv')
@@ -19,23 +44,74 @@ def load_data():
     data['final_drives'] = pd.read_csv('data/final_drives.csv')
     data['decisions'] = pd.read_csv('data/coaches_decisions.csv')
     data['scaler'] = joblib.load('models/scaler.pkl')
-    data['features'] = ['dwn', 'yfog', 'secs_left',
-                        'score_diff', 'timo', 'timd', 'spread',
-                        'kneel_down', 'qtr', 'qtr_scorediff']
+    data['features'] = list(FEATURES)
+    if FGTable.exists():
+        data['fg_table'] = FGTable.load()
+    if FourthDownIndex.exists():
+        data['fourths_index'] = FourthDownIndex.load()
+    if DriveEP.exists():
+        data['drive_ep'] = DriveEP.load()
 
     model = joblib.load('models/win_probability.pkl')
     return data, model
 
-def fg_make_prob(situation):
-    args = ' '.join("--%s=%r" % (key,val) for (key,val) in situation.iteritems())
-    model_fg = muterun_js('model-fg/model-fg.js', args)
-    return model_fg.stdout.split()[-1]
+def load_in_background(artifact_dir=None, reload_interval=0):
+    """Start read_data on a thread. Returns the thread and a dict that
+    holds 'holder', a hot_reload.StateHolder with the data, model and
+    version, once it has been joined, or 'error', the exception loading
+    raised. The version is the one the artifacts were exported as, or
+    a hash of the pickles and tables read.
+
+    With a reload_interval, the holder's state is swapped for new
+    versions as they are written."""
+    loaded = {}
+    # Said now, so it doesn't land in the middle of the prompts
+    click.echo('Loading data and setting up model.')
+
+    def load():
+        try:
+            from hot_reload import (Reloader, StateHolder, artifact_source,
+                                    load_state, pickle_source)
+            source = (artifact_source(artifact_dir)
+                      if artifact_dir is not None else pickle_source())
+            loaded['holder'] = StateHolder(load_state(source))
+            if reload_interval:
+                Reloader(loaded['holder'], source, reload_interval).start()
+        except Exception as e:
+            loaded['error'] = e
+
+    thread = threading.Thread(target=load)
+    thread.daemon = True
+    thread.start()
+    return thread, loaded
+
 
 @click.command()
-def run_bot():
+@click.option('--artifacts', 'artifact_dir', default=None,
+              help='Load memory-mapped artifacts from this directory '
+                   'instead of data/ and models/.')
+@click.option('--budget-ms', default=None, type=float,
+              help='Answer within this many milliseconds, falling back to '
+                   'cheaper field goal rates and leaving out historical '
+                   'comparisons if need be.')
+@click.option('--reload-interval', default=0.,
+              help='Seconds between checks for new models and tables, '
+                   'which are swapped in between situations (0 = never).')
+@click.option('--decision-log', 'decision_dir', default=None,
+              help='Directory to log every decision to.')
+def run_bot(artifact_dir, budget_ms, reload_interval, decision_dir):
+    # Data loads while the first situation is being typed in
+    loading, loaded = load_in_background(artifact_dir, reload_interval)
+    # One node process answers every field goal query
+    fg_model = FGModelProcess()
+    decision_log = None
+    if decision_dir is not None:
+        decision_log = DecisionLog(decision_dir)
+        atexit.register(decision_log.close)
+
     click.echo("\n\n*** Hit CTRL-C to leave the program. *** \n\n")
     while True:
-        situation = OrderedDict.fromkeys(data['features'])
+        situation = Situation()
 
         situation['dwn'] = int(raw_input('Down: '))
         situation['ytg'] = int(raw_input('Yards to go: '))
@@ -56,12 +132,27 @@ def run_bot():
         situation['temp'] = float(raw_input('Temperature: '))
         situation['wind'] = float(raw_input('Windspeed (mph): '))
         situation['chanceOfRain'] = float(raw_input('Chance of rain (percent): '))
-        situation['fg_make_prob'] = float(fg_make_prob(situation))
 
-        response = wp.generate_response(situation, data, model)
+        loading.join()
+        if 'error' in loaded:
+            raise loaded['error']
+        state = loaded['holder'].current()
+        data, model = state.data, state.model
+        if budget_ms is not None:
+            # node is only worth the budget when there is no tensor
+            if 'fg_table' not in data:
+                data = dict(data, fg_model=fg_model)
+            response = wp.generate_response(situation, data, model,
+                                            budget=budget_ms / 1000)
+        else:
+            if 'fg_table' not in data:
+                situation['fg_make_prob'] = fg_model.prob(situation)
+            response = wp.generate_response(situation, data, model)
+        response['version'] = state.version
+        if decision_log is not None:
+            decision_log.log(situation, response)
 
         click.echo(response)
 
 if __name__ == '__main__':
-    data, model = load_data()
     run_bot()
@@ -0,0 +1,94 @@
+from __future__ import division, print_function
+
+import click
+import numpy as np
+import pandas as pd
+
+import plays as p
+
+from situation import FIELDS, SituationBatch
+
+
+# Scalar transition -> columnar equivalent, keyed by scenario name.
+TRANSITIONS = [
+    ('touchdown', p.touchdown, p.touchdown_batch),
+    ('fail', p.turnover_downs, p.turnover_downs_batch),
+    ('punt', p.punt, p.punt_batch),
+    ('fg', p.field_goal, p.field_goal_batch),
+    ('missed_fg', p.missed_field_goal, p.missed_field_goal_batch),
+]
+
+
+def random_states(n, rng):
+    """Random (not necessarily realistic) pre-play states covering the
+    edges of every column, including end of game and 4th & goal."""
+
+    batch = SituationBatch.empty(n)
+    batch.column('dwn')[:] = rng.randint(1, 5, n)
+    batch.column('ytg')[:] = rng.randint(1, 30, n)
+    batch.column('yfog')[:] = rng.randint(1, 100, n)
+    batch.column('secs_left')[:] = rng.randint(0, 3601, n)
+    batch.column('score_diff')[:] = rng.randint(-35, 36, n)
+    batch.column('timo')[:] = rng.randint(0, 4, n)
+    batch.column('timd')[:] = rng.randint(0, 4, n)
+    batch.column('spread')[:] = rng.randint(-30, 31, n) / 2
+    return batch
+
+
+def random_punts(rng):
+    """punts_grouped-shaped table with holes, so the default net punt
+    distance gets exercised."""
+
+    yfog = np.arange(1, 100)
+    yfog = yfog[rng.rand(yfog.shape[0]) < 0.8]
+    pnet = 45 - yfog / 5 + rng.randn(yfog.shape[0])
+    return pd.DataFrame({'yfog': yfog, 'pnet': pnet})
+
+
+def same(left, right):
+    return np.all((left == right) | (np.isnan(left) & np.isnan(right)))
+
+
+def check(n, seed):
+    """Compare every columnar transition to its scalar version on n
+    random states. Returns a list of (scenario, row) mismatches."""
+
+    rng = np.random.RandomState(seed)
+    batch = random_states(n, rng)
+    punts = random_punts(rng)
+    table = p.punt_table(punts)
+
+    columnar = [('first_down', p.first_down_batch(batch))]
+    for name, _, batch_play in TRANSITIONS:
+        columnar.append((name, p.change_poss_batch(batch, batch_play,
+                                                   data=punts, table=table)))
+
+    mismatches = []
+    for i in range(n):
+        situation = batch[i]
+        scalar = [('first_down', p.first_down(situation))]
+        for name, play, _ in TRANSITIONS:
+            scalar.append((name, p.change_poss(situation, play, data=punts)))
+
+        for (name, expected), (_, result) in zip(scalar, columnar):
+            if not same(expected.values, result.values[i]):
+                mismatches.append((name, i))
+    return mismatches
+
+
+@click.command()
+@click.option('--n', default=10000, help='Number of random states.')
+@click.option('--seed', default=0)
+def main(n, seed):
+    """Check the columnar plays transitions against the scalar ones."""
+    mismatches = check(n, seed)
+    if mismatches:
+        for name, i in mismatches[:20]:
+            click.echo('Mismatch: {} on row {}'.format(name, i))
+        raise click.ClickException('{} of {} transitions differ.'.format(
+                len(mismatches), n * (len(TRANSITIONS) + 1)))
+    click.echo('All {} transitions on {} states match across {} '
+               'fields.'.format(len(TRANSITIONS) + 1, n, len(FIELDS)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+from __future__ import division, print_function
+
+import json
+import random
+
+from multiprocessing.pool import ThreadPool
+
+import click
+import pandas as pd
+
+import bot
+import winprob as wp
+
+
+def fingerprint(payload):
+    """Exact, comparable form of a payload, NaNs included."""
+    return json.dumps(payload, sort_keys=True,
+                      default=lambda obj: obj.item())
+
+
+def snapshot(situations, data):
+    """Copies of everything generate_response must leave alone."""
+    return ([(s.values.copy(), dict(s.context)) for s in situations],
+            dict((name, table.copy()) for name, table in data.items()
+                 if isinstance(table, pd.DataFrame)))
+
+
+def modified(situations, data, before):
+    """Names of the inputs that differ from their snapshot."""
+    situation_copies, table_copies = before
+    changed = []
+    for i, (situation, (values, context)) in enumerate(
+            zip(situations, situation_copies)):
+        same_values = ((situation.values == values) |
+                       ((situation.values != situation.values) &
+                        (values != values))).all()
+        if not same_values or situation.context != context:
+            changed.append('situation {}'.format(i))
+    for name, table in table_copies.items():
+        if not data[name].equals(table):
+            changed.append('data[{!r}]'.format(name))
+    return changed
+
+
+@click.command()
+@click.option('--n', 'n_situations', default=200)
+@click.option('--threads', default=8)
+@click.option('--repeats', default=5,
+              help='Times each situation is decided concurrently.')
+@click.option('--seed', default=0)
+@click.option('--artifacts', 'artifact_dir', default=None)
+def main(n_situations, threads, repeats, seed, artifact_dir):
+    """Decide the same situations serially and then from a thread pool,
+    with every thread sharing the situations, data and model, and check
+    the answers match exactly and no input was modified."""
+
+    data, model = bot.load_data(artifact_dir)
+    rng = random.Random(seed)
+    situations = [wp.random_situation(rng) for _ in range(n_situations)]
+    before = snapshot(situations, data)
+
+    reference = [fingerprint(wp.generate_response(s, data, model))
+                 for s in situations]
+
+    jobs = list(range(n_situations)) * repeats
+    rng.shuffle(jobs)
+
+    def decide(i):
+        return i, fingerprint(wp.generate_response(situations[i], data,
+                                                   model))
+
+    pool = ThreadPool(threads)
+    try:
+        results = pool.map(decide, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    mismatches = sum(1 for i, result in results if result != reference[i])
+    changed = modified(situations, data, before)
+    click.echo('{} concurrent decisions on {} threads: {} differ from the '
+               'serial answer.'.format(len(results), threads, mismatches))
+    if changed:
+        click.echo('Modified inputs: {}'.format(', '.join(changed[:10])))
+    if mismatches or changed:
+        raise click.ClickException('Decisions are not thread-safe.')
+
+if __name__ == '__main__':
+    main()
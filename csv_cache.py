@@ -0,0 +1,111 @@
+"""Cache of parsed CSV tables.
+
+Parsing the Armchair Analysis CSVs is the slowest part of a data_prep
+run, and they rarely change between runs. read_csv parses a file once
+and pickles the resulting DataFrame, dtypes and index included, to the
+cache directory. Later calls with the same file and arguments load the
+pickle instead.
+
+An entry is reused while the source file's size and mtime match those
+recorded with it. If only the mtime has changed (the file was copied or
+touched), the file's SHA-1 is compared before deciding to parse again.
+"""
+from __future__ import division, print_function
+
+import hashlib
+import json
+import os
+
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+# Directory read_csv caches in, or None to always parse. Set by
+# data_prep's --cache-dir option.
+SETTINGS = {'dir': 'data/cache'}
+
+
+def file_sha1(fname, blocksize=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha1.update(block)
+            block = f.read(blocksize)
+    return sha1.hexdigest()
+
+
+def entry_name(fname, kwargs):
+    """Cache file stem for fname parsed with kwargs."""
+    key = json.dumps([os.path.abspath(fname), sorted(kwargs.items()),
+                      pd.__version__], default=repr)
+    stem = os.path.splitext(os.path.basename(fname))[0]
+    return '{}-{}'.format(stem, hashlib.sha1(key.encode('utf-8'))
+                                       .hexdigest()[:12])
+
+
+def read_csv(fname, cache_dir=None, **kwargs):
+    """pandas.read_csv, through the cache.
+
+    Parameters
+    ----------
+    fname     : str, CSV file
+    cache_dir : str, optional, defaults to SETTINGS['dir']
+    kwargs    : passed to pandas.read_csv
+
+    Returns
+    -------
+    df        : DataFrame
+    """
+
+    if cache_dir is None:
+        cache_dir = SETTINGS['dir']
+    if not cache_dir:
+        return pd.read_csv(fname, **kwargs)
+
+    stem = os.path.join(cache_dir, entry_name(fname, kwargs))
+    meta_fname, pickle_fname = stem + '.json', stem + '.pkl'
+    stat = os.stat(fname)
+
+    meta = None
+    if os.path.exists(meta_fname) and os.path.exists(pickle_fname):
+        with open(meta_fname) as f:
+            meta = json.load(f)
+
+    sha1 = None
+    if meta is not None and meta['size'] == stat.st_size:
+        if meta['mtime'] != stat.st_mtime:
+            sha1 = file_sha1(fname)
+        if meta['mtime'] == stat.st_mtime or meta['sha1'] == sha1:
+            try:
+                df = pd.read_pickle(pickle_fname)
+            except Exception:
+                # Written by an incompatible version, or truncated
+                pass
+            else:
+                if sha1 is not None:
+                    meta['mtime'] = stat.st_mtime
+                    write_json(meta_fname, meta)
+                return df
+
+    if sha1 is None:
+        sha1 = file_sha1(fname)
+    df = pd.read_csv(fname, **kwargs)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_fname = '{}.{}.tmp'.format(pickle_fname, os.getpid())
+    df.to_pickle(tmp_fname)
+    os.rename(tmp_fname, pickle_fname)
+    write_json(meta_fname, {'source': os.path.abspath(fname),
+                            'size': stat.st_size, 'mtime': stat.st_mtime,
+                            'sha1': sha1})
+    return df
+
+
+def write_json(fname, obj):
+    tmp_fname = '{}.{}.tmp'.format(fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.rename(tmp_fname, fname)
@@ -0,0 +1,207 @@
+"""Counts of historical 4th down decisions in a dense cube.
+
+data_prep counts every coded 4th down by offense, season, quarter, score
+band, field zone and distance, along with what the coach chose and how
+it turned out. Any roll-up or slice of those dimensions is then a sum
+over array axes, with no need to go back to the plays:
+
+    cube = DecisionCube.load()
+    cube.query(by=['season'], team='PHI', qtr=4)
+"""
+from __future__ import division, print_function
+
+import click
+import numpy as np
+
+from lazy import LazyModule
+
+pd = LazyModule('pandas')
+
+
+# Counted in each cell, in the order of the cube's first axis
+MEASURES = ('attempts', 'went', 'converted', 'punted', 'kicked', 'made')
+
+# Binned dimensions as (name, column, right bin edges, labels). A value
+# falls in the first bin whose edge it does not exceed.
+SCORE_BANDS = ('score', 'score_diff', [-17, -9, -4, -1, 0, 3, 8, 16, np.inf],
+               ['down 17+', 'down 9-16', 'down 4-8', 'down 1-3', 'tied',
+                'up 1-3', 'up 4-8', 'up 9-16', 'up 17+'])
+FIELD_ZONES = ('zone', 'yfog', [9, 19, 29, 39, 49, 59, 69, 79, 89, np.inf],
+               ['own 1-9', 'own 10-19', 'own 20-29', 'own 30-39',
+                'own 40-49', 'opp 41-50', 'opp 31-40', 'opp 21-30',
+                'opp 11-20', 'opp 1-10'])
+DISTANCES = ('distance', 'ytg', [1, 2, 3, 6, 10, np.inf],
+             ['1', '2', '3', '4-6', '7-10', '11+'])
+BINNED = (SCORE_BANDS, FIELD_ZONES, DISTANCES)
+
+# Dimensions taking each distinct value, as (name, column)
+DISTINCT = (('team', 'off'), ('season', 'seas'), ('qtr', 'qtr'))
+
+DIMENSIONS = tuple(name for name, _ in DISTINCT) + tuple(
+    dim[0] for dim in BINNED)
+
+
+class DecisionCube(object):
+    """Decision counts with one axis per dimension.
+
+    Parameters
+    ----------
+    counts : int array of shape (len(MEASURES),) + one axis per dimension
+    labels : dict of dimension name to the list of labels along its axis
+    """
+
+    def __init__(self, counts, labels):
+        self.counts = counts
+        self.labels = labels
+
+    @classmethod
+    def from_fourths(cls, fourths):
+        """Count the coded 4th downs from data_prep.code_fourth_downs."""
+
+        labels = {}
+        codes = []
+        for name, column in DISTINCT:
+            values = fourths[column].astype(str if name == 'team' else
+                                            np.int64).values
+            uniques, code = np.unique(values, return_inverse=True)
+            labels[name] = uniques.tolist()
+            codes.append(code)
+        for name, column, edges, bin_labels in BINNED:
+            labels[name] = list(bin_labels)
+            codes.append(np.searchsorted(edges, fourths[column].values,
+                                         side='left'))
+
+        shape = tuple(len(labels[name]) for name in DIMENSIONS)
+        cell = np.ravel_multi_index(codes, shape)
+
+        went = fourths.goforit.values == 1
+        kicked = fourths.kick.values == 1
+        measures = {'attempts': np.ones(len(cell), dtype=bool),
+                    'went': went,
+                    'converted': went & (fourths.first_down.values == 1),
+                    'punted': fourths.punt.values == 1,
+                    'kicked': kicked,
+                    'made': kicked & (fourths.good.values == 1)}
+
+        size = int(np.prod(shape))
+        counts = np.vstack([np.bincount(cell, weights=measures[name],
+                                        minlength=size)
+                            for name in MEASURES]).astype(np.int32)
+        return cls(counts.reshape((len(MEASURES),) + shape), labels)
+
+    @classmethod
+    def load(cls, fname='data/decision_cube.npz'):
+        with np.load(fname) as npz:
+            labels = dict((name, npz['labels_' + name].tolist())
+                          for name in DIMENSIONS)
+            return cls(npz['counts'], labels)
+
+    def save(self, fname='data/decision_cube.npz'):
+        arrays = dict(('labels_' + name, np.asarray(self.labels[name]))
+                      for name in DIMENSIONS)
+        np.savez_compressed(fname, counts=self.counts, **arrays)
+
+    def positions(self, name, values):
+        """Indices along a dimension's axis of one or more labels."""
+        if not isinstance(values, (list, tuple, set)):
+            values = [values]
+        labels = self.labels[name]
+        try:
+            return [labels.index(value) for value in values]
+        except ValueError:
+            raise KeyError('{} has no label among {!r}. Labels: {}'.format(
+                name, list(values), labels))
+
+    def select(self, by=(), **filters):
+        """Sum the counts over every dimension not in by, keeping only
+        the filtered labels.
+
+        Parameters
+        ----------
+        by      : list of dimension names to keep, in order
+        filters : dimension name to a label or list of labels
+
+        Returns
+        -------
+        counts  : int array of shape (len(MEASURES),) + one axis per
+                  dimension in by
+        """
+
+        unknown = (set(by) | set(filters)) - set(DIMENSIONS)
+        if unknown:
+            raise KeyError('Unknown dimensions {}. Choose from {}.'.format(
+                sorted(unknown), ', '.join(DIMENSIONS)))
+
+        counts = self.counts
+        for name, values in filters.items():
+            counts = counts.take(self.positions(name, values),
+                                 axis=1 + DIMENSIONS.index(name))
+        drop = tuple(1 + i for i, name in enumerate(DIMENSIONS)
+                     if name not in by)
+        counts = counts.sum(axis=drop)
+
+        # Remaining axes are in DIMENSIONS order, put them in by order
+        kept = [name for name in DIMENSIONS if name in by]
+        return counts.transpose([0] + [1 + kept.index(name) for name in by])
+
+    def query(self, by=(), **filters):
+        """Roll-up as a DataFrame, one row per combination of the labels
+        of the dimensions in by, with the counts and the go for it,
+        conversion and field goal rates."""
+
+        counts = self.select(by, **filters)
+        values = counts.reshape(len(MEASURES), -1).T
+        if by:
+            index = pd.MultiIndex.from_product(
+                [self.labels[name] if name not in filters else
+                 [self.labels[name][i] for i in
+                  self.positions(name, filters[name])]
+                 for name in by], names=list(by))
+        else:
+            index = pd.Index(['all'])
+        df = pd.DataFrame(values, index=index, columns=list(MEASURES))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            df['go_rate'] = df.went / df.attempts
+            df['conversion_rate'] = df.converted / df.went
+            df['fg_rate'] = df.made / df.kicked
+        return df
+
+
+def parse_filter(name, value):
+    """Command line filter values are strings; season and qtr labels
+    are ints."""
+    if name in ('season', 'qtr'):
+        return int(value)
+    return value
+
+
+@click.command()
+@click.option('--by', multiple=True, type=click.Choice(DIMENSIONS),
+              help='Dimension to break the rates out by. Repeatable.')
+@click.option('--where', multiple=True,
+              help='DIMENSION=LABEL filter, e.g. qtr=4 or team=PHI. '
+                   'Repeat a dimension to allow several labels.')
+@click.option('--cube', 'fname', default='data/decision_cube.npz')
+@click.option('--min-attempts', default=0,
+              help='Leave out rows with fewer 4th downs than this.')
+def main(by, where, fname, min_attempts):
+    """Print go for it rates from the decision cube."""
+
+    filters = {}
+    for spec in where:
+        name, _, value = spec.partition('=')
+        if name not in DIMENSIONS or not value:
+            raise click.BadParameter('Expected DIMENSION=LABEL with one of '
+                                     '{}, got {!r}.'.format(
+                                         ', '.join(DIMENSIONS), spec))
+        filters.setdefault(name, []).append(parse_filter(name, value))
+
+    cube = DecisionCube.load(fname)
+    try:
+        df = cube.query(list(by), **filters)
+    except KeyError as e:
+        raise click.ClickException(e.args[0])
+    click.echo(df[df.attempts >= min_attempts].to_string())
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,21 @@
 from __future__ import division, print_function
 
 import os
+import resource
 
 import click
 import numpy as np
-import pandas as pd
+
+import aggregate
+import csv_cache
+import cube
+import drive_ep
+import similar
+
+from lazy import LazyModule
+
+# Nothing needs pandas until the CSVs are read
+pd = LazyModule('pandas')
 
 
 def load_games(game_data_fname, remove_ties=False):
@@ -19,7 +30,7 @@ def load_games(game_data_fname, remove_ties=False):
     -------
     games           : DataFrame
     """
-    games = pd.read_csv(game_data_fname, index_col=0)
+    games = csv_cache.read_csv(game_data_fname, index_col=0)
 
     # Data from 2000 import is less reliable, omit this season
     # and use regular season games only.
@@ -58,11 +69,12 @@ def load_pbp(pbp_data_fname, games, remove_knees=False):
     -------
     pbp            : DataFrame
     """
-    pbp = pd.read_csv(pbp_data_fname, index_col=1, low_memory=False,
-                      usecols=['gid', 'pid', 'off', 'def', 'type', 'qtr',
-                               'min', 'sec', 'kne', 'ptso', 'ptsd', 'timo',
-                               'timd', 'dwn', 'ytg', 'yfog', 'yds', 'fd',
-                               'fgxp', 'good', 'pnet', 'pts', 'detail'])
+    pbp = csv_cache.read_csv(pbp_data_fname, index_col=1, low_memory=False,
+                             usecols=['gid', 'pid', 'off', 'def', 'type',
+                                      'qtr', 'min', 'sec', 'kne', 'ptso',
+                                      'ptsd', 'timo', 'timd', 'dwn', 'ytg',
+                                      'yfog', 'yds', 'fd', 'fgxp', 'good',
+                                      'pnet', 'pts', 'detail'])
 
     # Remove overtime
     pbp = pbp[pbp.qtr <= 4]
@@ -178,14 +190,8 @@ def fg_success_rate(fg_data_fname, out_fname, min_pid=473957):
     uses a logistic regression kicking model developed by Josh Katz
     to smooth out these rates.
     """
-    fgs = pd.read_csv(fg_data_fname)
-
-    fgs = fgs.loc[(fgs.fgxp == 'FG') & (fgs.pid >= min_pid)].copy()
-
-    fgs_grouped = fgs.groupby('dist')['good'].agg(
-            {'N': len, 'average': np.mean}).reset_index()
-
-    fgs_grouped['yfog'] = 100 - (fgs_grouped.dist - 17)
+    fgs = csv_cache.read_csv(fg_data_fname)
+    fgs_grouped = aggregate.fg_table(aggregate.fg_stats(fgs, min_pid))
     fgs_grouped[['yfog', 'average']].to_csv(out_fname, index=False)
 
     return fgs_grouped
@@ -205,13 +211,12 @@ def punt_averages(punt_data_fname, out_fname, joined):
     or punt returned for a TD.
     """
 
-    punts = pd.read_csv(punt_data_fname, index_col=0)
+    punts = csv_cache.read_csv(punt_data_fname, index_col=0)
 
     punts = pd.merge(punts, joined[['yfog']],
                      left_index=True, right_index=True)
 
-    punts_dist = pd.DataFrame(punts.groupby('yfog')['pnet']
-                                   .mean().reset_index())
+    punts_dist = aggregate.punt_table(aggregate.punt_stats(punts))
 
     punts_dist.to_csv(out_fname, index=False)
     return punts_dist
@@ -223,30 +228,7 @@ def group_coaches_decisions(fourths):
 
     Writes these to a CSV and returns them."""
 
-    df = fourths.copy()
-
-    df['down_by_td'] = (df.score_diff <= -4).astype(np.uint8)
-    df['up_by_td'] = (df.score_diff >= 4).astype(np.uint8)
-    df['yfog_bin'] = df.yfog // 20
-    df['short'] = (df.ytg <= 3).astype(np.uint8)
-    df['med'] = ((df.ytg >= 4) & (df.ytg <= 7)).astype(np.uint8)
-    df['long'] = (df.ytg > 7).astype(np.uint8)
-
-    grouped = df.groupby(['down_by_td', 'up_by_td', 'yfog_bin',
-                          'short', 'med', 'long'])
-
-    goforit = grouped['goforit'].agg({'proportion_went': np.mean,
-                                      'sample_size': len})
-    punt = grouped['punt'].agg({'proportion_punted': np.mean,
-                                'sample_size': len})
-    kick = grouped['kick'].agg({'proportion_kicked': np.mean,
-                               'sample_size': len})
-
-    decisions = goforit.merge(
-            punt.merge(kick, left_index=True, right_index=True,
-                       suffixes=['_punt', '_kick']),
-            left_index=True, right_index=True, suffixes=['_goforit', 'punt'])
-
+    decisions = aggregate.decision_table(aggregate.decision_stats(fourths))
     decisions.to_csv('data/coaches_decisions.csv')
     return decisions
 
@@ -262,65 +244,45 @@ def first_down_rates(df_plays, yfog):
                If yfog_bin, use the decile of the field instead.
     """
 
-    downs = df_plays.copy()
-    if yfog == 'yfog_bin':
-        # Break the field into deciles
-        downs[yfog] = downs.yfog // 10
-        downs = downs.loc[downs.yfog < 90].copy()
-    else:
-        downs = downs.loc[downs.yfog >= 90].copy()
-
-    # For each segment, find the average first down rate by dwn & ytg
-    grouped = (downs.groupby([yfog, 'dwn', 'ytg'])['first_down']
-                    .agg({'fdr': np.mean, 'N': len})
-                    .reset_index())
-
-    # Just keep 3rd & 4th downs
-    grouped = grouped.loc[grouped.dwn >= 3].copy()
-    merged = grouped.merge(grouped, on=[yfog, 'ytg'], how='left')
-
-    # Note this will lose scenarios that have *only* ever seen a 4th down
-    # This matches to one play since 2001.
-    merged = merged.loc[(merged.dwn_x == 4) & (merged.dwn_y == 3)].copy()
-
-    # Compute a weighted mean of FDR on 3rd & 4th down to deal with sparsity
-    merged['weighted_N_x'] = (merged.fdr_x * merged.N_x)
-    merged['weighted_N_y'] = (merged.fdr_y * merged.N_y)
-    merged['weighted_total'] = (merged.weighted_N_x + merged.weighted_N_y)
-    merged['total_N'] = (merged.N_x + merged.N_y)
-    merged['weighted_fdr'] = (merged.weighted_total / merged.total_N)
-    merged = merged.drop(labels=['weighted_N_x', 'weighted_N_y',
-                                 'weighted_total', 'total_N'], axis='columns')
-    merged = merged.rename(columns={'dwn_x': 'dwn'})
-
-    # Need to fill in any missing combinations where possible
-    merged = merged.set_index([yfog, 'dwn', 'ytg'])
-    p = pd.MultiIndex.from_product(merged.index.levels,
-                                   names=merged.index.names)
-    merged = merged.reindex(p, fill_value=None).reset_index()
-    merged = merged.rename(columns={'weighted_fdr': 'fdr'})
-
-    # Eliminate impossible combinations
-    if yfog == 'yfog_bin':
-        # Sparse situations, just set to p(success) = 0.1
-        merged.loc[merged.ytg > 13, 'fdr'] = 0.10
+    merged = aggregate.first_down_table(aggregate.first_down_stats(df_plays),
+                                        yfog)
+    save_first_down_rates(merged, yfog)
+    return merged
 
-        # Missing values inside -10 because no one goes for it here
-        merged.loc[(merged.fdr_x.isnull()) & (merged.ytg <= 3),
-                   'fdr'] = .2
-        merged.loc[(merged.fdr_x.isnull()) & (merged.ytg > 3),
-                   'fdr'] = .1
 
-        # Fill in missing values
-        merged['fdr'] = merged['fdr'].interpolate()
+def save_first_down_rates(merged, yfog):
+    """Write first down rates to the CSV for their segment of the field."""
+    if yfog == 'yfog_bin':
         merged.to_csv('data/fd_open_field.csv', index=False)
     else:
-        merged = merged.loc[(merged.yfog + merged.ytg <= 100)]
-        merged.loc[(merged.yfog == 99) & (merged.ytg == 1), 'fdr'] = (
-                merged.loc[(merged.yfog == 99) & (merged.ytg == 1), 'fdr_x'])
-        merged['fdr'] = merged['fdr'].interpolate()
         merged.to_csv('data/fd_inside_10.csv', index=False)
-    return merged
+
+
+def save_historical_tables(stats):
+    """Derive the historical tables from the merged stats returned by
+    aggregate.historical_stats and write them to data/.
+
+    Returns
+    -------
+    fd_open_field, fd_inside_10 : DataFrames of first down rates
+    """
+
+    decisions = aggregate.decision_table(stats['decisions'])
+    decisions.to_csv('data/coaches_decisions.csv')
+
+    fgs_grouped = aggregate.fg_table(stats['fgs'])
+    fgs_grouped[['yfog', 'average']].to_csv('data/fgs_grouped.csv',
+                                            index=False)
+
+    punts_dist = aggregate.punt_table(stats['punts'])
+    punts_dist.to_csv('data/punts_grouped.csv', index=False)
+
+    fd_open_field = aggregate.first_down_table(stats['first_downs'],
+                                               'yfog_bin')
+    save_first_down_rates(fd_open_field, 'yfog_bin')
+    fd_inside_10 = aggregate.first_down_table(stats['first_downs'], 'yfog')
+    save_first_down_rates(fd_inside_10, 'yfog')
+    return fd_open_field, fd_inside_10
 
 
 def join_df_first_down_rates(df, fd_open_field, fd_inside_10):
@@ -337,6 +299,88 @@ def join_df_first_down_rates(df, fd_open_field, fd_inside_10):
     return new_df
 
 
+def join_first_down_rates_inplace(df, fd_open_field, fd_inside_10):
+    """Same columns as join_df_first_down_rates, but added to df in place
+    instead of rebuilding it from two merged copies. Plays with no yfog,
+    which join_df_first_down_rates drops, are dropped here too."""
+
+    df.drop(df.index[df.yfog.isnull()], inplace=True)
+
+    open_field = (df.yfog < 90).values
+    inside_10 = ~open_field
+
+    keys = df.loc[open_field, ['dwn', 'ytg']]
+    keys['yfog_bin'] = df.loc[open_field, 'yfog'] // 10
+    open_rates = keys.merge(fd_open_field, on=['yfog_bin', 'dwn', 'ytg'],
+                            how='left')
+
+    keys = df.loc[inside_10, ['dwn', 'ytg', 'yfog']]
+    inside_rates = keys.merge(fd_inside_10, on=['dwn', 'ytg', 'yfog'],
+                              how='left')
+
+    for col in fd_open_field.columns.union(fd_inside_10.columns):
+        if col in ('yfog_bin', 'dwn', 'ytg', 'yfog'):
+            continue
+        values = np.empty(df.shape[0])
+        values.fill(np.nan)
+        if col in open_rates:
+            values[open_field] = open_rates[col].values
+        if col in inside_rates:
+            values[inside_10] = inside_rates[col].values
+        df[col] = values
+    return df
+
+
+def downcast(df, min_int=np.int16):
+    """Shrink numeric columns in place to the smallest dtype that holds
+    their values exactly.
+
+    Integers never go below min_int, which leaves headroom for the
+    arithmetic done on yard lines and clocks later. Floats become
+    float32 only when every value survives the round trip.
+    """
+
+    int_types = [t for t in (np.int8, np.int16, np.int32, np.int64)
+                 if np.dtype(t).itemsize >= np.dtype(min_int).itemsize]
+
+    for col in df.columns:
+        values = df[col].values
+        if values.dtype.kind in 'iu' and values.shape[0]:
+            lo, hi = values.min(), values.max()
+            for t in int_types:
+                if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+                    if t != values.dtype:
+                        df[col] = values.astype(t)
+                    break
+        elif values.dtype == np.float64:
+            small = values.astype(np.float32)
+            same = (small == values) | (np.isnan(small) & np.isnan(values))
+            if same.all():
+                df[col] = small
+    return df
+
+
+def categorize(df, columns):
+    """Store low-cardinality string columns as categoricals, in place."""
+    for col in columns:
+        if col in df:
+            df[col] = df[col].astype('category')
+    return df
+
+
+def report_memory(stage):
+    """Echo current and peak resident memory after a stage of prep."""
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        rss_mb = pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except IOError:
+        rss_mb = float('nan')
+    click.echo('  [{}] rss {:.0f} MB, peak {:.0f} MB'.format(stage, rss_mb,
+                                                            peak_mb))
+
+
 def kneel_down(df):
     """Code a situation a 1 if the offense can kneel to end the game
     based on time remaining, defensive timeouts remaining,
@@ -372,7 +416,7 @@ def calculate_prob_poss(drive_fname, out_name, games):
     Used to weight the win probabilities in the 4th quarter.
     """
 
-    drives = pd.read_csv(drive_fname, index_col=1)
+    drives = csv_cache.read_csv(drive_fname, index_col=1)
     drives = drives.merge(games[['seas', 'wk']],
                           left_index=True, right_index=True)
 
@@ -399,9 +443,29 @@ def calculate_prob_poss(drive_fname, out_name, games):
     final_drives.to_csv('data/final_drives.csv')
 
 
+# Game columns used downstream, joined onto plays in low memory mode.
+GAME_COLUMNS = ['seas', 'wk', 'v', 'h', 'sprv', 'winner']
+
+# String columns with few distinct values, stored as categoricals in low
+# memory mode.
+CATEGORICAL_COLUMNS = ['off', 'def', 'v', 'h', 'winner', 'type', 'fgxp']
+
+
 @click.command()
 @click.argument('pbp_data_location')
-def main(pbp_data_location):
+@click.option('--low-memory/--no-low-memory', default=False,
+              help='Join only the game columns needed, downcast numeric '
+                   'columns, use categoricals and drop play text once '
+                   'fourth downs are coded.')
+@click.option('--jobs', default=1,
+              help='Processes used to aggregate the historical tables, '
+                   'one season per task.')
+@click.option('--cache-dir', default='data/cache',
+              help='Where parsed copies of the CSVs are kept, so unchanged '
+                   'files are not parsed again.')
+@click.option('--cache/--no-cache', default=True,
+              help='Use the parsed CSV cache.')
+def main(pbp_data_location, low_memory, jobs, cache_dir, cache):
     pd.set_option('display.max_columns', 200)
     pd.set_option('display.max_colwidth', 200)
     pd.set_option('display.width', 200)
@@ -409,15 +473,25 @@ def main(pbp_data_location):
     if not os.path.exists('data'):
         click.echo('Making data directory.')
         os.mkdir('data')
+    csv_cache.SETTINGS['dir'] = cache_dir if cache else None
 
     click.echo('Loading game data.')
     games = load_games('{}/GAME.csv'.format(pbp_data_location))
     click.echo('Loading play by play data.')
     pbp = load_pbp('{}/PBP.csv'.format(pbp_data_location),
                    games, remove_knees=False)
+    report_memory('load')
 
     click.echo('Joining game and play by play data.')
-    joined = pbp.merge(games, left_on='gid', right_index=True)
+    if low_memory:
+        # Add just the needed game columns to the plays, no merged copy
+        for col in GAME_COLUMNS:
+            pbp[col] = pbp.gid.map(games[col])
+        joined = pbp
+    else:
+        joined = pbp.merge(games, left_on='gid', right_index=True)
+    del pbp
+    report_memory('join')
 
     # Switch offensive and defensive stats on PUNT/KOFF
     click.echo('Munging data...')
@@ -442,52 +516,86 @@ def main(pbp_data_location):
     joined['secs_left'] = (((4 - joined.qtr) * 15.0) * 60 +
                            (joined['min'] * 60) + joined.sec)
 
+    if low_memory:
+        # Only after the arithmetic above, which needs the wider types
+        downcast(joined)
+        categorize(joined, CATEGORICAL_COLUMNS)
+    report_memory('munge')
+
     # Group all fourth downs that indicate if the team went for it or not
     # by down, yards to go, and yards from own goal
 
     click.echo('Processing fourth downs.')
     fourths = code_fourth_downs(joined)
+    similar.save_index(similar.build_index(fourths))
+    cube.DecisionCube.from_fourths(fourths).save()
 
     # Merge the goforit column back into all plays, not just fourth downs
-    joined = joined.merge(fourths[['goforit']], left_index=True,
-                          right_index=True, how='left')
+    if low_memory:
+        joined['goforit'] = fourths['goforit']
+        joined.drop('detail', axis='columns', inplace=True)
+    else:
+        joined = joined.merge(fourths[['goforit']], left_index=True,
+                              right_index=True, how='left')
 
-    click.echo('Grouping and saving historical 4th down decisions.')
-    decisions = group_coaches_decisions(fourths)
     fourths_grouped = fourths.groupby(['dwn', 'ytg', 'yfog'])['goforit'].agg(
         {'N': len, 'mean': np.mean})
-    fourths_grouped.to_csv('data/fourths_grouped.csv', index=False)
+    fourths_grouped.to_csv('data/fourths_grouped.csv')
+    report_memory('fourth downs')
 
     # Remove kickoffs and extra points, retain FGs
     joined = joined[(joined['type'] != 'KOFF') & (joined.fgxp != 'XP')]
 
-    click.echo('Grouping and saving field goal attempts and punts.')
-    fgs_grouped = fg_success_rate('{}/FGXP.csv'.format(pbp_data_location),
-                                  'data/fgs_grouped.csv')
-    punt_dist = punt_averages('{}/PUNT.csv'.format(pbp_data_location),
-                              'data/punts_grouped.csv', joined)
-
     # Code situations where the offense can take a knee(s) to win
     click.echo('Coding kneel downs.')
     joined = kneel_down(joined)
 
-    click.echo('Computing first down rates.')
+    click.echo('Aggregating 4th down decisions, field goals, punts and '
+               'first down rates.')
 
     # Only rush & pass plays that were actually executed are eligible
     # for computing first down success rates.
+    plays = joined['type'].isin(['PASS', 'RUSH'])
+    df_plays = joined.loc[plays, ['seas', 'yfog', 'dwn', 'ytg', 'first_down']]
 
-    df_plays = joined.loc[joined['type'].isin(['PASS', 'RUSH']), :].copy()
-    fd_open_field = first_down_rates(df_plays, 'yfog_bin')
-    fd_inside_10 = first_down_rates(df_plays, 'yfog')
-    joined = join_df_first_down_rates(joined, fd_open_field, fd_inside_10)
+    punts = csv_cache.read_csv('{}/PUNT.csv'.format(pbp_data_location),
+                               index_col=0)
+    punts = pd.merge(punts, joined[['yfog', 'seas']],
+                     left_index=True, right_index=True)
+    fgs = csv_cache.read_csv('{}/FGXP.csv'.format(pbp_data_location))
+
+    stats = aggregate.historical_stats(df_plays, fourths, punts, fgs,
+                                       jobs=jobs)
+    del df_plays, punts, fgs
+    fd_open_field, fd_inside_10 = save_historical_tables(stats)
+    report_memory('historical tables')
+
+    if low_memory:
+        joined = join_first_down_rates_inplace(joined, fd_open_field,
+                                               fd_inside_10)
+    else:
+        joined = join_df_first_down_rates(joined, fd_open_field,
+                                          fd_inside_10)
+    report_memory('first down rates')
+
+    # Expected drive points by down, distance and field position, also
+    # kept with each play so models can use it as a feature
+    click.echo('Solving for expected drive points.')
+    drive_table = drive_ep.DriveEP.from_plays(joined)
+    drive_table.save()
+    joined['drive_ep'] = drive_table.lookup_array(joined.dwn, joined.ytg,
+                                                  joined.yfog)
+    report_memory('drive expected points')
 
     click.echo('Calculating final drive statistics.')
     final_drives = calculate_prob_poss(
         '{}/DRIVE.csv'.format(pbp_data_location),
         'data/final_drives.csv', games)
+    report_memory('final drives')
 
     click.echo('Writing cleaned play-by-play data.')
     joined.to_csv('data/pbp_cleaned.csv')
+    report_memory('write')
 
 if __name__ == '__main__':
     main()
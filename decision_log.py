@@ -0,0 +1,362 @@
+"""Append-only log of every decision served, and a tool to query it.
+
+DecisionLog.log only queues the payload with a copy of the situation,
+which takes a microsecond or two. A background thread turns what has
+queued up into fixed-width records, one NumPy column at a time, and
+appends them to the current log file. A new file is started each (UTC)
+day and whenever the current one reaches max_bytes.
+
+Each file is a short JSON header describing the record layout followed
+by packed records, so it can be memory-mapped as a NumPy structured
+array without parsing anything:
+
+    python decision_log.py data/decisions --gid 2015091300 --by best_play
+    python decision_log.py data/decisions --since 2015-09-13 --play punt
+"""
+from __future__ import division, print_function
+
+import calendar
+import collections
+import datetime
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+import click
+import numpy as np
+
+from lazy import LazyModule
+from situation import INDEX
+
+pd = LazyModule('pandas')
+
+log = logging.getLogger('decision_log')
+
+
+MAGIC = b'4THDLOG1'
+
+# Situation inputs, as passed to generate_response
+SITUATION_COLUMNS = ('dwn', 'ytg', 'yfog', 'secs_left', 'score_diff',
+                     'timo', 'timd', 'spread', 'dome')
+
+PROB_COLUMNS = ('pre_play_wp', 'success_wp', 'fail_wp', 'punt_wp', 'fg_wp',
+                'missed_fg_wp', 'wp_ev_goforit', 'prob_success_fg',
+                'fg_ev_wp')
+
+DECISION_COLUMNS = ('prob_success', 'breakeven_punt', 'breakeven_fg',
+                    'wpa_going_for_it', 'drive_ep')
+
+# best_play and kicking_option are stored as indexes into PLAYS
+PLAYS = ('go for it', 'punt', 'kick')
+PLAY_CODES = dict((play, i) for i, play in enumerate(PLAYS))
+
+DTYPE = np.dtype(
+    [('time', '<f8'), ('gid', 'S16'), ('version', 'S40'),
+     ('offense', 'S4'), ('home', 'S4')] +
+    [(name, '<f4') for name in SITUATION_COLUMNS] +
+    [(name, '<f8') for name in PROB_COLUMNS + DECISION_COLUMNS] +
+    [('best_play', 'u1'), ('kicking_option', 'u1'), ('degraded', 'u1')])
+
+
+def header(dtype=DTYPE):
+    """File header: MAGIC, the length of the JSON layout as 4 bytes and
+    the layout, padded so records start on a multiple of 64 bytes."""
+    layout = json.dumps({'descr': dtype.descr}).encode('utf-8')
+    size = len(MAGIC) + 4 + len(layout)
+    layout += b' ' * (-size % 64)
+    return MAGIC + np.array([len(layout)], '<u4').tobytes() + layout
+
+
+def encode(entries):
+    """Records for a list of (time, gid, situation values, context,
+    payload) entries."""
+
+    records = np.zeros(len(entries), dtype=DTYPE)
+    if not entries:
+        return records
+    stamps, gids, values, contexts, payloads = zip(*entries)
+    records['time'] = stamps
+    records['gid'] = [str(gid) if gid is not None else '' for gid in gids]
+    records['version'] = [str(p.get('version', '')) for p in payloads]
+    records['offense'] = [str(c.get('offense', '')) for c in contexts]
+    records['home'] = [str(c.get('home', '')) for c in contexts]
+
+    values = np.vstack(values)
+    for name in SITUATION_COLUMNS:
+        records[name] = values[:, INDEX[name]]
+
+    probs = [payload['probs'] for payload in payloads]
+    decisions = [payload['decision'] for payload in payloads]
+    for name in PROB_COLUMNS:
+        records[name] = [number(p.get(name)) for p in probs]
+    for name in DECISION_COLUMNS:
+        records[name] = [number(d.get(name)) for d in decisions]
+    records['best_play'] = [PLAY_CODES[d['best_play']] for d in decisions]
+    records['kicking_option'] = [PLAY_CODES[d['kicking_option']]
+                                 for d in decisions]
+    records['degraded'] = [len(d.get('degraded', ())) for d in decisions]
+    return records
+
+
+def number(value):
+    """Float for a column, NaN for missing or non-numeric values."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class DecisionLog(object):
+    """Buffered writer of decision records.
+
+    Parameters
+    ----------
+    directory      : str, created if need be
+    max_bytes      : int, start a new file once the current one is this big
+    flush_interval : float, seconds between writes
+    max_pending    : int, decisions held before new ones are dropped
+                     (and counted) rather than let memory grow
+    prefix         : str, start of the file names. Give each process
+                     writing to a directory its own.
+    """
+
+    def __init__(self, directory, max_bytes=64 << 20, flush_interval=1.,
+                 max_pending=100000, prefix='decisions'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.prefix = prefix
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        self.files = 0
+        self.f = None
+        self.day = None
+        self.wakeup = threading.Event()
+        self.stopping = False
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log(self, situation, payload, gid=None):
+        """Queue one decision. situation is the one passed to
+        generate_response and payload what it returned, with the version
+        of the artifacts used if it has one."""
+        if len(self.pending) >= self.max_pending:
+            self.drop(1)
+            return
+        self.pending.append((time.time(), gid, situation.values.copy(),
+                             situation.context, payload))
+
+    def run(self):
+        while True:
+            stopping = self.stopping
+            self.wakeup.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Could not log decisions.')
+            if stopping:
+                break
+        if self.f is not None:
+            self.f.close()
+
+    def drop(self, n):
+        with self.lock:
+            self.dropped += n
+
+    def flush(self):
+        entries = []
+        while self.pending:
+            entries.append(self.pending.popleft())
+        if not entries:
+            return
+        records = self.records(entries)
+        written = self.written
+        try:
+            # Records from either side of midnight (UTC) go to the files
+            # for their own days
+            days = (records['time'] // 86400).astype(np.int64)
+            for day in np.split(records, np.flatnonzero(np.diff(days)) + 1):
+                self.write(day)
+        except Exception:
+            self.drop(len(records) - (self.written - written))
+            raise
+
+    def records(self, entries):
+        """encode entries, one at a time if the batch fails, so one bad
+        payload only loses itself. Those that fail are dropped and
+        counted."""
+        try:
+            return encode(entries)
+        except Exception:
+            pass
+        encoded = []
+        for entry in entries:
+            try:
+                encoded.append(encode([entry]))
+            except Exception:
+                self.drop(1)
+                log.exception('Could not log a decision.')
+        return np.concatenate([encode([])] + encoded)
+
+    def write(self, records):
+        """Append records from one day, starting new files as needed."""
+        while len(records):
+            room = self.room(records['time'][0])
+            self.f.write(records[:room].tobytes())
+            self.f.flush()
+            self.written += len(records[:room])
+            records = records[room:]
+
+    def room(self, stamp):
+        """Records that fit in the current file, after starting a new one
+        if the day has changed or the current one is full."""
+        day = time.strftime('%Y%m%d', time.gmtime(stamp))
+        if self.f is not None and day == self.day:
+            room = (self.max_bytes - self.f.tell()) // DTYPE.itemsize
+            if room > 0:
+                return room
+        if self.f is not None:
+            self.f.close()
+        self.day = day
+        self.files += 1
+        fname = os.path.join(self.directory, '{}-{}-{}.{:04d}-{}.dlog'.format(
+            self.prefix, day, time.strftime('%H%M%S', time.gmtime(stamp)),
+            self.files, os.getpid()))
+        self.f = open(fname, 'ab')
+        self.f.write(header())
+        return max(1, (self.max_bytes - self.f.tell()) // DTYPE.itemsize)
+
+    def close(self):
+        """Write everything queued and close the current file."""
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+
+def read_log(fname):
+    """Memory-map one log file as a structured array. A record still
+    being written at the end of the file is left out."""
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a decision log.'.format(fname))
+        length = int(np.frombuffer(f.read(4), '<u4')[0])
+        layout = json.loads(f.read(length).decode('utf-8'))
+    dtype = np.dtype([tuple(field) for field in layout['descr']])
+    offset = len(MAGIC) + 4 + length
+    n = (os.path.getsize(fname) - offset) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset, shape=(n,))
+
+
+def log_files(directory, since=None, until=None):
+    """Log files in directory, skipping days outside [since, until)
+    going by their names."""
+    fnames = sorted(glob.glob(os.path.join(directory, '*.dlog')))
+    selected = []
+    for fname in fnames:
+        day = os.path.basename(fname).rsplit('-', 3)[1]
+        start = datetime.datetime.strptime(day, '%Y%m%d')
+        if since is not None and start + datetime.timedelta(1) <= since:
+            continue
+        if until is not None and start >= until:
+            continue
+        selected.append(fname)
+    return selected
+
+
+def query(directory, gid=None, since=None, until=None, play=None,
+          version=None):
+    """Decisions matching every filter given, as one structured array.
+
+    Parameters
+    ----------
+    directory    : str
+    gid, version : str, optional
+    since, until : datetime, optional, the UTC time window [since, until)
+    play         : str, optional, the best play, one of PLAYS
+    """
+    selected = []
+    for fname in log_files(directory, since, until):
+        records = read_log(fname)
+        keep = np.ones(len(records), dtype=bool)
+        if gid is not None:
+            keep &= records['gid'] == str(gid).encode('ascii')
+        if version is not None:
+            keep &= records['version'] == version.encode('ascii')
+        if since is not None:
+            keep &= records['time'] >= calendar.timegm(since.timetuple())
+        if until is not None:
+            keep &= records['time'] < calendar.timegm(until.timetuple())
+        if play is not None:
+            keep &= records['best_play'] == PLAY_CODES[play]
+        selected.append(np.asarray(records[keep]))
+    if not selected:
+        return np.zeros(0, dtype=DTYPE)
+    return np.concatenate(selected)
+
+
+def to_frame(records):
+    """DataFrame of records with the text columns decoded."""
+    df = pd.DataFrame(records)
+    for name in ('gid', 'version', 'offense', 'home'):
+        df[name] = df[name].str.decode('ascii')
+    for name in ('best_play', 'kicking_option'):
+        df[name] = np.asarray(PLAYS)[df[name].values]
+    df['time'] = pd.to_datetime(df['time'], unit='s')
+    return df
+
+
+def parse_day(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+@click.command()
+@click.argument('directory')
+@click.option('--gid', default=None)
+@click.option('--since', default=None, help='YYYY-MM-DD (UTC), inclusive.')
+@click.option('--until', default=None, help='YYYY-MM-DD (UTC), exclusive.')
+@click.option('--play', type=click.Choice(PLAYS), default=None,
+              help='Only decisions with this best play.')
+@click.option('--version', default=None)
+@click.option('--by', multiple=True,
+              help='Column to count decisions by, e.g. best_play, version, '
+                   'gid or offense. Repeatable.')
+@click.option('--show', default=0, help='Print this many decisions.')
+def main(directory, gid, since, until, play, version, by, show):
+    """Count and summarize logged decisions."""
+
+    start = time.time()
+    records = query(directory, gid, parse_day(since), parse_day(until),
+                    play, version)
+    click.echo('{} decisions in {:.3f}s.'.format(len(records),
+                                                 time.time() - start))
+    if len(records) == 0:
+        return
+
+    df = to_frame(records)
+    if show:
+        click.echo(df.tail(show).to_string())
+    if by:
+        unknown = set(by) - set(df.columns)
+        if unknown:
+            raise click.BadParameter('Unknown columns: {}'.format(
+                ', '.join(sorted(unknown))))
+        summary = df.groupby(list(by)).agg(
+            {'pre_play_wp': 'mean', 'wpa_going_for_it': 'mean',
+             'prob_success': 'mean', 'time': 'size'})
+        click.echo(summary.rename(columns={'time': 'n'}).to_string())
+    else:
+        click.echo(df['best_play'].value_counts().to_string())
+
+if __name__ == '__main__':
+    main()
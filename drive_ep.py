@@ -0,0 +1,213 @@
+"""Expected points of a drive from each down, distance and field position.
+
+data_prep counts, over the cleaned play by play, how often each (dwn,
+ytg, yfog) state led to each other state on the next play of the drive,
+and how many points drives ended with from it. These are the transition
+counts of a Markov chain whose absorbing states are the ends of drives.
+The expected points of every state then solve one sparse linear system,
+
+    (I - P) v = b
+
+where P holds the transition probabilities between states and b the
+expected points scored on the play. The solution is stored as a dense
+(dwn, ytg, yfog) table, so a lookup is an array index:
+
+    table = DriveEP.load()
+    table.lookup(4, 2, 65)
+"""
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+
+# Distances beyond this share the last row of the table
+YTG_MAX = 20
+
+# Table shape, indexed by dwn - 1, ytg - 1 and yfog
+SHAPE = (4, YTG_MAX, 101)
+N_STATES = int(np.prod(SHAPE))
+
+# A touchdown is worth its extra point too
+TD_POINTS = 7
+
+
+def state_index(dwn, ytg, yfog):
+    """Flat table index of each state, -1 where the state is not in the
+    table (missing values, yfog outside 0-100, ytg under 1)."""
+
+    dwn = np.asarray(dwn, dtype=np.float64)
+    ytg = np.minimum(np.asarray(ytg, dtype=np.float64), YTG_MAX)
+    yfog = np.asarray(yfog, dtype=np.float64)
+    valid = ((dwn >= 1) & (dwn <= 4) & (ytg >= 1) &
+             (yfog >= 0) & (yfog <= 100))
+    index = np.full(dwn.shape, -1, dtype=np.int64)
+    index[valid] = np.ravel_multi_index(
+        (dwn[valid].astype(np.int64) - 1, ytg[valid].astype(np.int64) - 1,
+         yfog[valid].astype(np.int64)), SHAPE)
+    return index
+
+
+def drive_points(pts):
+    """Points a drive ends with from the points scored on its last play,
+    in terms of the offense."""
+    pts = np.nan_to_num(np.asarray(pts, dtype=np.float64))
+    return np.where(pts >= 6, TD_POINTS, np.where(pts <= -6, -TD_POINTS, pts))
+
+
+def drive_transitions(plays):
+    """Transition counts between states on consecutive plays of a drive.
+
+    A drive continues to the next play of the game when the same team
+    has the ball in the same half and nothing was scored. Otherwise the
+    play ends the drive with drive_points. Plays that leave the state
+    unchanged (offsetting penalties, say) are left out, which does not
+    change the solution.
+
+    Parameters
+    ----------
+    plays    : DataFrame of plays indexed by pid, with gid, off, qtr,
+               dwn, ytg, yfog and pts columns, kickoffs and extra points
+               removed
+
+    Returns
+    -------
+    counts   : scipy.sparse.csr_matrix, counts[i, j] plays from state i
+               to state j
+    points   : array, total points of the drives ended from each state
+    visits   : array, plays from each state
+    """
+    from scipy import sparse
+
+    order = np.lexsort((plays.index.values, plays.gid.values))
+    gid = plays.gid.values[order]
+    off = plays.off.astype(str).values[order]
+    half = (plays.qtr.values[order] > 2)
+    state = state_index(plays.dwn.values[order], plays.ytg.values[order],
+                        plays.yfog.values[order])
+    pts = drive_points(plays.pts.values[order])
+
+    # Whether each play's drive continues with the next play
+    continues = np.zeros(len(state), dtype=bool)
+    continues[:-1] = ((gid[1:] == gid[:-1]) & (off[1:] == off[:-1]) &
+                      (half[1:] == half[:-1]) & (pts[:-1] == 0))
+    following = np.full(len(state), -1, dtype=np.int64)
+    following[:-1] = state[1:]
+
+    moves = continues & (state >= 0) & (following >= 0)
+    ends = ~continues & (state >= 0)
+    moves &= following != state
+
+    visits = np.bincount(state[moves | ends], minlength=N_STATES)
+    points = np.bincount(state[ends], weights=pts[ends], minlength=N_STATES)
+    counts = sparse.coo_matrix(
+        (np.ones(moves.sum()), (state[moves], following[moves])),
+        shape=(N_STATES, N_STATES)).tocsr()
+    return counts, points, visits
+
+
+def solve(counts, points, visits, tol=1e-10, max_iter=10000):
+    """Expected drive points of every state, NaN for states never seen.
+
+    Drives last a handful of plays, so the series v = b + P b + P^2 b +
+    ... converges quickly, each term a sparse matrix-vector product. If
+    it has not converged after max_iter terms, the system is factored
+    and solved directly instead. Raises ValueError if some states never
+    reach the end of a drive.
+    """
+    from scipy import sparse
+    from scipy.sparse.linalg import spsolve
+
+    seen = np.flatnonzero(visits > 0)
+    inverse = 1 / visits[seen]
+    P = sparse.diags(inverse, 0).dot(counts[seen][:, seen]).tocsr()
+    b = points[seen] * inverse
+
+    values = b
+    for _ in range(max_iter):
+        updated = P.dot(values) + b
+        change = np.abs(updated - values).max() if len(b) else 0
+        values = updated
+        if change < tol:
+            break
+    else:
+        A = sparse.identity(len(seen), format='csc') - P.tocsc()
+        values = spsolve(A, b)
+
+    if not np.all(np.isfinite(values)):
+        raise ValueError('Drive transitions do not reach the end of a drive '
+                         'from every state.')
+    solution = np.full(N_STATES, np.nan)
+    solution[seen] = values
+    return solution
+
+
+def fill_unobserved(table):
+    """Fill NaN entries of a (dwn, ytg, yfog) table in place, first
+    along yfog within each down and distance, then from the nearest
+    distance with any values."""
+
+    yfog = np.arange(SHAPE[2])
+    for dwn in range(SHAPE[0]):
+        for ytg in range(SHAPE[1]):
+            row = table[dwn, ytg]
+            seen = ~np.isnan(row)
+            if seen.any() and not seen.all():
+                row[~seen] = np.interp(yfog[~seen], yfog[seen], row[seen])
+        filled = [ytg for ytg in range(SHAPE[1])
+                  if not np.isnan(table[dwn, ytg]).any()]
+        if not filled:
+            table[dwn] = 0
+            continue
+        for ytg in range(SHAPE[1]):
+            if np.isnan(table[dwn, ytg]).any():
+                nearest = min(filled, key=lambda f: abs(f - ytg))
+                table[dwn, ytg] = table[dwn, nearest]
+    return table
+
+
+class DriveEP(object):
+    """Expected drive points by down, distance and field position.
+
+    Parameters
+    ----------
+    values : float array of SHAPE, may be memory-mapped
+    visits : int array of SHAPE, plays seen from each state, optional
+    """
+
+    def __init__(self, values, visits=None):
+        self.values = values
+        self.visits = visits
+
+    @classmethod
+    def from_plays(cls, plays):
+        counts, points, visits = drive_transitions(plays)
+        values = solve(counts, points, visits).reshape(SHAPE)
+        return cls(fill_unobserved(values), visits.reshape(SHAPE))
+
+    @classmethod
+    def load(cls, fname='data/drive_ep.npz'):
+        with np.load(fname) as npz:
+            return cls(npz['values'], npz['visits'])
+
+    @staticmethod
+    def exists(fname='data/drive_ep.npz'):
+        return os.path.exists(fname)
+
+    def save(self, fname='data/drive_ep.npz'):
+        np.savez(fname, values=self.values, visits=self.visits)
+
+    def lookup(self, dwn, ytg, yfog):
+        """Expected points of the drive from one state."""
+        return float(self.values[int(dwn) - 1, min(int(ytg), YTG_MAX) - 1,
+                                 int(yfog)])
+
+    def lookup_array(self, dwn, ytg, yfog):
+        """Expected points from each of many states, NaN for states
+        outside the table."""
+        index = state_index(dwn, ytg, yfog)
+        values = np.full(index.shape, np.nan)
+        valid = index >= 0
+        values[valid] = self.values.ravel()[index[valid]]
+        return values
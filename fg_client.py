@@ -0,0 +1,131 @@
+"""Field goal probabilities from one long-lived model-fg.js process.
+
+`node model-fg/model-fg.js --ndjson` reads a JSON situation (or a list
+of them) per line and answers with one line of JSON. Starting node costs
+far more than a field goal evaluation, so FGModelProcess starts it once
+and sends every situation to the same warm process:
+
+    fg_model = FGModelProcess()
+    fg_model.prob(situation)
+    fg_model.probs([situation, ...])
+
+An FGModelProcess can also be used as data['fg_model'] in winprob.
+"""
+from __future__ import division, print_function
+
+import errno
+import json
+import os
+import select
+import subprocess
+import threading
+import time
+
+
+COMMAND = ('node', 'model-fg/model-fg.js', '--ndjson')
+
+
+def as_mapping(situation):
+    """Situations are sent with the keys model-fg.js takes on the
+    command line."""
+    return dict(situation.items())
+
+
+def as_prob(value):
+    """JSON has no NaN, so node writes the NaN the command line would
+    print (missing weather, say) as null."""
+    return float('nan') if value is None else float(value)
+
+
+class FGModelProcess(object):
+    """A model-fg.js process answering one request at a time.
+
+    The process is started on first use. When it fails to answer within
+    a timeout it is killed, so that a late answer cannot be mistaken for
+    the next one, and started again on the next request.
+
+    Parameters
+    ----------
+    command : sequence of str, the command to start
+    """
+
+    def __init__(self, command=COMMAND):
+        self.command = list(command)
+        self.proc = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(self.command,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+            self.buffer = b''
+        return self
+
+    def close(self):
+        """Stop the process. It is started again if used afterwards."""
+        with self.lock:
+            self.stop()
+
+    def stop(self):
+        if self.proc is None:
+            return
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout):
+            f.close()
+        self.proc = None
+
+    def request(self, obj, timeout=None):
+        """Send one line of JSON and return the decoded answer. Raises
+        RuntimeError if the process fails, times out or reports an
+        error."""
+        with self.lock:
+            try:
+                self.start()
+                line = json.dumps(obj) + '\n'
+                self.proc.stdin.write(line.encode('utf-8'))
+                self.proc.stdin.flush()
+                answer = json.loads(self.readline(timeout).decode('utf-8'))
+            except (OSError, IOError, ValueError) as e:
+                self.stop()
+                raise RuntimeError('model-fg.js failed: {}'.format(e))
+        if isinstance(answer, dict):
+            raise RuntimeError('model-fg.js: {}'.format(answer.get('error')))
+        return answer
+
+    def readline(self, timeout=None):
+        """Next line of output, waiting at most timeout seconds."""
+        fd = self.proc.stdout.fileno()
+        deadline = time.time() + timeout if timeout is not None else None
+        while b'\n' not in self.buffer:
+            wait = None
+            if deadline is not None:
+                wait = max(0, deadline - time.time())
+            try:
+                ready, _, _ = select.select([fd], [], [], wait)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                raise IOError('no answer within {:.3f}s'.format(timeout))
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                raise IOError('exited with {}'.format(self.proc.wait()))
+            self.buffer += chunk
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line
+
+    def prob(self, situation, timeout=None):
+        """Probability a field goal attempt from situation is good."""
+        return as_prob(self.request(as_mapping(situation), timeout))
+
+    def probs(self, situations, timeout=None):
+        """Probabilities for a list of situations, in one request."""
+        answer = self.request([as_mapping(s) for s in situations], timeout)
+        return [as_prob(p) for p in answer]
+
+    __call__ = prob
@@ -0,0 +1,93 @@
+from __future__ import division, print_function
+
+import json
+import math
+import os
+
+import numpy as np
+
+
+# Venue axis: 2 * is_dome + is_turf for sea level stadiums, and Denver
+HIGH_ALTITUDE = 4
+
+# Situation keys needed for a lookup, beyond yfog
+WEATHER_KEYS = ('temp', 'wind', 'chanceOfRain')
+
+
+def knot_position(axis, x):
+    """Knot below x on a weather axis and the fraction of the way to the
+    next one, on the axis scale."""
+    knots = axis['knots']
+    f = math.sqrt if axis['scale'] == 'sqrt' else float
+    x = min(knots[-1], max(knots[0], float(x)))
+    i = 0
+    while i < len(knots) - 2 and x > knots[i + 1]:
+        i += 1
+    frac = (f(x) - f(knots[i])) / (f(knots[i + 1]) - f(knots[i]))
+    return i, frac
+
+
+class FGTable(object):
+    """Field goal make probabilities precomputed by
+    model-fg/build-tensor.js, with the same inputs as the node model:
+    kicker_code or offense, is_dome/is_turf or home, yfog, temp, wind and
+    chanceOfRain.
+    """
+
+    def __init__(self, header, values):
+        self.header = header
+        self.values = values
+        self.kicker_index = dict((code, i) for i, code
+                                 in enumerate(header['kickers']))
+
+    @classmethod
+    def load(cls, prefix='models/fg_tensor'):
+        with open(prefix + '.json') as f:
+            header = json.load(f)
+        values = np.memmap(prefix + '.bin', dtype='<i2', mode='r',
+                           shape=tuple(header['shape']))
+        return cls(header, values)
+
+    @staticmethod
+    def exists(prefix='models/fg_tensor'):
+        return os.path.exists(prefix + '.json')
+
+    def can_score(self, situation):
+        """Whether situation has the kicker, venue and weather inputs."""
+        has_kicker = 'offense' in situation or 'kicker_code' in situation
+        has_venue = 'home' in situation or ('is_dome' in situation and
+                                            'is_turf' in situation)
+        return has_kicker and has_venue and all(
+            key in situation for key in WEATHER_KEYS)
+
+    def prob(self, situation):
+        """Probability the kick is made."""
+        header = self.header
+        yfog = int(situation['yfog'])
+        # Kicks from this far out are effectively never made
+        if yfog < header['yfogMin']:
+            return 0.
+
+        if 'offense' in situation:
+            code = header['teams'][situation['offense']]['kicker']
+        else:
+            code = situation['kicker_code']
+        kicker = self.kicker_index.get(code, self.kicker_index['none'])
+
+        if situation.get('home') == 'DEN':
+            venue = HIGH_ALTITUDE
+        elif 'home' in situation:
+            venue = header['teams'][situation['home']]['venue']
+        else:
+            venue = (2 * int(bool(situation['is_dome'])) +
+                     int(bool(situation['is_turf'])))
+
+        cube = self.values[kicker, yfog - header['yfogMin'], venue]
+        pos = [knot_position(axis, situation[axis['name']])
+               for axis in header['weather']]
+        (t, ft), (w, fw), (r, fr) = pos
+        corners = np.asarray(cube[t:t + 2, w:w + 2, r:r + 2], dtype=np.float64)
+        weights = np.einsum('i,j,k->ijk', [1 - ft, ft], [1 - fw, fw],
+                            [1 - fr, fr])
+        log_odds = (weights * corners).sum() / header['scale']
+        return 1 / (1 + math.exp(-log_odds))
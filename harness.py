@@ -0,0 +1,466 @@
+"""Differential checks for faster versions of the decision code.
+
+A deterministic corpus of 4th downs is run through today's decision
+code: generate_response, the plays transitions, calc_prob_success and
+expected_wp_fg. Alternative implementations of each are run on the same
+corpus, and every output is compared within a tolerance. The corpus
+covers the cases the code special-cases: 4th & goal, kicks from beyond
+the 42, field goals that end the game, kneel-down windows, quarter
+boundaries and field positions missing from the punt and first down
+tables. The tables are synthetic by default, so no data is needed:
+
+    python harness.py
+    python harness.py --record reference.json
+    python harness.py --reference reference.json --only response
+
+Recording the reference outputs before changing the decision code and
+checking against them afterwards shows whether the change altered any
+answer. Other implementations can be checked too, with --alternative
+COMPONENT=module:factory. The factory takes (data, model) and returns a
+function from a list of situations to a list of outputs.
+"""
+from __future__ import division, print_function
+
+import importlib
+import json
+import math
+import random
+import shutil
+import tempfile
+import time
+
+from collections import Counter, OrderedDict
+
+import click
+import numpy as np
+import pandas as pd
+
+import artifacts
+import plays as p
+import winprob as wp
+
+from incremental import IncrementalEvaluator, clock_sequence
+from shadow import ShadowScorer
+from situation import FEATURES, N_FEATURES, SituationBatch
+
+
+# Game clock thresholds in plays.kneel_down. The first down scenario
+# runs 10 seconds off, so the windows are probed either side of these
+# plus 10.
+KNEEL_THRESHOLDS = (120, 87, 48, 84, 45, 42)
+
+
+def synthetic_data(seed=0):
+    """Historical tables shaped like data_prep's, and a linear model,
+    made up so the harness runs without the Armchair Analysis data.
+    Some punt, first down and coaches' decision keys are left out on
+    purpose.
+
+    Returns
+    -------
+    data  : dict, as returned by bot.load_data
+    model : artifacts.SharedLogit
+    """
+
+    rng = np.random.RandomState(seed)
+    data = {}
+
+    yfog = np.arange(0, 101)
+    make = np.clip((yfog - 40) / 60, 0, 1)
+    data['fgs'] = pd.DataFrame({'yfog': yfog, 'dome_rate': 0.92 * make,
+                                'open_rate': 0.87 * make})
+
+    punt_yfog = np.arange(1, 90)
+    punt_yfog = punt_yfog[rng.rand(punt_yfog.shape[0]) < 0.85]
+    data['punts'] = pd.DataFrame({
+        'yfog': punt_yfog,
+        'pnet': 42 - punt_yfog / 8 + rng.randn(punt_yfog.shape[0])})
+
+    rows = [(yfog_bin, dwn, ytg, max(0.05, 0.65 - 0.03 * ytg))
+            for yfog_bin in range(9) for dwn in (3, 4)
+            for ytg in range(1, 21) if rng.rand() < 0.9]
+    data['fd_open_field'] = pd.DataFrame(
+        rows, columns=['yfog_bin', 'dwn', 'ytg', 'fdr'])
+
+    rows = [(yfog, dwn, ytg, max(0.05, 0.55 - 0.04 * ytg))
+            for yfog in range(90, 100) for dwn in (3, 4)
+            for ytg in range(1, 101 - yfog) if rng.rand() < 0.9]
+    data['fd_inside_10'] = pd.DataFrame(
+        rows, columns=['yfog', 'dwn', 'ytg', 'fdr'])
+
+    secs = np.arange(0, 901, 5)
+    data['final_drives'] = pd.DataFrame({
+        'secs': secs, 'n': 1, 'pct': 1 / len(secs),
+        'cum_pct': np.linspace(0.01, 1, len(secs))})
+
+    rows = []
+    for down_by_td, up_by_td in ((0, 0), (1, 0), (0, 1)):
+        for yfog_bin in range(5):
+            for short, med, long_ in ((1, 0, 0), (0, 1, 0), (0, 0, 1)):
+                if rng.rand() < 0.9:
+                    went, punted = rng.uniform(0, 0.5, 2)
+                    rows.append((down_by_td, up_by_td, yfog_bin, short, med,
+                                 long_, went, rng.randint(1, 500), punted,
+                                 rng.randint(1, 500), 1 - went - punted,
+                                 rng.randint(1, 500)))
+    data['decisions'] = pd.DataFrame(rows, columns=[
+        'down_by_td', 'up_by_td', 'yfog_bin', 'short', 'med', 'long',
+        'proportion_went', 'sample_size', 'proportion_punted',
+        'sample_size_punt', 'proportion_kicked', 'sample_size_kick'])
+
+    # Roughly the means and spreads of the real features
+    mean = np.array([2.3, 48., 1800., 0., 2.5, 2.5, 0., 0.02, 2.5, 0.])
+    scale = np.array([1.1, 24., 1040., 10., 0.8, 0.8, 3., 0.15, 1.1, 28.])
+    data['scaler'] = artifacts.SharedScaler(mean, scale)
+    data['features'] = list(FEATURES)
+
+    coef = rng.normal(0, 0.3, (1, N_FEATURES))
+    coef[0, FEATURES.index('score_diff')] = 1.2
+    coef[0, FEATURES.index('qtr_scorediff')] = 0.8
+    model = artifacts.SharedLogit(coef, np.array([0.1]))
+    return data, model
+
+
+def corpus(n_random=1000, seed=0):
+    """Situations to check, as (case, Situation) pairs. The edge cases
+    are enumerated, followed by n_random draws from random_situation
+    and runs of clock-only changes within a game."""
+
+    rng = random.Random(seed)
+    cases = []
+
+    def add(case, **fields):
+        situation = wp.random_situation(rng)
+        for key, val in fields.items():
+            situation[key] = val
+        cases.append((case, situation))
+
+    for yfog in range(90, 100):
+        for secs_left in (3500, 1700, 600, 30):
+            add('goal_to_go', yfog=yfog, ytg=100 - yfog, secs_left=secs_left)
+
+    for yfog in range(1, 43, 3):
+        add('long_kick', yfog=yfog, ytg=rng.randint(1, 10))
+
+    for secs_left in (1, 20, 39, 40, 41):
+        for score_diff in range(-3, 2):
+            for timd in (0, 1):
+                add('fg_ends_game', yfog=rng.randint(55, 80),
+                    ytg=rng.randint(1, 10), secs_left=secs_left,
+                    score_diff=score_diff, timd=timd)
+
+    for secs_left in (1, 39, 41):
+        for score_diff in range(-1, 4):
+            for timo in (0, 1):
+                add('opp_fg_ends_game', secs_left=secs_left,
+                    score_diff=score_diff, timo=timo)
+
+    windows = sorted(set(t + 10 + d for t in KNEEL_THRESHOLDS
+                         for d in (-1, 0, 1)))
+    for secs_left in windows:
+        for timd in range(4):
+            add('kneel_window', yfog=rng.randint(20, 85),
+                ytg=rng.randint(1, 3), secs_left=secs_left,
+                score_diff=rng.randint(1, 9), timd=timd)
+
+    punts = set(synthetic_data(seed)[0]['punts'].yfog)
+    for yfog in [y for y in range(1, 100) if y not in punts]:
+        add('missing_punt', yfog=yfog, ytg=min(rng.randint(1, 10), 100 - yfog))
+
+    for ytg in (19, 20, 21, 25, 30):
+        add('missing_first_down', yfog=rng.randint(20, 70), ytg=ytg)
+    for yfog in range(90, 100):
+        for ytg in range(1, 101 - yfog):
+            add('inside_10', yfog=yfog, ytg=ytg)
+
+    for secs_left in (0, 900, 901, 1800, 1801, 2700, 2701, 3600):
+        add('quarter_edge', secs_left=secs_left)
+
+    for _ in range(n_random):
+        cases.append(('random', wp.random_situation(rng)))
+
+    for _ in range(max(1, n_random // 20)):
+        for situation in clock_sequence(wp.random_situation(rng), rng, 8):
+            cases.append(('clock_sequence', situation))
+    return cases
+
+
+def each(function):
+    """Adapt a function of one situation to the list interface, with an
+    exception recorded as that situation's output."""
+
+    def run(situations):
+        outputs = []
+        for situation in situations:
+            try:
+                outputs.append(function(situation))
+            except Exception as e:
+                outputs.append(error(e))
+        return outputs
+    return run
+
+
+def error(e):
+    return {'error': type(e).__name__}
+
+
+# Reference implementations: today's code, one per component.
+
+def response(data, model):
+    return each(lambda s: wp.generate_response(s, data, model))
+
+
+def transitions(data, model):
+    def scenarios(situation):
+        situation = wp.calculate_features(situation, data)
+        return dict((name, new.as_dict()) for name, new in
+                    wp.simulate_scenarios(situation, data).items())
+    return each(scenarios)
+
+
+def prob_success(data, model):
+    return each(lambda s: wp.calc_prob_success(s, data))
+
+
+def fg(data, model):
+    def expected(situation):
+        situation = wp.calculate_features(situation, data)
+        probs = wp.generate_win_probabilities(
+            situation, wp.simulate_scenarios(situation, data), model, data)
+        return list(wp.expected_wp_fg(situation, probs, data))
+    return each(expected)
+
+
+COMPONENTS = OrderedDict([('response', response),
+                          ('transitions', transitions),
+                          ('prob_success', prob_success),
+                          ('fg', fg)])
+
+
+# Alternatives in the repo to check against them.
+
+def incremental_response(data, model):
+    evaluator = IncrementalEvaluator(data, model)
+    return each(lambda s: evaluator.evaluate('harness', s))
+
+
+def artifact_response(data, model):
+    directory = tempfile.mkdtemp()
+    try:
+        artifacts.export_shared(data, model, directory)
+        shared_data, shared_model = artifacts.load_shared(directory)
+    finally:
+        # The arrays stay mapped after their files are removed
+        shutil.rmtree(directory)
+    return each(lambda s: wp.generate_response(s, shared_data, shared_model))
+
+
+def shadow_response(data, model):
+    scorer = ShadowScorer(data, model)
+    return each(scorer.respond)
+
+
+def batch_transitions(data, model):
+    table = p.punt_table(data['punts'])
+    plays = [('touchdown', p.touchdown_batch),
+             ('fail', p.turnover_downs_batch), ('punt', p.punt_batch),
+             ('fg', p.field_goal_batch),
+             ('missed_fg', p.missed_field_goal_batch)]
+
+    def scenarios(situations):
+        featured = [wp.calculate_features(s, data) for s in situations]
+        batch = SituationBatch.from_situations(featured)
+        new = dict((name, p.change_poss_batch(batch, play, table=table))
+                   for name, play in plays)
+        new['first_down'] = p.first_down_batch(batch)
+        goal_to_go = batch.column('ytg') + batch.column('yfog') >= 100
+        outputs = []
+        for i in range(len(batch)):
+            names = ['touchdown' if goal_to_go[i] else 'first_down',
+                     'fail', 'punt', 'fg', 'missed_fg']
+            outputs.append(dict((name, new[name][i].as_dict())
+                                for name in names))
+        return outputs
+    return scenarios
+
+
+ALTERNATIVES = [('response', 'incremental', incremental_response),
+                ('response', 'artifacts', artifact_response),
+                ('response', 'shadow', shadow_response),
+                ('transitions', 'batch', batch_transitions)]
+
+
+def canonical(obj):
+    """Plain JSON types for an output, so recorded and live outputs
+    compare the same way."""
+    if isinstance(obj, dict):
+        return dict((str(key), canonical(val)) for key, val in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [canonical(val) for val in obj]
+    if isinstance(obj, np.ndarray):
+        return canonical(obj.tolist())
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def differences(expected, actual, rtol, atol, path=''):
+    """Paths at which actual differs from expected. Numbers match when
+    within atol + rtol * |expected|, NaN matching NaN."""
+
+    numbers = (int, float)
+    if (isinstance(expected, numbers) and isinstance(actual, numbers) and
+            not isinstance(expected, bool) and not isinstance(actual, bool)):
+        if math.isnan(expected) or math.isnan(actual):
+            same = math.isnan(expected) and math.isnan(actual)
+        else:
+            same = abs(actual - expected) <= atol + rtol * abs(expected)
+        return [] if same else [path]
+    if isinstance(expected, dict) and isinstance(actual, dict):
+        diffs = []
+        for key in sorted(set(expected) | set(actual)):
+            if key not in expected or key not in actual:
+                diffs.append(path + '/' + key)
+            else:
+                diffs.extend(differences(expected[key], actual[key], rtol,
+                                         atol, path + '/' + key))
+        return diffs
+    if isinstance(expected, list) and isinstance(actual, list):
+        if len(expected) != len(actual):
+            return [path]
+        diffs = []
+        for i, (left, right) in enumerate(zip(expected, actual)):
+            diffs.extend(differences(left, right, rtol, atol,
+                                     '{}/{}'.format(path, i)))
+        return diffs
+    return [] if expected == actual else [path]
+
+
+def run(function, situations):
+    """Canonical outputs of an implementation and the seconds taken."""
+    start = time.time()
+    outputs = function(situations)
+    elapsed = time.time() - start
+    if len(outputs) != len(situations):
+        raise ValueError('Expected {} outputs, got {}.'.format(
+            len(situations), len(outputs)))
+    return [canonical(output) for output in outputs], elapsed
+
+
+def compare(expected, actual, cases, rtol, atol):
+    """Mismatches as (index, case, paths)."""
+    mismatches = []
+    for i, (left, right) in enumerate(zip(expected, actual)):
+        paths = differences(left, right, rtol, atol)
+        if paths:
+            mismatches.append((i, cases[i], paths))
+    return mismatches
+
+
+def load_factory(spec):
+    """COMPONENT=module:factory from the command line."""
+    component, _, target = spec.partition('=')
+    module, _, name = target.partition(':')
+    if component not in COMPONENTS or not name:
+        raise click.BadParameter('Expected COMPONENT=module:factory with '
+                                 'one of {}, got {!r}.'.format(
+                                     ', '.join(COMPONENTS), spec))
+    return component, target, getattr(importlib.import_module(module), name)
+
+
+@click.command()
+@click.option('--n', 'n_random', default=1000,
+              help='Random situations on top of the edge cases.')
+@click.option('--seed', default=0)
+@click.option('--repo-data/--synthetic', default=False,
+              help='Use the tables and model in data/ and models/ instead '
+                   'of synthetic ones.')
+@click.option('--only', multiple=True, type=click.Choice(list(COMPONENTS)),
+              help='Check only these components. Repeatable.')
+@click.option('--alternative', 'specs', multiple=True,
+              help='COMPONENT=module:factory to check as well. Repeatable.')
+@click.option('--record', 'record_fname', default=None,
+              help='Save the reference outputs to this file.')
+@click.option('--reference', 'reference_fname', default=None,
+              help='Compare with outputs saved by --record instead of '
+                   "today's code.")
+@click.option('--rtol', default=1e-9)
+@click.option('--atol', default=1e-12)
+@click.option('--show', default=5, help='Mismatches to print per check.')
+def main(n_random, seed, repo_data, only, specs, record_fname,
+         reference_fname, rtol, atol, show):
+    """Check alternative decision code against the reference outputs."""
+
+    if repo_data:
+        import bot
+        data, model = bot.load_data()
+    else:
+        data, model = synthetic_data(seed)
+
+    cases = corpus(n_random, seed)
+    names = [case for case, _ in cases]
+    situations = [situation for _, situation in cases]
+    components = list(only) or list(COMPONENTS)
+
+    checks = [(component, 'current', COMPONENTS[component])
+              for component in components]
+    checks.extend(check for check in ALTERNATIVES if check[0] in components)
+    checks.extend(load_factory(spec) for spec in specs)
+
+    reference = {}
+    timings = {}
+    if reference_fname is not None:
+        with open(reference_fname) as f:
+            recorded = json.load(f)
+        if recorded['cases'] != names:
+            raise click.ClickException(
+                '{} was recorded with a different corpus; use the same '
+                '--n and --seed.'.format(reference_fname))
+        reference = dict((component, recorded['outputs'][component])
+                         for component in components)
+    else:
+        for component in components:
+            reference[component], timings[component] = run(
+                COMPONENTS[component](data, model), situations)
+        checks = [check for check in checks if check[1] != 'current']
+
+    if record_fname is not None:
+        with open(record_fname, 'w') as f:
+            json.dump({'seed': seed, 'cases': names, 'outputs': reference}, f)
+        click.echo('Recorded {} outputs to {}.'.format(
+            len(names) * len(reference), record_fname))
+
+    click.echo('{} situations: {}'.format(len(cases), ', '.join(
+        '{} {}'.format(count, case)
+        for case, count in sorted(Counter(names).items()))))
+
+    failed = 0
+    for component, name, factory in checks:
+        outputs, elapsed = run(factory(data, model), situations)
+        mismatches = compare(reference[component], outputs, names, rtol,
+                             atol)
+        if name == 'current':
+            timings[component] = elapsed
+        speed = ''
+        if name != 'current' and component in timings and elapsed > 0:
+            speed = ', {:.2f}x the reference speed'.format(
+                timings[component] / elapsed)
+        click.echo('{}/{}: {} mismatches, {:.3f} ms per situation{}'.format(
+            component, name, len(mismatches),
+            1000 * elapsed / len(situations), speed))
+        if mismatches:
+            failed += 1
+            by_case = Counter(case for _, case, _ in mismatches)
+            click.echo('  by case: {}'.format(', '.join(
+                '{} {}'.format(count, case)
+                for case, count in sorted(by_case.items()))))
+            for i, case, paths in mismatches[:show]:
+                click.echo('  #{} ({}) {}: {}'.format(
+                    i, case, situations[i], ', '.join(paths[:5])))
+
+    if failed:
+        raise click.ClickException('{} of {} checks found mismatches.'
+                                   .format(failed, len(checks)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Pick up new models and historical tables without restarting.
+
+A StateHolder holds the data, model and version currently being served.
+A Reloader thread watches the files they were loaded from. When those
+change (or reload is requested, say from a signal handler), it loads
+and checks the new version in the background and then swaps it in
+with a single assignment. Requests that already took the old state
+finish with it; later ones get the new one.
+"""
+from __future__ import division, print_function
+
+import hashlib
+import logging
+import os
+import random
+import threading
+
+import numpy as np
+
+import winprob as wp
+
+from situation import FEATURES
+
+
+log = logging.getLogger('hot_reload')
+
+# What bot.load_data reads, relative to the working directory
+SOURCE_FILES = ('models/win_probability.pkl', 'models/scaler.pkl',
+                'data/fgs_grouped.csv', 'data/punts_grouped.csv',
+                'data/fd_open_field.csv', 'data/fd_inside_10.csv',
+                'data/final_drives.csv', 'data/coaches_decisions.csv',
+                'models/fg_tensor.json', 'models/fg_tensor.bin',
+                'data/fourths_index.npz', 'data/drive_ep.npz')
+
+
+class ServingState(object):
+    """One loaded version of the data and model. Not modified once
+    it is being served."""
+
+    def __init__(self, data, model, version, stamp=None):
+        self.data = data
+        self.model = model
+        self.version = version
+        self.stamp = stamp
+
+
+class StateHolder(object):
+    """The ServingState requests should use. Read it once per request
+    with current() and use that state throughout."""
+
+    def __init__(self, state):
+        self.state = state
+
+    def current(self):
+        return self.state
+
+    def swap(self, state):
+        self.state = state
+
+
+def stamp(paths):
+    """Size and mtime of each path that exists, to notice changes."""
+    stamps = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamps.append((path, st.st_size, st.st_mtime))
+    return tuple(stamps)
+
+
+def content_version(paths):
+    """Short hash of the contents of the paths that exist."""
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def pickle_source():
+    """Watched paths and loader for bot.read_data's pickles and CSVs."""
+    def load():
+        import bot
+        data, model = bot.read_data()
+        return data, model, content_version(SOURCE_FILES)
+    return SOURCE_FILES, load
+
+
+def artifact_source(directory):
+    """Watched paths and loader for artifacts exported by server.py."""
+    def load():
+        import artifacts
+        data, model = artifacts.load_shared(directory)
+        return data, model, data['version']
+    return (os.path.join(directory, 'CURRENT'),
+            os.path.join(directory, 'manifest.json')), load
+
+
+def load_state(source):
+    """Load a ServingState from a (paths, load) source, making sure the
+    files didn't change while they were being read."""
+    paths, load = source
+    before = stamp(paths)
+    data, model, version = load()
+    after = stamp(paths)
+    if before != after:
+        raise IOError('Artifacts changed while loading.')
+    return ServingState(data, model, version, after)
+
+
+def validate(state, n_situations=20, seed=0):
+    """Raise ValueError unless state's model and tables answer a few
+    random situations with sane probabilities."""
+    if list(state.data.get('features', FEATURES)) != list(FEATURES):
+        raise ValueError('Features {} do not match {}.'.format(
+            state.data['features'], list(FEATURES)))
+    rng = random.Random(seed)
+    for _ in range(n_situations):
+        payload = wp.generate_response(wp.random_situation(rng), state.data,
+                                       state.model)
+        wps = [val for key, val in payload['probs'].items()
+               if key.endswith('_wp')]
+        if not all(np.isfinite(val) and -1e-9 <= val <= 1 + 1e-9
+                   for val in wps):
+            raise ValueError('Win probabilities out of range: {}'.format(
+                payload['probs']))
+
+
+class Reloader(object):
+    """Thread that swaps new versions into a StateHolder.
+
+    Every interval seconds, or as soon as request() is called, the
+    source's paths are checked. A change must hold for two checks in a
+    row (so files still being copied are not loaded) before the new
+    version is loaded, validated and swapped in. A version that fails to
+    load or validate is logged and not tried again until the files
+    change once more.
+
+    Parameters
+    ----------
+    holder   : StateHolder
+    source   : (paths, load), from pickle_source or artifact_source
+    interval : float, seconds between checks
+    prepare  : function, optional, called with each new ServingState
+               before it is swapped in
+    """
+
+    def __init__(self, holder, source, interval=2., prepare=None):
+        self.holder = holder
+        self.source = source
+        self.interval = interval
+        self.prepare = prepare
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.reloads = 0
+        self.failures = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def request(self):
+        """Check for a new version now. Safe to call from a signal
+        handler."""
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+    def run(self):
+        seen = self.holder.current().stamp
+        failed = None
+        while not self.stopping:
+            forced = self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            if self.stopping:
+                break
+            current = stamp(self.source[0])
+            settled = current == seen
+            seen = current
+            if current in (self.holder.current().stamp, failed):
+                continue
+            if not (settled or forced):
+                continue
+            try:
+                self.reload()
+            except Exception:
+                failed = current
+                self.failures += 1
+                log.exception('Could not reload; still serving %s.',
+                              self.holder.current().version)
+
+    def reload(self):
+        state = load_state(self.source)
+        validate(state)
+        if self.prepare is not None:
+            self.prepare(state)
+        old = self.holder.current()
+        self.holder.swap(state)
+        self.reloads += 1
+        log.info('Now serving %s (was %s).', state.version, old.version)
+        return state
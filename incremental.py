@@ -0,0 +1,254 @@
+"""Incremental re-evaluation of 4th downs within a game.
+
+During a drive the bot is often asked about the same down, distance and
+score several times, with only the clock or a timeout changing. None of
+the scenario field positions and scores, the conversion and field goal
+probabilities or the historical comparisons depend on those, so the
+evaluator keeps them from the last full evaluation of each game and only
+refills the clock-dependent feature columns before scoring again. The
+payload is the same as generate_response's.
+"""
+from __future__ import division, print_function
+
+import random
+import threading
+import time
+
+from collections import Counter, OrderedDict
+
+import click
+import numpy as np
+
+import plays as p
+import winprob as wp
+
+from artifacts import scaler_params
+from situation import INDEX, SituationBatch
+
+
+# Inputs that may change without invalidating a game's cached state, and
+# the derived fields recomputed from them.
+CLOCK_FIELDS = ('secs_left', 'timo', 'timd')
+DERIVED_FIELDS = ('kneel_down', 'qtr', 'qtr_scorediff', 'poss_prob')
+
+# Model features that depend on the clock and timeouts (spread is scaled
+# by the time left), refilled on every evaluation.
+CLOCK_FEATURES = ('secs_left', 'timo', 'timd', 'spread', 'kneel_down',
+                  'qtr', 'qtr_scorediff')
+CLOCK_COLUMNS = np.array([INDEX[name] for name in CLOCK_FEATURES])
+
+# Table lookups reused by each incremental evaluation
+LOOKUPS = ('prob_success', 'prob_success_fg', 'historical')
+
+
+def static_key(situation):
+    """Everything about a situation other than the clock and timeouts,
+    or None if some input can't be compared."""
+    skip = CLOCK_FIELDS + DERIVED_FIELDS
+    key = tuple((name, val) for name, val in situation.items()
+                if name not in skip)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class GameState(object):
+    """What a full evaluation leaves behind for the next one. Never
+    modified once built, so it can be shared between threads."""
+
+    __slots__ = ('key', 'names', 'changes_poss', 'scenarios', 'scaled',
+                 'fail_yfog', 'lookups')
+
+    def __init__(self, key, names, changes_poss, scenarios, scaled,
+                 fail_yfog, lookups):
+        self.key = key
+        self.names = names
+        self.changes_poss = changes_poss
+        self.scenarios = scenarios
+        self.scaled = scaled
+        self.fail_yfog = fail_yfog
+        self.lookups = lookups
+
+
+class IncrementalEvaluator(object):
+    """generate_response with the clock-independent work of the last
+    evaluation of each game kept and reused.
+
+    Parameters
+    ----------
+    data      : dict, contains historical data
+    model     : LogisticRegression
+    max_games : int, games kept, least recently queried dropped first
+    """
+
+    def __init__(self, data, model, max_games=64):
+        self.data = data
+        self.model = model
+        self.max_games = max_games
+        self.games = OrderedDict()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        try:
+            self.mean, self.scale = scaler_params(data['scaler'])
+        except AttributeError:
+            # Not a standard scaler: rescale whole rows instead.
+            self.mean = self.scale = None
+
+    def evaluate(self, game_id, situation):
+        """Decision payload for situation, equal to generate_response's.
+
+        Parameters
+        ----------
+        game_id   : hashable, e.g. the Armchair Analysis gid
+        situation : Situation, not modified
+
+        Returns
+        -------
+        payload   : dict
+        """
+
+        start = time.time()
+        key = static_key(situation)
+        with self.lock:
+            state = self.games.get(game_id)
+            if state is not None:
+                self.games.pop(game_id)
+                self.games[game_id] = state
+
+        situation = wp.calculate_features(situation, self.data)
+        if key is not None and state is not None and state.key == key:
+            payload = self.update(situation, state)
+            kind = 'incremental'
+        else:
+            payload, state = self.full(situation, key)
+            kind = 'full'
+            if key is not None:
+                with self.lock:
+                    self.games.pop(game_id, None)
+                    self.games[game_id] = state
+                    while len(self.games) > self.max_games:
+                        self.games.popitem(last=False)
+
+        with self.lock:
+            self.counts[kind] += 1
+            self.counts[kind + '_secs'] += time.time() - start
+            if kind == 'incremental':
+                self.counts['scenarios_saved'] += len(state.names)
+                self.counts['lookups_saved'] += len(LOOKUPS)
+        return payload
+
+    def full(self, situation, key):
+        """Evaluate from scratch and keep the clock-independent parts."""
+
+        scenarios = wp.simulate_scenarios(situation, self.data)
+        names = list(scenarios.keys())
+        batch = SituationBatch.from_situations(
+            [situation] + list(scenarios.values()))
+        scaled = self.data['scaler'].transform(batch.features())
+        lookups = wp.table_lookups(situation, self.data)
+
+        state = GameState(key, names,
+                          np.array([name != 'first_down' for name in names]),
+                          batch, scaled, scenarios['fail']['yfog'], lookups)
+        return self.respond(situation, state, scaled), state
+
+    def update(self, situation, state):
+        """Evaluate a situation differing from state's only in the clock
+        and timeouts."""
+
+        batch = SituationBatch(state.scenarios.values.copy())
+        batch.values[0] = situation.values
+        p.retime_batch(SituationBatch(batch.values[1:]), situation,
+                       state.changes_poss)
+
+        if self.mean is None:
+            scaled = self.data['scaler'].transform(batch.features())
+        else:
+            scaled = state.scaled.copy()
+            scaled[:, CLOCK_COLUMNS] = (
+                (batch.values[:, CLOCK_COLUMNS] - self.mean[CLOCK_COLUMNS]) /
+                self.scale[CLOCK_COLUMNS])
+        return self.respond(situation, state, scaled)
+
+    def respond(self, situation, state, scaled):
+        pred_probs = self.model.predict_proba(scaled)[:, 1]
+        probs = wp.win_probabilities(situation, state.names, pred_probs,
+                                     state.fail_yfog, self.data)
+        decision, probs = wp.generate_decision(situation, self.data, probs,
+                                               lookups=state.lookups)
+        return {'decision': decision, 'probs': probs,
+                'situation': situation.as_dict()}
+
+    def stats(self):
+        """Evaluation counts, time spent and work saved so far."""
+        with self.lock:
+            stats = dict(self.counts)
+        stats['games'] = len(self.games)
+        for kind in ('full', 'incremental'):
+            stats.setdefault(kind, 0)
+            stats.setdefault(kind + '_secs', 0.)
+        return stats
+
+
+def clock_sequence(situation, rng, length):
+    """Copies of situation with the clock running down and the odd
+    timeout taken, as the bot sees during a drive."""
+    sequence = [situation]
+    for _ in range(length - 1):
+        situation = situation.copy()
+        situation['secs_left'] = max(situation['secs_left'] -
+                                     rng.randint(1, 40), 0)
+        if rng.random() < 0.15:
+            side = rng.choice(['timo', 'timd'])
+            situation[side] = max(situation[side] - 1, 0)
+        sequence.append(situation)
+    return sequence
+
+
+@click.command()
+@click.option('--games', default=100)
+@click.option('--queries', default=8, help='Clock-only queries per game.')
+@click.option('--seed', default=0)
+@click.option('--artifacts', 'artifact_dir', default=None)
+def main(games, queries, seed, artifact_dir):
+    """Replay clock-only query sequences through the incremental
+    evaluator, check every payload equals a full recomputation and
+    report the time saved."""
+
+    import bot
+    from check_threads import fingerprint
+
+    data, model = bot.load_data(artifact_dir)
+    rng = random.Random(seed)
+    evaluator = IncrementalEvaluator(data, model)
+
+    full_secs = 0.
+    mismatches = 0
+    for gid in range(games):
+        for situation in clock_sequence(wp.random_situation(rng), rng,
+                                        queries):
+            start = time.time()
+            expected = wp.generate_response(situation, data, model)
+            full_secs += time.time() - start
+            if (fingerprint(evaluator.evaluate(gid, situation)) !=
+                    fingerprint(expected)):
+                mismatches += 1
+
+    stats = evaluator.stats()
+    n = stats['full'] + stats['incremental']
+    click.echo('{} queries: {} full, {} incremental evaluations, {} table '
+               'lookups and {} scenarios reused.'.format(
+                   n, stats['full'], stats['incremental'],
+                   stats.get('lookups_saved', 0),
+                   stats.get('scenarios_saved', 0)))
+    click.echo('{:.3f} ms per query vs {:.3f} ms recomputing in full.'.format(
+        1000 * (stats['full_secs'] + stats['incremental_secs']) / n,
+        1000 * full_secs / n))
+    if mismatches:
+        raise click.ClickException(
+            '{} payloads differ from a full recomputation.'.format(mismatches))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+from __future__ import division, print_function
+
+import importlib
+
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported the first time one of
+    its attributes is used, keeping heavy imports off the startup path of
+    the command line scripts.
+
+    Usage: `pd = LazyModule('pandas')` in place of `import pandas as pd`.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        return '<lazy module {!r}>'.format(self.__dict__['_name'])
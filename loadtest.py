@@ -0,0 +1,282 @@
+from __future__ import division, print_function
+
+import json
+import os
+import platform
+import random
+import subprocess
+import threading
+import time
+
+from multiprocessing import Pool
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+import click
+import numpy as np
+
+import winprob as wp
+
+
+# Set before the worker processes fork, so they share the loaded data.
+TARGET = {}
+
+
+class InProcessTarget(object):
+    """Call the decision code directly."""
+
+    def __init__(self, data, model):
+        self.data = data
+        self.model = model
+
+    def __call__(self, situation):
+        return wp.generate_response(situation, self.data, self.model)
+
+
+class HttpTarget(object):
+    """POST situations to a running server.py."""
+
+    def __init__(self, url):
+        self.url = url
+
+    def __call__(self, situation):
+        body = json.dumps(situation.as_dict()).encode('utf-8')
+        request = Request(self.url, body,
+                          {'Content-Type': 'application/json'})
+        response = urlopen(request, timeout=30)
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+
+def closed_loop(call, situations, concurrency, duration):
+    """Keep `concurrency` requests in flight: each thread sends its next
+    request as soon as the last one returns.
+
+    Returns
+    -------
+    latencies : list of seconds per successful request
+    errors    : int
+    elapsed   : float, seconds
+    """
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def run(offset):
+        i = offset
+        mine = []
+        failed = 0
+        while time.time() < deadline:
+            situation = situations[i % len(situations)]
+            i += concurrency
+            start = time.time()
+            try:
+                call(situation)
+            except Exception:
+                failed += 1
+                continue
+            mine.append(time.time() - start)
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    start = time.time()
+    threads = [threading.Thread(target=run, args=(n,))
+               for n in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.time() - start
+
+
+def open_loop(call, situations, qps, duration, concurrency):
+    """Send requests on a fixed schedule of `qps` per second, whether or
+    not earlier ones have returned, from up to `concurrency` threads.
+
+    Latency is measured from the time a request was scheduled, not when
+    a thread got to it, so queueing behind slow requests is counted.
+
+    Returns
+    -------
+    latencies : list of seconds per successful request
+    errors    : int
+    elapsed   : float, seconds
+    """
+
+    n_requests = int(qps * duration)
+    start = time.time()
+    schedule = start + np.arange(n_requests) / qps
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    next_request = [0]
+
+    def run():
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                i = next_request[0]
+                next_request[0] += 1
+            if i >= n_requests:
+                break
+            wait = schedule[i] - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                call(situations[i % len(situations)])
+            except Exception:
+                failed += 1
+                continue
+            mine.append(time.time() - schedule[i])
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=run) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.time() - start
+
+
+def run_process(args):
+    """Run one process's share of the load against TARGET['call']."""
+    mode, situations, rate, concurrency, duration = args
+    call = TARGET['call']
+    if mode == 'closed':
+        return closed_loop(call, situations, concurrency, duration)
+    return open_loop(call, situations, rate, duration, concurrency)
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles in ms."""
+    latencies = np.asarray(latencies) * 1000
+    summary = {'requests': int(latencies.shape[0]), 'errors': int(errors),
+               'elapsed_secs': elapsed,
+               'throughput_rps': latencies.shape[0] / elapsed}
+    if latencies.shape[0]:
+        for name, q in (('p50', 50), ('p95', 95), ('p99', 99),
+                        ('p999', 99.9)):
+            summary[name + '_ms'] = float(np.percentile(latencies, q))
+        summary['mean_ms'] = float(latencies.mean())
+        summary['max_ms'] = float(latencies.max())
+    return summary
+
+
+def code_version():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__))
+            ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_comparison(current, previous):
+    click.echo('{:<16} {:>12} {:>12} {:>8}'.format(
+            '', previous.get('label', 'previous'),
+            current.get('label', 'current'), 'change'))
+    for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'p999_ms'):
+        if key not in current or key not in previous:
+            continue
+        old, new = previous[key], current[key]
+        change = (new - old) / old if old else float('nan')
+        click.echo('{:<16} {:>12.2f} {:>12.2f} {:>+7.1%}'.format(
+                key, old, new, change))
+
+
+@click.command()
+@click.option('--mode', type=click.Choice(['closed', 'open']),
+              default='closed',
+              help='closed: fixed concurrency. open: fixed request rate.')
+@click.option('--concurrency', default=4,
+              help='Threads per process. In open mode, the most requests '
+                   'in flight per process.')
+@click.option('--qps', default=100.,
+              help='Total requests per second in open mode.')
+@click.option('--processes', default=1,
+              help='Processes sharing the load, each with its own threads.')
+@click.option('--duration', default=10., help='Seconds to run for.')
+@click.option('--url', default=None,
+              help='Load a running server.py at this URL instead of '
+                   'calling the decision code in-process.')
+@click.option('--artifacts', 'artifact_dir', default=None,
+              help='For in-process runs, load memory-mapped artifacts.')
+@click.option('--situations', 'n_situations', default=1000,
+              help='Size of the corpus of random situations cycled through.')
+@click.option('--seed', default=0)
+@click.option('--label', default=None,
+              help='Name for this run in saved results. Default: git commit.')
+@click.option('--save', default=None, help='Write the results as JSON.')
+@click.option('--compare', default=None,
+              help='Results JSON from an earlier run to compare against.')
+def main(mode, concurrency, qps, processes, duration, url, artifact_dir,
+         n_situations, seed, label, save, compare):
+    """Drive the 4th down decision code with random realistic situations
+    and report throughput and tail latency."""
+
+    rng = random.Random(seed)
+    situations = [wp.random_situation(rng) for _ in range(n_situations)]
+
+    if url is not None:
+        TARGET['call'] = HttpTarget(url)
+    else:
+        import bot
+        data, model = bot.load_data(artifact_dir)
+        TARGET['call'] = InProcessTarget(data, model)
+
+    # Warm up caches and lazy imports before timing
+    for situation in situations[:20]:
+        TARGET['call'](situation)
+
+    args = (mode, situations, qps / processes, concurrency, duration)
+    if processes == 1:
+        results = [run_process(args)]
+    else:
+        pool = Pool(processes=processes)
+        try:
+            results = pool.map(run_process, [args] * processes)
+        finally:
+            pool.close()
+            pool.join()
+
+    latencies = [lat for result in results for lat in result[0]]
+    errors = sum(result[1] for result in results)
+    elapsed = max(result[2] for result in results)
+
+    summary = summarize(latencies, errors, elapsed)
+    summary.update({'label': label or code_version(), 'mode': mode,
+                    'target': url or 'in-process',
+                    'concurrency': concurrency, 'processes': processes,
+                    'qps': qps if mode == 'open' else None,
+                    'duration': duration, 'seed': seed,
+                    'host': platform.node(), 'time': time.time()})
+
+    click.echo('{requests} requests, {errors} errors in {elapsed_secs:.1f}s: '
+               '{throughput_rps:.1f} decisions/s'.format(**summary))
+    if summary['requests']:
+        click.echo('latency ms  p50 {p50_ms:.2f}  p95 {p95_ms:.2f}  '
+                   'p99 {p99_ms:.2f}  p99.9 {p999_ms:.2f}  '
+                   'max {max_ms:.2f}'.format(**summary))
+
+    if save is not None:
+        with open(save, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if compare is not None:
+        with open(compare) as f:
+            print_comparison(summary, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env node
+// Precompute field goal make probabilities over kicker x yfog x venue x
+// weather knots, so a lookup is an array index instead of a call to
+// calculateProb. Probabilities are stored as log-odds, which the model is
+// linear in across the weather knots, so interpolating between knots is
+// exact up to rounding. Writes <out>.bin (int16 log-odds x 1000, C order)
+// and <out>.json (axes and team lookup), then checks the interpolated
+// lookups against calculateProb on random situations.
+//
+//   node model-fg/build-tensor.js --out=models/fg_tensor --samples=100000
+var fs = require('fs');
+var modelFG = require('./model-fg');
+var fgTensor = require('./fg-tensor');
+
+var argv = require('minimist')(process.argv.slice(2));
+var out = argv.out || "models/fg_tensor";
+var samples = argv.samples || 100000;
+var tolerance = argv.tolerance || 0.001;
+
+var SCALE = 1000;
+var YFOG_MIN = 40;
+var YFOG_MAX = 100;
+// Venue axis order, see fgTensor.venueIndex
+var VENUES = ["open_grass", "open_turf", "dome_grass", "dome_turf",
+              "high_altitude"];
+// Temperature and wind knots are evenly spaced in sqrt, the scale the
+// model uses for them.
+var WEATHER = [
+  {name: "temp", scale: "sqrt", knots: [0, 4, 16, 36, 64, 100]},
+  {name: "wind", scale: "sqrt", knots: [0, 4, 16, 36, 64, 100]},
+  {name: "chanceOfRain", scale: "linear", knots: [0, 25, 50]}
+];
+
+var kickers = Object.keys(modelFG.kickerAdjust);
+
+var teams = {};
+Object.keys(modelFG.lookup).forEach(function(code) {
+  var team = modelFG.lookup[code];
+  teams[code] = {
+    kicker: team.kickerCode,
+    venue: code === "DEN" ? fgTensor.HIGH_ALTITUDE : fgTensor.venueIndex(
+      team.roofType !== "open", team.surfaceType === "turf")
+  };
+});
+
+function venueSituation(venue) {
+  if (venue === fgTensor.HIGH_ALTITUDE) return {home: "DEN"};
+  return {is_dome: venue >> 1, is_turf: venue & 1};
+}
+
+var shape = [kickers.length, YFOG_MAX - YFOG_MIN + 1, VENUES.length]
+  .concat(WEATHER.map(function(axis) { return axis.knots.length; }));
+var size = shape.reduce(function(a, b) { return a * b; });
+var values = new Int16Array(size);
+
+var start = Date.now();
+var i = 0;
+kickers.forEach(function(kicker) {
+  for (var yfog = YFOG_MIN; yfog <= YFOG_MAX; yfog++) {
+    for (var venue = 0; venue < VENUES.length; venue++) {
+      var situation = venueSituation(venue);
+      situation.kicker_code = kicker;
+      situation.yfog = yfog;
+      WEATHER[0].knots.forEach(function(temp) {
+        WEATHER[1].knots.forEach(function(wind) {
+          WEATHER[2].knots.forEach(function(rain) {
+            var logOdds = modelFG.linearPredictor(situation, {
+              temp: temp, wind: wind, chanceOfRain: rain});
+            logOdds = Math.round(SCALE * logOdds);
+            values[i++] = Math.max(-32767, Math.min(32767, logOdds));
+          });
+        });
+      });
+    }
+  }
+});
+
+var header = {
+  shape: shape,
+  dtype: "int16",
+  scale: SCALE,
+  yfogMin: YFOG_MIN,
+  kickers: kickers,
+  venues: VENUES,
+  weather: WEATHER,
+  teams: teams
+};
+fs.writeFileSync(out + ".bin", Buffer.from(values.buffer));
+fs.writeFileSync(out + ".json", JSON.stringify(header));
+console.log("Built " + size + " log-odds (" + (2 * size / 1e6).toFixed(1) +
+            " MB) in " + (Date.now() - start) + " ms.");
+
+// Check the interpolated lookup against the model itself
+function uniform(lo, hi) { return lo + Math.random() * (hi - lo); }
+function choice(arr) { return arr[Math.floor(Math.random() * arr.length)]; }
+
+var table = fgTensor.load(out);
+var teamCodes = Object.keys(teams);
+var maxError = 0;
+var worst = null;
+for (var n = 0; n < samples; n++) {
+  var d = {
+    yfog: Math.floor(uniform(0, 101)),
+    temp: uniform(-10, 110),
+    wind: uniform(0, 40),
+    chanceOfRain: uniform(0, 100)
+  };
+  if (Math.random() < 0.5) d.offense = choice(teamCodes);
+  else d.kicker_code = choice(kickers);
+  if (Math.random() < 0.5) d.home = choice(teamCodes);
+  else { d.is_dome = Math.round(Math.random()); d.is_turf = Math.round(Math.random()); }
+
+  var error = Math.abs(table.lookup(d) - modelFG.calculateProb(d));
+  if (error > maxError) {
+    maxError = error;
+    worst = d;
+  }
+}
+
+header.maxError = maxError;
+fs.writeFileSync(out + ".json", JSON.stringify(header));
+console.log("Max error over " + samples + " random situations: " +
+            maxError.toFixed(6));
+if (maxError > tolerance) {
+  console.log("Over tolerance of " + tolerance + " at " + JSON.stringify(worst));
+  process.exit(1);
+}
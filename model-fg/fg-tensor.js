@@ -0,0 +1,96 @@
+// Constant-time lookups into the field goal probability tensor written by
+// build-tensor.js. Takes the same inputs as modelFG.calculateProb.
+(function() {
+
+  var fs = require('fs');
+
+  // Venue axis: 2 * is_dome + is_turf for sea level stadiums, and Denver
+  var HIGH_ALTITUDE = 4;
+
+  function venueIndex(isDome, isTurf) {
+    return 2 * (isDome ? 1 : 0) + (isTurf ? 1 : 0);
+  }
+
+  // Knot below x on a weather axis and the fraction of the way to the next
+  // one, measured on the axis scale (the model is linear in sqrt(temp) and
+  // sqrt(wind)).
+  function position(axis, x) {
+    var knots = axis.knots;
+    var f = axis.scale === "sqrt" ? Math.sqrt : function(v) { return v; };
+    x = Math.min(knots[knots.length - 1], Math.max(knots[0], Number(x)));
+    var i = 0;
+    while (i < knots.length - 2 && x > knots[i + 1]) i++;
+    var frac = (f(x) - f(knots[i])) / (f(knots[i + 1]) - f(knots[i]));
+    return [i, frac];
+  }
+
+  function load(prefix) {
+    var header = JSON.parse(fs.readFileSync(prefix + ".json", "utf8"));
+    var buf = fs.readFileSync(prefix + ".bin");
+    if (buf.byteOffset % 2) buf = Buffer.from(buf);
+    var values = new Int16Array(buf.buffer, buf.byteOffset, buf.length / 2);
+
+    var kickerIndex = {};
+    header.kickers.forEach(function(code, i) { kickerIndex[code] = i; });
+
+    var strides = [];
+    var stride = 1;
+    for (var i = header.shape.length - 1; i >= 0; i--) {
+      strides[i] = stride;
+      stride *= header.shape[i];
+    }
+
+    return {
+      header: header,
+
+      lookup: function(d, situation) {
+        var s = {};
+        [d, situation || {}].forEach(function(obj) {
+          for (var key in obj) s[key] = obj[key];
+        });
+
+        var yfog = Number(s.yfog);
+        // Kicks from this far out are effectively never made
+        if (yfog < header.yfogMin) return 0;
+
+        var code = s.offense !== undefined ?
+          header.teams[s.offense].kicker : s.kicker_code;
+        var kicker = code in kickerIndex ? kickerIndex[code] : kickerIndex.none;
+
+        var venue;
+        if (s.home === "DEN") venue = HIGH_ALTITUDE;
+        else if (s.home !== undefined) venue = header.teams[s.home].venue;
+        else venue = venueIndex(Number(s.is_dome), Number(s.is_turf));
+
+        var base = kicker * strides[0] + (yfog - header.yfogMin) * strides[1] +
+          venue * strides[2];
+        var pos = header.weather.map(function(axis) {
+          return position(axis, s[axis.name]);
+        });
+
+        // trilinear interpolation across the weather knots
+        var logOdds = 0;
+        for (var corner = 0; corner < 8; corner++) {
+          var weight = 1;
+          var index = base;
+          for (var a = 0; a < 3; a++) {
+            var upper = (corner >> a) & 1;
+            weight *= upper ? pos[a][1] : 1 - pos[a][1];
+            index += (pos[a][0] + upper) * strides[3 + a];
+          }
+          if (weight > 0) logOdds += weight * values[index];
+        }
+        logOdds /= header.scale;
+        return Math.exp(logOdds) / (1 + Math.exp(logOdds));
+      }
+    };
+  }
+
+  module.exports = {
+    load: load,
+    position: position,
+    venueIndex: venueIndex,
+    HIGH_ALTITUDE: HIGH_ALTITUDE
+  };
+
+})();
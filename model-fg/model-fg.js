@@ -5,36 +5,55 @@
     var modelFG = {
 
       calculateProb: function(d, situation) {
-        var situation = situation || {};
-        var cloned = _.chain(d)
-          .clone()
-          .extend(situation)
-          .value();
+        var linearPredictor = this.linearPredictor(d, situation);
+        // convert from log-odds to probability
+        var prob = Math.exp(linearPredictor) / (1 + Math.exp(linearPredictor))
+        return Math.round(100000*prob) / 100000;  // round to 5 decimal places
+      },
+
+      // probabilities for an array of situations, each optionally altered by
+      // the same second argument as calculateProb
+      calculateProbBatch: function(situations, situation) {
+        var probs = new Array(situations.length);
+        for (var i = 0; i < situations.length; i++) {
+          probs[i] = this.calculateProb(situations[i], situation);
+        }
+        return probs;
+      },
+
+      // log-odds of making the kick //
+      linearPredictor: function(d, situation) {
+        var merged = {};
+        for (var key in d) merged[key] = d[key];
+        for (key in situation) merged[key] = situation[key];
         // override roof/surface variables if object has 'home' key
-        if ( _.has(cloned, "home") ) cloned.is_dome = this.lookup[cloned.home].roofType !== "open";
-        if ( _.has(cloned, "home") ) cloned.is_turf = this.lookup[cloned.home].surfaceType === "turf";
+        if ( merged.home !== undefined ) {
+          merged.is_dome = this.lookup[merged.home].roofType !== "open";
+          merged.is_turf = this.lookup[merged.home].surfaceType === "turf";
+        }
         // assign kicker_code if object has 'offense' key
-        if ( _.has(cloned, "offense") ) cloned.kicker_code = this.lookup[cloned.offense].kickerCode;
+        if ( merged.offense !== undefined ) merged.kicker_code = this.lookup[merged.offense].kickerCode;
 
-        var kickerTerm = this.kickerAdjust[cloned.kicker_code] || 0;
+        var kickerTerm = this.kickerAdjust[merged.kicker_code] || 0;
         var par = this.terms.parametric;
-        var smoothTerm = _.findWhere(this.terms.smooth, {yfog: Number(cloned.yfog)}).term;
+        var smoothTerm = this.smoothByYfog[Number(merged.yfog)];
+        if (smoothTerm === undefined) {
+          throw new Error("No field goal model term for yfog=" + merged.yfog);
+        }
         var weather = {
-          temp: [0, 100, cloned.temp].sort()[1],
-          wind: cloned.wind,
-          chanceOfRain: Math.min(50, cloned.chanceOfRain)
+          temp: Math.min(100, Math.max(0, merged.temp)),
+          wind: merged.wind,
+          chanceOfRain: Math.min(50, merged.chanceOfRain)
         };
         // put it all together
         var linearPredictor = kickerTerm + smoothTerm + 
-          par.isDomeTRUE * cloned.is_dome +
-          par.isTurfTRUE * cloned.is_turf +
-          par.sqrtGameTemp * ((1 - cloned.is_dome) * Math.sqrt(weather.temp)) +    
-          par.sqrtWindSpeed * ((1 - cloned.is_dome) * Math.sqrt(weather.wind)) +   
-          par.isRainingTRUE * ((1 - cloned.is_dome) * weather.chanceOfRain / 50) +
-          par.highAltitudeTRUE * (cloned.home == "DEN");
-        // convert from log-odds to probability
-        var prob = Math.exp(linearPredictor) / (1 + Math.exp(linearPredictor))
-        return Math.round(100000*prob) / 100000;  // round to 5 decimal places
+          par.isDomeTRUE * merged.is_dome +
+          par.isTurfTRUE * merged.is_turf +
+          par.sqrtGameTemp * ((1 - merged.is_dome) * Math.sqrt(weather.temp)) +    
+          par.sqrtWindSpeed * ((1 - merged.is_dome) * Math.sqrt(weather.wind)) +   
+          par.isRainingTRUE * ((1 - merged.is_dome) * weather.chanceOfRain / 50) +
+          par.highAltitudeTRUE * (merged.home == "DEN");
+        return linearPredictor;
       },
 
       // team/kicker lookup table //
@@ -367,17 +386,48 @@
 
     };
 
+    // smooth terms indexed by yfog, instead of searching terms.smooth
+    modelFG.smoothByYfog = [];
+    modelFG.terms.smooth.forEach(function(t) {
+      modelFG.smoothByYfog[t.yfog] = t.term;
+    });
+
     return modelFG;
 
   }
 
+  // Answer one situation per line of stdin, each a JSON object (or an array
+  // of them), with one line of JSON on stdout: the probability (or an array
+  // of them), or {"error": message}. One process can then answer any number
+  // of situations without paying node's startup each time.
+  function serveNDJSON(modelFG) {
+    var rl = require('readline').createInterface({input: process.stdin});
+    rl.on('line', function(line) {
+      if (!line.trim()) return;
+      var answer;
+      try {
+        var request = JSON.parse(line);
+        answer = Array.isArray(request) ?
+          modelFG.calculateProbBatch(request) : modelFG.calculateProb(request);
+      } catch (e) {
+        answer = {error: e.message};
+      }
+      process.stdout.write(JSON.stringify(answer) + "\n");
+    });
+  }
+
   // if called from command line or python, write probability to stdout
   if (!module.parent) {
     var argv = require('minimist')(process.argv.slice(2));
-    var fgMakeProb = init(require('underscore')).calculateProb(argv);
-    console.log("prob of making FG: ")
-    process.stdout.write(fgMakeProb.toString())
-    console.log("")
+    var modelFG = init(require('underscore'));
+    if (argv.ndjson) {
+      serveNDJSON(modelFG);
+    } else {
+      var fgMakeProb = modelFG.calculateProb(argv);
+      console.log("prob of making FG: ")
+      process.stdout.write(fgMakeProb.toString())
+      console.log("")
+    }
   }
   
   if (typeof define === "function" && define.amd) define(['underscore'], init);
@@ -1,18 +1,24 @@
 from __future__ import division, print_function
 
 import os
+import time
 
 import click
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from sklearn.base import BaseEstimator, TransformerMixin
 from sklearn.cross_validation import train_test_split
+from sklearn.ensemble import GradientBoostingClassifier
 from sklearn.externals import joblib
+from sklearn.externals.joblib import Parallel, delayed
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import (auc, classification_report,
-                             f1_score, log_loss, roc_curve)
-from sklearn.preprocessing import StandardScaler
+                             f1_score, log_loss, roc_auc_score, roc_curve)
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import PolynomialFeatures, StandardScaler
+
+from situation import FEATURES
 
 
 def calibration_plot(preds, truth):
@@ -23,6 +29,8 @@ def calibration_plot(preds, truth):
     calibrated model means that plays with a win probability of n%
     win about n% of the time.
     """
+    import matplotlib.pyplot as plt
+
     cal_df = pd.DataFrame({'pred': preds, 'win': truth})
     cal_df['pred_bin'] = pd.cut(cal_df.pred, 100, labels=False)
 
@@ -46,6 +54,8 @@ def plot_roc(fpr, tpr, roc_auc):
     """Plots the ROC curve for the win probability model along with
     the AUC.
     """
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots()
     ax.set(title='Receiver Operating Characteristic',
            xlim=[0, 1], ylim=[0, 1], xlabel='False Positive Rate',
@@ -56,31 +66,275 @@ def plot_roc(fpr, tpr, roc_auc):
     plt.show()
 
 
-@click.command()
-@click.option('--plot/--no-plot', default=False)
-def main(plot):
-    pd.set_option('display.max_columns', 200)
+def load_plays(fname='data/pbp_cleaned.csv'):
+    """Read the cleaned play by play data and derive the custom model
+    features. Returns a DataFrame of actual plays."""
 
     # Only train on actual plays, remove 2pt conversion attempts
-    click.echo('Reading play by play data.')
-    df = pd.read_csv('data/pbp_cleaned.csv', index_col=0)
+    df = pd.read_csv(fname, index_col=0)
     df_plays = df.loc[(df['type'] != 'CONV')].copy()
+    return add_features(df_plays)
+
+
+def add_features(df_plays):
+    """Custom features, computed the same way at serving time by
+    winprob.calculate_features."""
 
-    # Custom features
     # Interaction between qtr & score difference -- late score differences
     # are more important than early ones.
     df_plays['qtr_scorediff'] = df_plays.qtr * df_plays.score_diff
 
     # Decay effect of spread over course of game
     df_plays['spread'] = df_plays.spread * (df_plays.secs_left / 3600)
+    return df_plays
+
+
+def split_by_game(df, test_size=0.1, random_state=None):
+    """Train/test split that keeps every play of a game on the same
+    side, so the test set never sees a game the model was fit on."""
+    rng = np.random.RandomState(random_state)
+    gids = np.unique(df.gid.values)
+    test_gids = rng.choice(gids, int(round(test_size * gids.shape[0])),
+                           replace=False)
+    in_test = df.gid.isin(test_gids).values
+    return df.loc[~in_test], df.loc[in_test]
+
+
+def dedupe_rows(X, y):
+    """Collapse plays with identical feature rows. The features are
+    mostly small integers, so many plays share a row.
+
+    Returns
+    -------
+    rows   : array, the unique feature rows
+    wins   : array, how many of the plays with each row were won
+    counts : array, how many plays had each row
+    """
+    # Adding 0 turns -0.0 into 0.0 so both compare equal as bytes
+    X = np.ascontiguousarray(X, dtype=np.float64) + 0.
+    keys = X.view(np.dtype((np.void, X.dtype.itemsize * X.shape[1])))
+    _, first, inverse = np.unique(keys.ravel(), return_index=True,
+                                  return_inverse=True)
+    inverse = inverse.ravel()
+    counts = np.bincount(inverse)
+    wins = np.bincount(inverse, weights=np.asarray(y, dtype=np.float64))
+    return X[first], wins, counts
+
+
+def weighted_rows(rows, wins, counts):
+    """Rows, labels and sample weights whose weighted log loss equals
+    the log loss over every play: each unique row once as a win weighted
+    by its wins and once as a loss weighted by its losses."""
+    X = np.vstack([rows, rows])
+    y = np.concatenate([np.ones(rows.shape[0]), np.zeros(rows.shape[0])])
+    weights = np.concatenate([wins, counts - wins])
+    keep = weights > 0
+    return X[keep], y[keep], weights[keep]
+
+
+def fit_weighted_logit(model, X, y, weights):
+    """Fit a LogisticRegression to weighted rows.
+
+    LogisticRegression.fit takes no sample_weight in scikit-learn 0.16,
+    so this minimizes liblinear's objective directly: half the squared
+    norm of the coefficients and the scaled intercept, plus C times the
+    weighted log loss. With the weights from weighted_rows that is the
+    objective model.fit minimizes over every play. Returns model, with
+    coef_, intercept_ and classes_ set.
+    """
+    from scipy.optimize import fmin_l_bfgs_b
+    from scipy.special import expit
+
+    X1 = np.column_stack([X, np.repeat(model.intercept_scaling, X.shape[0])])
+    sign = 2 * np.asarray(y, dtype=np.float64) - 1
+
+    def objective(w):
+        margin = sign * X1.dot(w)
+        value = 0.5 * w.dot(w) + model.C * weights.dot(np.logaddexp(0,
+                                                                   -margin))
+        grad = w - model.C * X1.T.dot(weights * sign * expit(-margin))
+        return value, grad
+
+    w, _, info = fmin_l_bfgs_b(objective, np.zeros(X1.shape[1]), factr=10,
+                               pgtol=1e-8, maxiter=10000)
+    if info['warnflag']:
+        raise RuntimeError('Weighted fit did not converge: {}'.format(
+            info['task']))
+    model.coef_ = w[np.newaxis, :-1]
+    model.intercept_ = w[-1:] * model.intercept_scaling
+    model.classes_ = np.array([0, 1])
+    return model
+
+
+def calibration_error(preds, truth, bins=10):
+    """Expected calibration error: the gap between predicted and
+    observed win rates per probability bin, weighted by bin size."""
+    preds = np.asarray(preds)
+    truth = np.asarray(truth)
+    bin_ids = np.minimum((preds * bins).astype(np.int64), bins - 1)
+    counts = np.bincount(bin_ids, minlength=bins)
+    pred_sums = np.bincount(bin_ids, weights=preds, minlength=bins)
+    win_sums = np.bincount(bin_ids, weights=truth, minlength=bins)
+    return np.abs(pred_sums - win_sums).sum() / counts.sum()
+
+
+class SplineFeatures(BaseEstimator, TransformerMixin):
+    """Piecewise linear spline basis: appends max(0, x - knot) for knots
+    at quantiles of each column with more than n_knots distinct values.
+    """
+
+    def __init__(self, n_knots=4):
+        self.n_knots = n_knots
+
+    def fit(self, X, y=None):
+        X = np.asarray(X)
+        quantiles = np.linspace(0, 100, self.n_knots + 2)[1:-1]
+        self.knots_ = []
+        for j in range(X.shape[1]):
+            if np.unique(X[:, j]).shape[0] > self.n_knots:
+                for knot in np.unique(np.percentile(X[:, j], quantiles)):
+                    self.knots_.append((j, knot))
+        return self
+
+    def transform(self, X):
+        X = np.asarray(X)
+        hinges = [np.maximum(0, X[:, j] - knot) for j, knot in self.knots_]
+        return np.column_stack([X] + hinges)
+
+
+def candidate_models():
+    """Win probability models the zoo can choose from. All of them are
+    fit on standardized features."""
+    return {
+        'logit': LogisticRegression(),
+        'logit_interactions': make_pipeline(
+            PolynomialFeatures(degree=2, interaction_only=True,
+                               include_bias=False),
+            LogisticRegression()),
+        'logit_splines': make_pipeline(SplineFeatures(),
+                                       LogisticRegression()),
+        'gbm': GradientBoostingClassifier(n_estimators=100, max_depth=3),
+    }
+
+
+def fit_candidate(name, model, train_X, train_y):
+    start = time.time()
+    model.fit(train_X, train_y)
+    return name, model, time.time() - start
+
+
+def evaluate_candidate(model, scaler, test_X, test_y, repeats=200):
+    """Accuracy and speed of a fitted candidate on raw test features.
+
+    Latency is the median time to scale and score one row, the way the
+    bot scores a situation. Throughput is rows per second when scoring
+    the whole test set in one call.
+    """
+
+    start = time.time()
+    preds = model.predict_proba(scaler.transform(test_X))[:, 1]
+    batch_secs = time.time() - start
+
+    row = test_X[:1]
+    timings = []
+    for _ in range(repeats):
+        start = time.time()
+        model.predict_proba(scaler.transform(row))
+        timings.append(time.time() - start)
+
+    return {'auc': roc_auc_score(test_y, preds),
+            'log_loss': log_loss(test_y, preds),
+            'calibration_error': calibration_error(preds, test_y),
+            'latency_us': 1e6 * np.median(timings),
+            'rows_per_sec': test_X.shape[0] / batch_secs}
+
+
+def run_zoo(df_plays, features, target, names, latency_budget_us, n_jobs):
+    """Fit each named candidate on the same game-level split in
+    parallel, report how they do, and return the name and model of the
+    lowest log loss candidate within the latency budget along with the
+    scaler and a DataFrame of results."""
+
+    click.echo('Splitting data into train/test sets by game.')
+    train, test = split_by_game(df_plays, test_size=0.1, random_state=0)
+    train_X, train_y = train[features].values, train[target].values
+    test_X, test_y = test[features].values, test[target].values
+
+    scaler = StandardScaler()
+    scaler.fit(train_X)
+    scaler.n_samples_seen_ = train_X.shape[0]
+    train_X_scaled = scaler.transform(train_X)
+
+    candidates = candidate_models()
+    unknown = set(names) - set(candidates)
+    if unknown:
+        raise click.BadParameter('Unknown candidates: {}. Choose from {}.'
+                                 .format(', '.join(sorted(unknown)),
+                                         ', '.join(sorted(candidates))))
+
+    click.echo('Fitting {} candidates.'.format(len(names)))
+    fitted = Parallel(n_jobs=n_jobs)(
+        delayed(fit_candidate)(name, candidates[name], train_X_scaled,
+                               train_y)
+        for name in names)
+
+    rows = []
+    models = {}
+    for name, model, fit_secs in fitted:
+        click.echo('Evaluating {}.'.format(name))
+        result = evaluate_candidate(model, scaler, test_X, test_y)
+        result.update({'model': name, 'fit_secs': fit_secs})
+        rows.append(result)
+        models[name] = model
+
+    results = pd.DataFrame(rows).set_index('model').sort('log_loss')
+    results['within_budget'] = results.latency_us <= latency_budget_us
+    click.echo(results.to_string())
+
+    eligible = results[results.within_budget]
+    if eligible.shape[0] == 0:
+        raise click.ClickException('No candidate scores a row within {} us.'
+                                   .format(latency_budget_us))
+    best = eligible.index[0]
+    return best, models[best], scaler, results
+
+
+@click.command()
+@click.option('--plot/--no-plot', default=False)
+@click.option('--zoo/--no-zoo', default=False,
+              help='Fit several candidate models and export the best one '
+                   'within the latency budget.')
+@click.option('--candidates', default=','.join(sorted(candidate_models())),
+              help='Comma-separated candidate names for --zoo.')
+@click.option('--latency-budget-us', default=500.0,
+              help='Max median time to score one row, in microseconds.')
+@click.option('--jobs', default=-1, help='Parallel fits for --zoo.')
+@click.option('--dedupe/--no-dedupe', default=False,
+              help='Fit the logistic model on unique feature rows weighted '
+                   'by their wins and losses. Same model, less time.')
+@click.option('--compare-full/--no-compare-full', default=False,
+              help='With --dedupe, also fit on every play and report the '
+                   'speedup and the largest coefficient difference.')
+def main(plot, zoo, candidates, latency_budget_us, jobs, dedupe,
+         compare_full):
+    pd.set_option('display.max_columns', 200)
+
+    click.echo('Reading play by play data.')
+    df_plays = load_plays()
 
     # Features to use in the model
-    features = ['dwn', 'yfog', 'secs_left',
-                'score_diff', 'timo', 'timd', 'spread',
-                'kneel_down', 'qtr',
-                'qtr_scorediff']
+    features = list(FEATURES)
     target = 'win'
 
+    if zoo:
+        names = [name.strip() for name in candidates.split(',')]
+        best, model, scaler, results = run_zoo(
+                df_plays, features, target, names, latency_budget_us, jobs)
+        click.echo('Selected {}.'.format(best))
+        save_model(model, scaler)
+        results.to_csv('models/zoo_results.csv')
+        return
+
     click.echo('Splitting data into train/test sets.')
     (train_X, test_X, train_y, test_y) = train_test_split(df_plays[features],
                                                           df_plays[target],
@@ -89,11 +343,39 @@ def main(plot):
     click.echo('Scaling features.')
     scaler = StandardScaler()
     scaler.fit(train_X)
+    scaler.n_samples_seen_ = train_X.shape[0]
     train_X_scaled = scaler.transform(train_X)
 
     click.echo('Training model.')
     logit = LogisticRegression()
-    logit.fit(train_X_scaled, train_y)
+    if dedupe:
+        rows, wins, counts = dedupe_rows(train_X.values, train_y.values)
+        click.echo('{} plays collapse to {} unique feature rows '
+                   '({:.1f}x smaller).'.format(train_X.shape[0],
+                                               rows.shape[0],
+                                               train_X.shape[0] /
+                                               rows.shape[0]))
+        rows_scaled = scaler.transform(rows)
+        X, y, weights = weighted_rows(rows_scaled, wins, counts)
+        start = time.time()
+        fit_weighted_logit(logit, X, y, weights)
+        fit_secs = time.time() - start
+        hessian = logistic_hessian(logit, rows_scaled, counts)
+
+        if compare_full:
+            full = LogisticRegression()
+            start = time.time()
+            full.fit(train_X_scaled, train_y)
+            full_secs = time.time() - start
+            diff = np.abs(np.r_[full.intercept_, full.coef_.ravel()] -
+                          np.r_[logit.intercept_, logit.coef_.ravel()]).max()
+            click.echo('Fit in {:.3f}s vs {:.3f}s on every play ({:.1f}x '
+                       'faster). Largest coefficient difference: {:.2e}.'
+                       .format(fit_secs, full_secs, full_secs / fit_secs,
+                               diff))
+    else:
+        logit.fit(train_X_scaled, train_y)
+        hessian = logistic_hessian(logit, train_X_scaled)
 
     click.echo('Making predictions on test set.')
     test_X_scaled = scaler.transform(test_X)
@@ -115,12 +397,36 @@ def main(plot):
         plot_roc(fpr, tpr, roc_auc)
         calibration_plot(preds, test_y)
 
+    save_model(logit, scaler, hessian)
+
+
+def logistic_hessian(model, X_scaled, counts=None):
+    """Hessian of the penalized log loss of a fitted LogisticRegression
+    over [intercept, coefficients]. Saved with the model so model_update
+    can fold in new plays without the old ones. Pass counts when
+    X_scaled holds the unique rows from dedupe_rows."""
+    X1 = np.column_stack([np.ones(X_scaled.shape[0]), X_scaled])
+    pred = model.predict_proba(X_scaled)[:, 1]
+    weights = pred * (1 - pred)
+    if counts is not None:
+        weights = weights * counts
+    return np.dot(X1.T * weights, X1) + np.eye(X1.shape[1]) / model.C
+
+
+def save_model(model, scaler, hessian=None):
     click.echo('Pickling model and scaler.')
     if not os.path.exists('models'):
         os.mkdir('models')
 
-    joblib.dump(logit, 'models/win_probability.pkl')
+    joblib.dump(model, 'models/win_probability.pkl')
     joblib.dump(scaler, 'models/scaler.pkl')
 
+    # A stale Hessian would no longer match the model, so drop it.
+    hessian_fname = 'models/win_probability_hessian.npy'
+    if hessian is not None:
+        np.save(hessian_fname, hessian)
+    elif os.path.exists(hessian_fname):
+        os.remove(hessian_fname)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,213 @@
+from __future__ import division, print_function
+
+import copy
+import os
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from sklearn.externals import joblib
+from sklearn.metrics import log_loss, roc_auc_score
+
+import model_train as mt
+
+from artifacts import scaler_params
+from situation import FEATURES
+
+
+HESSIAN_FNAME = 'models/win_probability_hessian.npy'
+
+
+def update_scaler(scaler, X_new, n_old):
+    """Fold new rows into a fitted StandardScaler's mean and variance
+    using only its running statistics.
+
+    Returns
+    -------
+    new_scaler : a copy of scaler with updated statistics
+    """
+
+    mean_old, scale_old = scaler_params(scaler)
+    n_new = X_new.shape[0]
+    n = n_old + n_new
+
+    mean_new = X_new.mean(axis=0)
+    delta = mean_new - mean_old
+    mean = mean_old + delta * n_new / n
+
+    # Pairwise combination of sums of squared deviations
+    m2 = (scale_old ** 2 * n_old + X_new.var(axis=0) * n_new +
+          delta ** 2 * n_old * n_new / n)
+    var = m2 / n
+    scale = np.sqrt(var)
+    scale[scale == 0] = 1
+
+    new_scaler = copy.deepcopy(scaler)
+    new_scaler.mean_ = mean
+    if hasattr(new_scaler, 'std_'):
+        new_scaler.std_ = scale
+    else:
+        new_scaler.scale_ = scale
+        new_scaler.var_ = var
+    new_scaler.n_samples_seen_ = n
+    return new_scaler
+
+
+def rescale_params(old_scaler, new_scaler):
+    """Matrix T mapping [intercept, coef] fit on features standardized by
+    old_scaler to the equivalent parameters under new_scaler."""
+
+    mean_old, scale_old = scaler_params(old_scaler)
+    mean_new, scale_new = scaler_params(new_scaler)
+
+    n = mean_old.shape[0]
+    T = np.eye(n + 1)
+    T[0, 1:] = (mean_new - mean_old) / scale_old
+    T[1:, 1:] = np.diag(scale_new / scale_old)
+    return T
+
+
+def newton_update(X, y, theta0, precision, max_iter=25, tol=1e-8):
+    """Fit [intercept, coef] to new rows with a Gaussian prior centered
+    on the current coefficients.
+
+    The prior precision is the Hessian of the loss on all earlier
+    plays, so this approximates refitting on old and new plays together
+    (a Laplace approximation of the old fit).
+
+    Returns
+    -------
+    theta   : ndarray, updated parameters
+    hessian : ndarray, precision to use as the prior next time
+    """
+
+    X1 = np.column_stack([np.ones(X.shape[0]), X])
+    theta = theta0.copy()
+    for _ in range(max_iter):
+        pred = 1 / (1 + np.exp(-np.dot(X1, theta)))
+        grad = np.dot(X1.T, pred - y) + np.dot(precision, theta - theta0)
+        hessian = np.dot(X1.T * (pred * (1 - pred)), X1) + precision
+        step = np.linalg.solve(hessian, grad)
+        theta -= step
+        if np.abs(step).max() < tol:
+            break
+
+    pred = 1 / (1 + np.exp(-np.dot(X1, theta)))
+    hessian = np.dot(X1.T * (pred * (1 - pred)), X1) + precision
+    return theta, hessian
+
+
+def raw_coefficients(theta, scaler):
+    """[intercept, coef] in unscaled feature units, comparable across
+    scalers."""
+    mean, scale = scaler_params(scaler)
+    coef = theta[1:] / scale
+    return np.concatenate([[theta[0] - np.dot(coef, mean)], coef])
+
+
+def coefficient_drift(theta_old, old_scaler, theta_new, new_scaler):
+    old = raw_coefficients(theta_old, old_scaler)
+    new = raw_coefficients(theta_new, new_scaler)
+    drift = pd.DataFrame({'old': old, 'new': new},
+                         index=['intercept'] + list(FEATURES))
+    drift['change'] = drift.new - drift.old
+    drift['pct_change'] = 100 * drift.change / drift.old.abs()
+    return drift[['old', 'new', 'change', 'pct_change']]
+
+
+def evaluate(model, scaler, X, y):
+    preds = model.predict_proba(scaler.transform(X))[:, 1]
+    return {'auc': roc_auc_score(y, preds), 'log_loss': log_loss(y, preds),
+            'calibration_error': mt.calibration_error(preds, y)}
+
+
+@click.command()
+@click.argument('new_plays')
+@click.option('--holdout', default=None,
+              help='Cleaned plays to evaluate on. Defaults to 10% of the '
+                   'games in NEW_PLAYS.')
+@click.option('--prior-samples', default=None, type=int,
+              help='Rows the current scaler was fit on, for scalers '
+                   'pickled before this was recorded.')
+@click.option('--dry-run/--save', default=False,
+              help='Report the update without overwriting the model.')
+def main(new_plays, holdout, prior_samples, dry_run):
+    """Update the pickled win probability model and scaler with the plays
+    in NEW_PLAYS (a pbp_cleaned.csv-style file) without a full retrain."""
+
+    start = time.time()
+    features = list(FEATURES)
+    target = 'win'
+
+    click.echo('Loading current model and scaler.')
+    model = joblib.load('models/win_probability.pkl')
+    scaler = joblib.load('models/scaler.pkl')
+    if getattr(model, 'coef_', None) is None or model.coef_.shape[0] != 1:
+        raise click.ClickException('Incremental updates need a binary '
+                                   'linear model; retrain from scratch.')
+
+    n_old = prior_samples
+    if n_old is None:
+        n_old = getattr(scaler, 'n_samples_seen_', None)
+    if n_old is None:
+        raise click.UsageError('The scaler does not record how many rows '
+                               'it was fit on; pass --prior-samples.')
+    n_old = int(np.max(n_old))
+
+    click.echo('Reading new plays.')
+    df_new = mt.load_plays(new_plays)
+    if holdout is None:
+        df_new, df_holdout = mt.split_by_game(df_new, test_size=0.1,
+                                              random_state=0)
+    else:
+        df_holdout = mt.load_plays(holdout)
+    X_new, y_new = df_new[features].values, df_new[target].values
+
+    theta_old = np.concatenate([model.intercept_, model.coef_[0]])
+    if os.path.exists(HESSIAN_FNAME):
+        precision = np.load(HESSIAN_FNAME)
+    else:
+        # Without a saved Hessian, assume standardized features and a
+        # worst-case p(1 - p) of 0.25 for every earlier play.
+        click.echo('Warning: no saved Hessian, using a diagonal prior.')
+        precision = 0.25 * n_old * np.eye(theta_old.shape[0])
+
+    click.echo('Updating scaler with {} new plays.'.format(X_new.shape[0]))
+    new_scaler = update_scaler(scaler, X_new, n_old)
+
+    # Express the current fit and its precision under the new scaler
+    T = rescale_params(scaler, new_scaler)
+    T_inv = np.linalg.inv(T)
+    theta0 = np.dot(T, theta_old)
+    precision = np.dot(np.dot(T_inv.T, precision), T_inv)
+
+    click.echo('Updating coefficients.')
+    theta, hessian = newton_update(new_scaler.transform(X_new), y_new,
+                                   theta0, precision)
+
+    new_model = copy.deepcopy(model)
+    new_model.intercept_ = theta[:1]
+    new_model.coef_ = theta[1:].reshape(1, -1)
+
+    click.echo('\nCoefficient drift (unscaled units):')
+    click.echo(coefficient_drift(theta_old, scaler,
+                                 theta, new_scaler).to_string())
+
+    X_holdout = df_holdout[features].values
+    y_holdout = df_holdout[target].values
+    scores = pd.DataFrame({
+        'old': evaluate(model, scaler, X_holdout, y_holdout),
+        'updated': evaluate(new_model, new_scaler, X_holdout, y_holdout)})
+    click.echo('\nHoldout ({} plays):'.format(X_holdout.shape[0]))
+    click.echo(scores.to_string())
+
+    if dry_run:
+        click.echo('\nDry run, model not saved.')
+    else:
+        mt.save_model(new_model, new_scaler, hessian)
+    click.echo('Done in {:.1f}s.'.format(time.time() - start))
+
+if __name__ == '__main__':
+    main()
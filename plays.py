@@ -1,9 +1,9 @@
 from __future__ import division, print_function
 
-from collections import OrderedDict
-
 import numpy as np
 
+from situation import Situation, SituationBatch
+
 
 def kneel_down(score_diff, timd, secs_left, dwn):
     """Return 1 if the offense can definitely kneel out the game,
@@ -30,23 +30,22 @@ def kneel_down(score_diff, timd, secs_left, dwn):
     return 0
 
 
-def change_poss(situation, play_type, features, **kwargs):
+def change_poss(situation, play_type, **kwargs):
     """Handles situation updating for all plays that involve
     a change of possession, including punts, field goals,
     missed field goals, touchdowns, turnover on downs.
 
     Parameters
     ----------
-    situation : OrderedDict
+    situation : Situation
     play_type : function
-    features  : list[str]
 
     Returns
     -------
-    new_situation : OrderedDict
+    new_situation : Situation
     """
 
-    new_situation = OrderedDict.fromkeys(features)
+    new_situation = Situation()
 
     # Nearly all changes of possession result in a 1st & 10
     # Doesn't cover the edge case of a turnover within own 10 yardline.
@@ -143,7 +142,7 @@ def punt(situation, new_situation, **kwargs):
 
 
 def first_down(situation):
-    new_situation = OrderedDict()
+    new_situation = Situation()
     new_situation['dwn'] = 1
 
     yfog = situation['yfog'] + situation['ytg']
@@ -179,3 +178,188 @@ def qtr(secs_left):
     if secs_left <= 2700:
         return 2
     return 1
+
+
+# Columnar versions of the transitions above. Each takes a SituationBatch
+# and returns (or fills) a SituationBatch of post-play states, one row per
+# input row, matching the scalar functions row for row.
+
+def kneel_down_array(score_diff, timd, secs_left, dwn):
+    """Vectorized kneel_down, returns a float array of 0s and 1s."""
+
+    first = (dwn == 1) & (((timd == 0) & (secs_left <= 120)) |
+                          ((timd == 1) & (secs_left <= 87)) |
+                          ((timd == 2) & (secs_left <= 48)))
+    second = (dwn == 2) & (((timd == 0) & (secs_left <= 84)) |
+                           ((timd == 1) & (secs_left <= 45)))
+    third = (dwn == 3) & (timd == 0) & (secs_left <= 42)
+
+    can_kneel = (first | second | third) & (score_diff > 0) & (dwn != 4)
+    return can_kneel.astype(np.float64)
+
+
+def qtr_array(secs_left):
+    """Vectorized qtr."""
+    return 4 - np.searchsorted([900, 1800, 2700], secs_left, side='left')
+
+
+def change_poss_batch(batch, play_type, **kwargs):
+    """Columnar change_poss. play_type is one of the *_batch functions
+    below and fills yfog (and score_diff, if points are scored).
+
+    Parameters
+    ----------
+    batch     : SituationBatch
+    play_type : function
+
+    Returns
+    -------
+    new_batch : SituationBatch
+    """
+
+    new_batch = SituationBatch.empty(len(batch))
+
+    new_batch.column('dwn')[:] = 1
+    new_batch.column('ytg')[:] = 10
+
+    secs_left = np.maximum(batch.column('secs_left') - 10, 0)
+    new_batch.column('secs_left')[:] = secs_left
+    new_batch.column('qtr')[:] = qtr_array(secs_left)
+
+    new_batch.column('timo')[:] = batch.column('timd')
+    new_batch.column('timd')[:] = batch.column('timo')
+
+    play_type(batch, new_batch, **kwargs)
+
+    new_batch.column('spread')[:] = -1 * batch.column('spread') + 0
+
+    # Plays that don't score leave score_diff unset; flip the old one.
+    score_diff = new_batch.column('score_diff')
+    unscored = np.isnan(score_diff)
+    score_diff[unscored] = batch.column('score_diff')[unscored]
+    score_diff[:] = np.trunc(-1 * score_diff) + 0
+
+    _finish_batch(new_batch)
+    return new_batch
+
+
+def field_goal_batch(batch, new_batch, **kwargs):
+    new_batch.column('score_diff')[:] = batch.column('score_diff') + 3
+    new_batch.column('yfog')[:] = 25
+    return new_batch
+
+
+def missed_field_goal_batch(batch, new_batch, **kwargs):
+    new_batch.column('yfog')[:] = 100 - (batch.column('yfog') - 8)
+    return new_batch
+
+
+def touchdown_batch(batch, new_batch, **kwargs):
+    new_batch.column('score_diff')[:] = batch.column('score_diff') + 7
+    new_batch.column('yfog')[:] = 25
+    return new_batch
+
+
+def turnover_downs_batch(batch, new_batch, **kwargs):
+    new_batch.column('yfog')[:] = 100 - batch.column('yfog')
+    return new_batch
+
+
+def punt_table(punts, default_punt=5):
+    """Dense net punt distance indexed by yfog (0-100) built from
+    punts_grouped. Field positions with no history get default_punt,
+    and the first row wins for duplicated yfogs, as in punt.
+    """
+
+    table = np.empty(101)
+    table.fill(default_punt)
+
+    yfogs = punts.yfog.values
+    first = np.unique(yfogs, return_index=True)[1]
+    keep = first[(yfogs[first] >= 0) & (yfogs[first] <= 100) &
+                 (yfogs[first] == np.floor(yfogs[first]))]
+    table[yfogs[keep].astype(np.int64)] = punts.pnet.values[keep]
+    return table
+
+
+def punt_batch(batch, new_batch, data=None, table=None, default_punt=5,
+               **kwargs):
+    """Columnar punt. Pass a prebuilt punt_table as `table` when scoring
+    many batches, otherwise one is built from `data` (punts_grouped).
+    """
+
+    if table is None:
+        table = punt_table(data, default_punt)
+
+    yfog = batch.column('yfog')
+    idx = np.clip(np.nan_to_num(yfog), 0, 100).astype(np.int64)
+    pnet = np.where(idx == yfog, table[idx], default_punt)
+
+    new_yfog = np.floor(100 - (yfog + pnet))
+
+    # Touchback
+    new_batch.column('yfog')[:] = np.where(new_yfog > 0, new_yfog, 25)
+    return new_batch
+
+
+def first_down_batch(batch):
+    """Columnar first_down."""
+
+    new_batch = SituationBatch.empty(len(batch))
+    new_batch.column('dwn')[:] = 1
+
+    yfog = batch.column('yfog') + batch.column('ytg')
+    new_batch.column('ytg')[:] = np.minimum(10, yfog)
+    new_batch.column('yfog')[:] = yfog
+
+    new_batch.column('secs_left')[:] = np.maximum(
+            batch.column('secs_left') - 10, 0)
+
+    for name in ('score_diff', 'timo', 'timd', 'spread'):
+        new_batch.column(name)[:] = batch.column(name)
+
+    new_batch.column('qtr')[:] = qtr_array(new_batch.column('secs_left'))
+    _finish_batch(new_batch)
+    return new_batch
+
+
+def _finish_batch(new_batch):
+    """Fill the derived kneel_down and qtr_scorediff columns."""
+    new_batch.column('kneel_down')[:] = kneel_down_array(
+            new_batch.column('score_diff'), new_batch.column('timd'),
+            new_batch.column('secs_left'), new_batch.column('dwn'))
+    new_batch.column('qtr_scorediff')[:] = (
+            new_batch.column('qtr') * new_batch.column('score_diff'))
+
+
+def retime_batch(new_batch, situation, changes_poss):
+    """Refill the clock-dependent columns of post-play states in place
+    after only the clock, timeouts or spread of the pre-play situation
+    changed. Matches change_poss and first_down for those columns.
+
+    Parameters
+    ----------
+    new_batch    : SituationBatch of post-play states
+    situation    : Situation, the new pre-play state with features
+    changes_poss : bool array, True for rows where the other team gets
+                   the ball
+
+    Returns
+    -------
+    new_batch    : SituationBatch
+    """
+
+    secs_left = max([situation['secs_left'] - 10, 0])
+    new_batch.column('secs_left')[:] = secs_left
+    new_batch.column('qtr')[:] = qtr(secs_left)
+
+    timo, timd = situation['timo'], situation['timd']
+    new_batch.column('timo')[:] = np.where(changes_poss, timd, timo)
+    new_batch.column('timd')[:] = np.where(changes_poss, timo, timd)
+
+    spread = situation['spread']
+    new_batch.column('spread')[:] = np.where(changes_poss, -1 * spread + 0,
+                                             spread)
+
+    _finish_batch(new_batch)
+    return new_batch
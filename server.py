@@ -0,0 +1,404 @@
+from __future__ import division, print_function
+
+import errno
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import click
+import numpy as np
+
+import artifacts
+import winprob as wp
+
+from decision_log import DecisionLog
+from hot_reload import (Reloader, StateHolder, artifact_source,
+                        load_state, stamp, validate)
+from incremental import IncrementalEvaluator
+from shadow import ShadowLog, ShadowScorer, load_version
+
+from situation import Situation
+
+
+logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger('server')
+log.setLevel(logging.INFO)
+
+# Set in each worker after fork.
+WORKER = {'id': None, 'requests': 0, 'stopping': False, 'reloader': None}
+
+
+def memory_usage():
+    """Resident and proportional set size of this process in kB. PSS
+    splits shared pages between the processes mapping them, so it is
+    the number that should stay flat per worker."""
+    usage = {}
+    for fname, key in (('/proc/self/status', 'VmRSS:'),
+                       ('/proc/self/smaps_rollup', 'Pss:')):
+        try:
+            with open(fname) as f:
+                for line in f:
+                    if line.startswith(key):
+                        usage[key.strip(':').lower()] = int(line.split()[1])
+                        break
+        except IOError:
+            pass
+    return usage
+
+
+def to_json(obj):
+    """json.dumps default for the NumPy scalars in a payload."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
+
+
+class DecisionHandler(BaseHTTPRequestHandler):
+    """POST a JSON situation to / for a decision payload. GET /health
+    reports the worker's id, request count and memory usage.
+
+    Situations with a `gid` are evaluated incrementally, reusing the
+    work from the worker's last query about that game when only the
+    clock or timeouts have changed. When shadow models are registered,
+    every situation is scored by them too and /health reports how often
+    they disagree with production.
+
+    Every payload carries the version of the artifacts it was decided
+    with. Each request uses one version throughout, even if a new one is
+    swapped in while it runs. With a decision log, every payload served
+    is appended to it."""
+
+    def do_GET(self):
+        if self.path != '/health':
+            self.send_error(404)
+            return
+        state = self.server.holder.current()
+        health = {'worker': WORKER['id'], 'pid': os.getpid(),
+                  'requests': WORKER['requests'], 'version': state.version}
+        if WORKER['reloader'] is not None:
+            health['reloads'] = WORKER['reloader'].reloads
+            health['reload_failures'] = WORKER['reloader'].failures
+        health.update(memory_usage())
+        health['incremental'] = state.evaluator.stats()
+        if state.scorer is not None:
+            health['shadow'] = state.scorer.shadow.rates()
+        if self.server.budget is not None:
+            health['degradations'] = wp.degradation_counts()
+        if self.server.decision_log is not None:
+            health['decisions_logged'] = self.server.decision_log.written
+            health['decisions_dropped'] = self.server.decision_log.dropped
+        self.respond(200, health)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length).decode('utf-8'))
+            situation = Situation.from_mapping(body)
+            state = self.server.holder.current()
+            if state.scorer is not None:
+                payload = state.scorer.respond(situation,
+                                               budget=self.server.budget)
+            elif body.get('gid') is not None:
+                payload = state.evaluator.evaluate(body['gid'], situation)
+            else:
+                payload = wp.generate_response(situation, state.data,
+                                               state.model,
+                                               budget=self.server.budget)
+            payload['version'] = state.version
+        except (ValueError, KeyError) as e:
+            self.respond(400, {'error': str(e)})
+            return
+        except Exception:
+            log.exception('worker %s: error handling request', WORKER['id'])
+            self.respond(500, {'error': 'internal error'})
+            return
+        WORKER['requests'] += 1
+        if self.server.decision_log is not None:
+            self.server.decision_log.log(situation, payload, body.get('gid'))
+        self.respond(200, payload)
+
+    def respond(self, status, obj):
+        body = json.dumps(obj, default=to_json).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Worker', str(WORKER['id']))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('worker %s: ' + format, WORKER['id'], *args)
+
+
+def serve_worker(worker_id, sock, state, max_requests, shadows=(),
+                 shadow_dir=None, budget=None, artifact_dir=None,
+                 reload_interval=0, decision_dir=None):
+    """Accept and answer requests on the shared listening socket until
+    told to stop, then exit without returning to the parent's code.
+
+    shadows is a list of (name, model, scaler) scored alongside model,
+    with comparisons written to shadow_dir, one file per worker. With a
+    budget in seconds, decisions are made within it, except those for a
+    gid evaluated incrementally when there are no shadows. With a
+    reload_interval, artifact_dir is checked that often for a new
+    export, which is loaded on a background thread and swapped in.
+    Decisions are logged to decision_dir, if given, one set of files
+    per worker."""
+
+    WORKER['id'] = worker_id
+
+    def stop(signum, frame):
+        WORKER['stopping'] = True
+
+    def reload(signum, frame):
+        if WORKER['reloader'] is not None:
+            WORKER['reloader'].request()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, reload)
+
+    # The logging thread has to be started after the fork.
+    shadow_log = None
+    if shadows:
+        fname = None
+        if shadow_dir is not None:
+            fname = os.path.join(shadow_dir,
+                                 'shadow-{}.jsonl'.format(worker_id))
+        shadow_log = ShadowLog(fname)
+    decision_log = None
+    if decision_dir is not None:
+        decision_log = DecisionLog(
+            decision_dir, prefix='decisions-{}'.format(worker_id))
+
+    def prepare(state):
+        """Per-version helpers, built before the version is served."""
+        state.evaluator = IncrementalEvaluator(state.data, state.model)
+        state.scorer = None
+        if shadow_log is not None:
+            state.scorer = ShadowScorer(state.data, state.model, shadow_log)
+            for name, shadow_model, scaler in shadows:
+                state.scorer.register(name, shadow_model, scaler)
+
+    prepare(state)
+    server = HTTPServer(sock.getsockname(), DecisionHandler,
+                        bind_and_activate=False)
+    server.socket = sock
+    server.timeout = 0.5
+    server.holder = StateHolder(state)
+    server.budget = budget
+    server.decision_log = decision_log
+    if reload_interval:
+        WORKER['reloader'] = Reloader(server.holder,
+                                      artifact_source(artifact_dir),
+                                      reload_interval, prepare).start()
+
+    # The current request always finishes; stopping only takes effect
+    # between requests.
+    while not WORKER['stopping']:
+        try:
+            server.handle_request()
+        except socket.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+        if max_requests and WORKER['requests'] >= max_requests:
+            break
+    if shadow_log is not None:
+        shadow_log.close()
+    if decision_log is not None:
+        decision_log.close()
+    os._exit(0)
+
+
+class Arbiter(object):
+    """Parent process: owns the listening socket and the mapped data,
+    forks the workers and replaces any that exit.
+
+    SIGHUP restarts workers one at a time, SIGUSR1 has them check for
+    new artifacts now, SIGTERM/SIGINT shut down.
+    """
+
+    def __init__(self, sock, state, n_workers, max_requests=0,
+                 shadows=(), shadow_dir=None, budget=None,
+                 artifact_dir=None, reload_interval=0, decision_dir=None):
+        self.sock = sock
+        self.state = state
+        self.n_workers = n_workers
+        self.max_requests = max_requests
+        self.shadows = shadows
+        self.shadow_dir = shadow_dir
+        self.budget = budget
+        self.artifact_dir = artifact_dir
+        self.reload_interval = reload_interval
+        self.decision_dir = decision_dir
+        self.workers = {}
+        self.stopping = False
+        self.restart_pending = False
+
+    def spawn(self, worker_id):
+        self.refresh()
+        pid = os.fork()
+        if pid == 0:
+            serve_worker(worker_id, self.sock, self.state,
+                         self.max_requests, self.shadows, self.shadow_dir,
+                         self.budget, self.artifact_dir,
+                         self.reload_interval, self.decision_dir)
+        self.workers[pid] = worker_id
+        log.info('Started worker %s (pid %s).', worker_id, pid)
+
+    def refresh(self):
+        """Map the newest export before forking, so a replacement worker
+        starts on the version the running workers have moved to rather
+        than the one the parent started with. Without reloading, every
+        worker keeps the parent's version."""
+        if not self.reload_interval:
+            return
+        source = artifact_source(self.artifact_dir)
+        if stamp(source[0]) == self.state.stamp:
+            return
+        try:
+            state = load_state(source)
+            validate(state)
+        except Exception:
+            log.exception('Could not load new artifacts; forking with %s.',
+                          self.state.version)
+            return
+        log.info('Forking workers with %s (was %s).', state.version,
+                 self.state.version)
+        self.state = state
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_hup)
+        signal.signal(signal.SIGUSR1, self.handle_usr1)
+
+        for worker_id in range(self.n_workers):
+            self.spawn(worker_id)
+
+        while self.workers:
+            if self.restart_pending and not self.stopping:
+                self.restart_pending = False
+                self.rolling_restart()
+            if self.reap() is None:
+                time.sleep(0.1)
+
+    def reap(self):
+        """Collect one exited worker, if any, and unless shutting down
+        replace it. Returns the pid reaped."""
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as e:
+            if e.errno in (errno.EINTR, errno.ECHILD):
+                return None
+            raise
+        if pid == 0 or pid not in self.workers:
+            return None
+        worker_id = self.workers.pop(pid)
+        if not self.stopping:
+            if status != 0:
+                log.warning('Worker %s (pid %s) exited with status %s.',
+                            worker_id, pid, status)
+            self.spawn(worker_id)
+        return pid
+
+    def rolling_restart(self):
+        """Stop each current worker in turn, waiting for its replacement
+        to be forked before moving on, so capacity never drops by more
+        than one worker."""
+        for pid in list(self.workers):
+            os.kill(pid, signal.SIGTERM)
+            while pid in self.workers and not self.stopping:
+                if self.reap() is None:
+                    time.sleep(0.1)
+
+    def handle_hup(self, signum, frame):
+        self.restart_pending = True
+
+    def handle_usr1(self, signum, frame):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except OSError:
+                pass
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1')
+@click.option('--port', default=8000)
+@click.option('--workers', default=4, help='Number of worker processes.')
+@click.option('--artifacts', 'artifact_dir', default='models/shared',
+              help='Directory of memory-mappable artifacts.')
+@click.option('--export/--no-export', default=False,
+              help='Rebuild the artifacts from data/ and models/ first.')
+@click.option('--max-requests', default=0,
+              help='Recycle a worker after this many requests (0 = never).')
+@click.option('--shadow', 'shadow_specs', multiple=True,
+              help='NAME=DIR: also score each request with the model and '
+                   'scaler that model_train pickled into DIR. Repeatable.')
+@click.option('--shadow-log', 'shadow_dir', default=None,
+              help='Directory to write shadow comparisons to.')
+@click.option('--budget-ms', default=None, type=float,
+              help='Latency budget per decision, shadowed or not. Optional '
+                   'pieces are skipped once it is spent. Situations with a '
+                   'gid are evaluated incrementally instead, without a '
+                   'budget, unless shadows are registered.')
+@click.option('--reload-interval', default=5.,
+              help='Seconds between checks for newly exported artifacts, '
+                   'which workers load and swap in without restarting '
+                   '(0 = never).')
+@click.option('--decision-log', 'decision_dir', default=None,
+              help='Directory to log every decision served to.')
+def main(host, port, workers, artifact_dir, export, max_requests,
+         shadow_specs, shadow_dir, budget_ms, reload_interval, decision_dir):
+    if export:
+        import bot
+        click.echo('Exporting artifacts to {}.'.format(artifact_dir))
+        data, model = bot.load_data()
+        artifacts.export_shared(data, model, artifact_dir)
+        del data, model
+
+    click.echo('Mapping artifacts from {}.'.format(artifact_dir))
+    state = load_state(artifact_source(artifact_dir))
+
+    shadows = []
+    for spec in shadow_specs:
+        name, _, directory = spec.partition('=')
+        if not directory:
+            raise click.BadParameter('Expected NAME=DIR, got {!r}.'
+                                     .format(spec))
+        shadows.append((name,) + load_version(directory))
+    if shadow_dir is not None and not os.path.exists(shadow_dir):
+        os.makedirs(shadow_dir)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+
+    click.echo('Serving on {}:{} with {} workers.'.format(host, port,
+                                                          workers))
+    budget = budget_ms / 1000 if budget_ms is not None else None
+    Arbiter(sock, state, workers, max_requests, shadows, shadow_dir, budget,
+            artifact_dir, reload_interval, decision_dir).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""Score candidate win probability models alongside production.
+
+A ShadowScorer answers with the production model, as generate_response
+would, while every registered shadow model scores the same scenarios.
+The situation, scenarios, feature matrix, table lookups and similar
+plays are built once per request and shared by all versions; versions
+sharing a scaler share the scaled matrix too. Shadow decisions are
+made from their predictions, compared with the production one and
+logged on a background thread, so the only added latency is the extra
+predict_proba calls.
+"""
+from __future__ import division, print_function
+
+import json
+import logging
+import os
+import threading
+
+from collections import Counter
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+import numpy as np
+
+import winprob as wp
+
+from situation import SituationBatch
+
+
+log = logging.getLogger('shadow')
+
+# Decision fields compared between production and each shadow.
+COMPARED = ('best_play', 'kicking_option')
+
+
+def load_version(directory):
+    """Model and scaler pickled by model_train.save_model into a
+    directory, as (model, scaler)."""
+    from sklearn.externals import joblib
+    return (joblib.load(os.path.join(directory, 'win_probability.pkl')),
+            joblib.load(os.path.join(directory, 'scaler.pkl')))
+
+
+class ShadowScorer(object):
+    """Production decisions with shadow models scored on the side.
+
+    Parameters
+    ----------
+    data   : dict, contains historical data, with the production scaler
+    model  : production LogisticRegression
+    shadow : ShadowLog, receives the shadow decisions. Default: a new
+             ShadowLog that keeps the rates but writes no file.
+    """
+
+    def __init__(self, data, model, shadow=None):
+        self.data = data
+        self.model = model
+        self.versions = []
+        self.shadow = shadow if shadow is not None else ShadowLog()
+
+    def register(self, name, model, scaler=None):
+        """Add a shadow model. With no scaler, it is fit on the same
+        scaled features as production."""
+        if scaler is None:
+            scaler = self.data['scaler']
+        self.versions.append((name, model, scaler))
+
+    def respond(self, situation, budget=None):
+        """Production payload for situation, equal to generate_response's
+        with the same budget. Shadow predictions are handed to the log,
+        which makes their decisions, without waiting."""
+
+        deadline = wp.Deadline(budget) if budget is not None else None
+        situation = wp.calculate_features(situation, self.data)
+        scenarios = wp.simulate_scenarios(situation, self.data)
+        names = list(scenarios.keys())
+        fail_yfog = scenarios['fail']['yfog']
+        features = SituationBatch.from_situations(
+            [situation] + list(scenarios.values())).features()
+        lookups = wp.table_lookups(situation, self.data, deadline)
+
+        def payload(pred_probs, lookups, deadline=None):
+            probs = wp.win_probabilities(situation, names, pred_probs,
+                                         fail_yfog, self.data)
+            decision, probs = wp.generate_decision(situation, self.data,
+                                                   probs, lookups=lookups,
+                                                   deadline=deadline)
+            return {'decision': decision, 'probs': probs}
+
+        scaled = {id(self.data['scaler']):
+                  self.data['scaler'].transform(features)}
+        production = payload(
+            self.model.predict_proba(scaled[id(self.data['scaler'])])[:, 1],
+            lookups, deadline)
+        if deadline is not None:
+            wp.count_degradations(production['decision'])
+
+        predictions = {}
+        for name, model, scaler in self.versions:
+            if id(scaler) not in scaled:
+                scaled[id(scaler)] = scaler.transform(features)
+            predictions[name] = model.predict_proba(scaled[id(scaler)])[:, 1]
+
+        production['situation'] = situation.as_dict()
+        if predictions:
+            # Shadows reuse production's similar plays, which don't
+            # depend on the model
+            shadow_lookups = dict(lookups, similar_plays=production[
+                'decision'].get('similar_plays'))
+            self.shadow.put(production, predictions,
+                            lambda pred_probs: payload(pred_probs,
+                                                       shadow_lookups))
+        return production
+
+    def close(self):
+        self.shadow.close()
+
+
+class ShadowLog(object):
+    """Make shadow decisions and compare them with production on a
+    background thread, keep disagreement rates and optionally append
+    each comparison to a JSON lines file.
+
+    Requests are never held up by logging: when max_pending comparisons
+    are already waiting, new ones are dropped and counted.
+
+    Parameters
+    ----------
+    fname       : str, file to append comparisons to, or None
+    max_pending : int, comparisons queued before dropping
+    """
+
+    def __init__(self, fname=None, max_pending=10000):
+        self.fname = fname
+        self.queue = Queue(max_pending)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, production, predictions, decide):
+        """Queue production's payload with each shadow's predictions, by
+        name, and the function that turns predictions into a payload."""
+        try:
+            self.queue.put_nowait((production, predictions, decide))
+        except Full:
+            with self.lock:
+                self.counts['dropped'] += 1
+
+    def run(self):
+        f = open(self.fname, 'a') if self.fname is not None else None
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    production, predictions, decide = item
+                    shadows = dict((name, decide(pred_probs)) for
+                                   name, pred_probs in predictions.items())
+                    record = self.compare(production, shadows)
+                    if f is not None:
+                        f.write(json.dumps(record, sort_keys=True,
+                                           default=to_json) + '\n')
+                        f.flush()
+                except Exception:
+                    log.exception('Could not log shadow decisions.')
+        finally:
+            if f is not None:
+                f.close()
+
+    def compare(self, production, shadows):
+        """Record how each shadow decision differs from production."""
+
+        record = {'situation': production['situation'],
+                  'production': production['decision'], 'shadows': {}}
+        with self.lock:
+            self.counts['requests'] += 1
+            for name, shadow in sorted(shadows.items()):
+                differs = dict((field, shadow['decision'][field] !=
+                                production['decision'][field])
+                               for field in COMPARED)
+                wp_diff = abs(shadow['probs']['pre_play_wp'] -
+                              production['probs']['pre_play_wp'])
+                self.counts[(name, 'n')] += 1
+                self.counts[(name, 'wp_diff')] += wp_diff
+                for field in COMPARED:
+                    self.counts[(name, field)] += differs[field]
+                record['shadows'][name] = {'decision': shadow['decision'],
+                                           'pre_play_wp_diff': wp_diff}
+        return record
+
+    def rates(self):
+        """Share of requests where each shadow's best play and kicking
+        option differ from production, and the mean absolute difference
+        in pre-play win probability."""
+        with self.lock:
+            counts = self.counts.copy()
+        rates = {'requests': counts['requests'], 'dropped': counts['dropped'],
+                 'shadows': {}}
+        names = set(key[0] for key in counts if isinstance(key, tuple))
+        for name in sorted(names):
+            n = counts[(name, 'n')]
+            rates['shadows'][name] = dict(
+                [(field + '_disagreement', counts[(name, field)] / n)
+                 for field in COMPARED] +
+                [('mean_wp_diff', float(counts[(name, 'wp_diff')]) / n),
+                 ('n', n)])
+        return rates
+
+    def close(self):
+        """Log everything still queued and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+def to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('{!r} is not JSON serializable'.format(obj))
@@ -0,0 +1,118 @@
+from __future__ import division, print_function
+
+import os
+
+import numpy as np
+
+
+# Game state the neighbours are found on, each scaled to unit variance
+INDEX_COLUMNS = ('ytg', 'yfog', 'secs_left', 'score_diff', 'timo', 'timd')
+
+# Numeric columns kept for each play, beyond INDEX_COLUMNS
+PLAY_COLUMNS = ('gid', 'pid', 'seas', 'goforit', 'punt', 'kick',
+                'first_down', 'good', 'pnet', 'yds', 'pts')
+
+# Team columns, stored as fixed-width strings
+TEAM_COLUMNS = ('off', 'def')
+
+
+def build_index(fourths):
+    """Arrays behind a FourthDownIndex, from the coded fourth downs
+    returned by data_prep.code_fourth_downs.
+
+    Returns
+    -------
+    arrays : dict of name to 1-d array, plus 'mean' and 'scale' of the
+             INDEX_COLUMNS
+    """
+
+    df = fourths.reset_index()
+    points = df[list(INDEX_COLUMNS)].values.astype(np.float64)
+    scale = points.std(axis=0)
+    scale[scale == 0] = 1
+
+    arrays = {'mean': points.mean(axis=0), 'scale': scale}
+    for name in INDEX_COLUMNS + PLAY_COLUMNS:
+        arrays[name] = df[name].values.astype(np.float64)
+    for name in TEAM_COLUMNS:
+        arrays[name] = np.asarray(df[name].astype(str), dtype='U3')
+    return arrays
+
+
+def save_index(arrays, fname='data/fourths_index.npz'):
+    np.savez(fname, **arrays)
+
+
+class FourthDownIndex(object):
+    """KD-tree over every coded historical fourth down, for finding the
+    plays most like a given situation and what coaches did on them.
+
+    Parameters
+    ----------
+    arrays : dict, from build_index. Columns may be memory-mapped.
+    """
+
+    def __init__(self, arrays):
+        from scipy.spatial import cKDTree
+
+        self.arrays = arrays
+        self.mean = np.asarray(arrays['mean'])
+        self.scale = np.asarray(arrays['scale'])
+        points = np.column_stack([arrays[name] for name in INDEX_COLUMNS])
+        self.tree = cKDTree((points - self.mean) / self.scale)
+
+    @classmethod
+    def load(cls, fname='data/fourths_index.npz'):
+        with np.load(fname) as npz:
+            return cls(dict((name, npz[name]) for name in npz.files))
+
+    @staticmethod
+    def exists(fname='data/fourths_index.npz'):
+        return os.path.exists(fname)
+
+    def __len__(self):
+        return self.tree.n
+
+    def query(self, situation, k=10):
+        """The k historical fourth downs nearest situation.
+
+        Returns
+        -------
+        plays : list of dicts, nearest first, with the game state, the
+                coaches' choice and its outcome: whether the offense
+                converted, the kick was good, or the net punt distance.
+        """
+
+        point = np.array([situation[name] for name in INDEX_COLUMNS],
+                         dtype=np.float64)
+        k = min(k, len(self))
+        distances, rows = self.tree.query((point - self.mean) / self.scale,
+                                          k=k)
+
+        rows = np.atleast_1d(rows)
+        columns = dict((name, np.asarray(values)[rows].tolist())
+                       for name, values in self.arrays.items()
+                       if name not in ('mean', 'scale'))
+
+        plays = []
+        for i, distance in enumerate(np.atleast_1d(distances).tolist()):
+            play = {'distance': distance}
+            for name in ('gid', 'pid', 'seas', 'ytg', 'yfog', 'secs_left',
+                         'score_diff', 'timo', 'timd'):
+                play[name] = int(columns[name][i])
+            for name in TEAM_COLUMNS:
+                play[name] = str(columns[name][i])
+
+            if columns['goforit'][i]:
+                play['choice'] = 'go for it'
+                play['converted'] = bool(columns['first_down'][i])
+                play['yds'] = columns['yds'][i]
+            elif columns['kick'][i]:
+                play['choice'] = 'kick'
+                play['made'] = columns['good'][i] == 1
+            else:
+                play['choice'] = 'punt'
+                pnet = columns['pnet'][i]
+                play['pnet'] = None if pnet != pnet else pnet
+            plays.append(play)
+        return plays
@@ -0,0 +1,158 @@
+from __future__ import division, print_function
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Win probability model features, in the column order the scaler and
+# model are fit on. Everything that builds a model row reads from here.
+FEATURES = ('dwn', 'yfog', 'secs_left', 'score_diff', 'timo', 'timd',
+            'spread', 'kneel_down', 'qtr', 'qtr_scorediff')
+
+# Numeric game state used by the decision code but not by the model.
+EXTRAS = ('ytg', 'dome', 'poss_prob')
+
+FIELDS = FEATURES + EXTRAS
+N_FEATURES = len(FEATURES)
+INDEX = dict((name, i) for i, name in enumerate(FIELDS))
+
+# Fields callers pass (and calculate_features derives) as integers.
+# They are stored as float64 but given back as ints.
+INTEGER_FIELDS = frozenset(('dwn', 'ytg', 'yfog', 'secs_left', 'score_diff',
+                            'timo', 'timd', 'dome', 'kneel_down', 'qtr',
+                            'qtr_scorediff'))
+
+
+class Situation(object):
+    """A single game state backed by a fixed-layout float64 array.
+
+    Numeric fields live in `values` in FIELDS order, with unset fields
+    stored as NaN. Anything else passed in by the caller (team codes,
+    weather, a precomputed FG probability) is kept in `context`.
+    Supports the same item access as the OrderedDicts it replaces.
+
+    Parameters
+    ----------
+    values : ndarray, optional, 1-d float64 of length len(FIELDS).
+             Used as-is (not copied), so a row of a SituationBatch can
+             be wrapped and written to directly.
+    """
+
+    __slots__ = ('values', 'context')
+
+    def __init__(self, values=None, **kwargs):
+        if values is None:
+            values = np.empty(len(FIELDS))
+            values.fill(np.nan)
+        self.values = values
+        self.context = {}
+        for key, val in kwargs.items():
+            self[key] = val
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        situation = cls()
+        for key, val in mapping.items():
+            situation[key] = val
+        return situation
+
+    def __getitem__(self, key):
+        idx = INDEX.get(key)
+        if idx is None:
+            return self.context[key]
+        val = self.values.item(idx)
+        if val != val:
+            raise KeyError(key)
+        return val
+
+    def __setitem__(self, key, val):
+        idx = INDEX.get(key)
+        if idx is None:
+            self.context[key] = val
+        else:
+            self.values[idx] = np.nan if val is None else val
+
+    def __contains__(self, key):
+        idx = INDEX.get(key)
+        if idx is None:
+            return key in self.context
+        val = self.values.item(idx)
+        return val == val
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def items(self):
+        """Set numeric fields in FIELDS order, followed by the context.
+        Whole numbers in INTEGER_FIELDS come back as ints, as they were
+        passed in."""
+        pairs = []
+        for name, val in zip(FIELDS, self.values.tolist()):
+            if val != val:
+                continue
+            if name in INTEGER_FIELDS and val.is_integer():
+                val = int(val)
+            pairs.append((name, val))
+        pairs.extend(self.context.items())
+        return pairs
+
+    def copy(self):
+        situation = Situation(self.values.copy())
+        situation.context = dict(self.context)
+        return situation
+
+    def to_row(self):
+        """Model features as a (1, N_FEATURES) view, no copy is made."""
+        return self.values[:N_FEATURES].reshape(1, N_FEATURES)
+
+    def as_dict(self):
+        return OrderedDict(self.items())
+
+    def __repr__(self):
+        return 'Situation({})'.format(
+                ', '.join('{}={!r}'.format(k, v) for k, v in self.items()))
+
+
+class SituationBatch(object):
+    """Many situations stored as rows of one (n, len(FIELDS)) array.
+
+    Columns are addressable by field name and the feature block is
+    exposed as a view, so a batch can be scaled and scored in a single
+    call without building intermediate lists.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    @classmethod
+    def empty(cls, n):
+        values = np.empty((n, len(FIELDS)))
+        values.fill(np.nan)
+        return cls(values)
+
+    @classmethod
+    def from_situations(cls, situations):
+        return cls(np.vstack([s.values for s in situations]))
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __getitem__(self, i):
+        """The i-th row as a Situation sharing this batch's memory."""
+        return Situation(self.values[i])
+
+    def column(self, name):
+        return self.values[:, INDEX[name]]
+
+    def features(self):
+        """Model features as an (n, N_FEATURES) view, no copy is made."""
+        return self.values[:, :N_FEATURES]
@@ -3,29 +3,75 @@ from __future__ import division, print_function
 import logging
 import random
 import sys
+import threading
+import time
 
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+
+import numpy as np
 
 import plays as p
 
+from drive_ep import TD_POINTS
+from situation import Situation
+
 
 logging.basicConfig(stream=sys.stderr)
+log = logging.getLogger('winprob')
+
+# How often each optional piece was skipped or fell back to a cheaper
+# source in decisions made with a latency budget, and how many such
+# decisions there were ('budgeted').
+DEGRADATIONS = Counter()
+DEGRADATIONS_LOCK = threading.Lock()
+
+# Historical fields when there is nothing to compare against
+NO_HISTORY = {'historical_goforit_pct': 'None',
+              'historical_punt_pct': 'None',
+              'historical_kick_pct': 'None',
+              'historical_N': 'None'}
+
 
+class Deadline(object):
+    """Time left of a latency budget, in seconds."""
 
-def generate_response(situation, data, model):
+    def __init__(self, budget):
+        self.end = time.time() + budget
+
+    def remaining(self):
+        return max(self.end - time.time(), 0.)
+
+    def expired(self):
+        return time.time() >= self.end
+
+
+def generate_response(situation, data, model, budget=None):
     """Parent function called by the bot to make decisions on 4th downs.
 
+    Neither situation nor data is modified, so one data dict and model
+    can be shared by any number of threads calling this at once, and the
+    same situation always gets the same answer.
+
+    With a budget, optional pieces (an external field goal model in
+    data['fg_model'], the field goal tensor, the historical comparisons)
+    only run while time remains, and cheaper sources are used instead
+    once it runs out. decision['degraded'] lists what was skipped, and
+    DEGRADATIONS counts it.
+
     Parameters
     ----------
-    situation : OrderedDict
+    situation : Situation
     data      : dict, contains historical data
     model     : LogisticRegression
+    budget    : float, optional, seconds
 
     Returns
     -------
     payload   : dict
     """
 
+    deadline = Deadline(budget) if budget is not None else None
+
     situation = calculate_features(situation, data)
 
     # Generate the game state of possible outcomes
@@ -35,26 +81,48 @@ def generate_response(situation, data, model):
     probs = generate_win_probabilities(situation, scenarios, model, data)
 
     # Calculate breakeven points, make decision on optimal decision
-    decision, probs = generate_decision(situation, data, probs)
+    lookups = table_lookups(situation, data, deadline)
+    decision, probs = generate_decision(situation, data, probs, lookups,
+                                        deadline=deadline)
+
+    if deadline is not None:
+        count_degradations(decision)
 
-    payload = {'decision': decision, 'probs': probs, 'situation': situation}
+    payload = {'decision': decision, 'probs': probs,
+               'situation': situation.as_dict()}
 
     return payload
 
 
+def count_degradations(decision):
+    """Add a budgeted decision's skipped pieces to DEGRADATIONS."""
+    with DEGRADATIONS_LOCK:
+        DEGRADATIONS['budgeted'] += 1
+        DEGRADATIONS.update(decision['degraded'])
+
+
+def degradation_counts():
+    """Copy of DEGRADATIONS."""
+    with DEGRADATIONS_LOCK:
+        return dict(DEGRADATIONS)
+
+
 def calculate_features(situation, data):
     """Generate features needed for the win probability model that are
     not contained in the general game state information passed via API.
 
     Parameters
     ----------
-    situation : OrderedDict
+    situation : Situation
 
     Returns
     -------
-    situation : The same OrderedDict, with new keys and values.
+    situation : A copy of situation with the new fields set. The one
+                passed in is not modified.
     """
 
+    situation = situation.copy()
+
     situation['kneel_down'] = p.kneel_down(situation['score_diff'],
                                            situation['timd'],
                                            situation['secs_left'],
@@ -66,10 +134,11 @@ def calculate_features(situation, data):
     situation['spread'] = (
             situation['spread'] * (situation['secs_left'] / 3600))
 
-    cum_pct = (
-        (situation['secs_left'] - data['final_drives'].secs).abs().argmin())
-
-    situation['poss_prob'] = data['final_drives'].ix[cum_pct].cum_pct
+    # Share of final drives starting with about this much time left
+    final_drives = data['final_drives']
+    nearest = np.abs(final_drives.secs.values -
+                     situation['secs_left']).argmin()
+    situation['poss_prob'] = final_drives.cum_pct.values[nearest]
 
     return situation
 
@@ -92,24 +161,21 @@ def simulate_scenarios(situation, data):
     field goal attempt (success or failure), and punt.
     """
 
-    features = data['features']
-    scenarios = dict()
+    scenarios = OrderedDict()
 
     # If it's 4th & goal, success is a touchdown, otherwise a 1st down.
 
     if situation['ytg'] + situation['yfog'] >= 100:
-        scenarios['touchdown'] = p.change_poss(situation, p.touchdown, features)
+        scenarios['touchdown'] = p.change_poss(situation, p.touchdown)
     else:
         scenarios['first_down'] = p.first_down(situation)
 
-    scenarios['fail'] = p.change_poss(situation, p.turnover_downs, features)
+    scenarios['fail'] = p.change_poss(situation, p.turnover_downs)
 
-    scenarios['punt'] = p.change_poss(situation, p.punt, features,
-                                      data=data['punts'])
+    scenarios['punt'] = p.change_poss(situation, p.punt, data=data['punts'])
 
-    scenarios['fg'] = p.change_poss(situation, p.field_goal, features)
-    scenarios['missed_fg'] = p.change_poss(situation, p.missed_field_goal,
-                                           features)
+    scenarios['fg'] = p.change_poss(situation, p.field_goal)
+    scenarios['missed_fg'] = p.change_poss(situation, p.missed_field_goal)
 
     return scenarios
 
@@ -118,22 +184,41 @@ def generate_win_probabilities(situation, scenarios, model, data, **kwargs):
     """For each of the possible scenarios, estimate the win probability
     for that game state."""
 
-    probs = dict.fromkeys([k + '_wp' for k in scenarios.keys()])
+    # Score the pre-play state and every scenario in one call. Row 0 is
+    # the pre-play win probability, the rest follow scenario order.
 
-    features = data['features']
+    feature_rows = np.vstack([situation.to_row()] +
+                             [s.to_row() for s in scenarios.values()])
+    pred_probs = model.predict_proba(
+            data['scaler'].transform(feature_rows))[:, 1]
 
-    # Pre-play win probability calculation
-    # Note there is more information in situation than just model features.
+    return win_probabilities(situation, list(scenarios.keys()), pred_probs,
+                             scenarios['fail']['yfog'], data)
 
-    feature_vec = [val for key, val in situation.items() if key in features]
-    feature_vec = data['scaler'].transform(feature_vec)
 
-    probs['pre_play_wp'] = model.predict_proba(feature_vec)[0][1]
+def win_probabilities(situation, names, pred_probs, fail_yfog, data):
+    """Win probabilities for each scenario from the model's predictions,
+    adjusted for end of game situations.
 
-    for scenario, outcome in scenarios.items():
-        feature_vec = [val for key, val in outcome.items() if key in features]
-        feature_vec = data['scaler'].transform(feature_vec)
-        pred_prob = model.predict_proba(feature_vec)[0][1]
+    Parameters
+    ----------
+    situation  : Situation, with features calculated
+    names      : list of scenario names, in the order they were scored
+    pred_probs : array, the model's predictions for the pre-play state
+                 followed by each scenario
+    fail_yfog  : yfog of the opponent after a turnover on downs
+    data       : dict, contains historical data
+
+    Returns
+    -------
+    probs      : dict
+    """
+
+    probs = dict.fromkeys([k + '_wp' for k in names])
+
+    probs['pre_play_wp'] = pred_probs[0]
+
+    for scenario, pred_prob in zip(names, pred_probs[1:]):
 
         # Change of possessions require 1 - WP
         if scenario in ('fg', 'fail', 'punt', 'missed_fg', 'touchdown'):
@@ -152,12 +237,10 @@ def generate_win_probabilities(situation, scenarios, model, data, **kwargs):
 
         if situation['dome'] > 0:
             prob_opp_fg = (data['fgs'].loc[
-                    data['fgs'].yfog == scenarios['fail']['yfog'],
-                    'dome_rate'].values[0])
+                    data['fgs'].yfog == fail_yfog, 'dome_rate'].values[0])
         else:
             prob_opp_fg = (data['fgs'].loc[
-                    data['fgs'].yfog == scenarios['fail']['yfog'],
-                    'open_rate'].values[0])
+                    data['fgs'].yfog == fail_yfog, 'open_rate'].values[0])
 
         probs['fail_wp'] = ((1 - prob_opp_fg) * probs['fail_wp'])
 
@@ -176,7 +259,37 @@ def generate_win_probabilities(situation, scenarios, model, data, **kwargs):
     return probs
 
 
-def generate_decision(situation, data, probs, **kwargs):
+def table_lookups(situation, data, deadline=None):
+    """Historical table lookups for a situation. None of them depend on
+    the clock or timeouts, so they can be reused while only those change.
+
+    With a Deadline, the field goal probability falls back to cheaper
+    sources and the historical comparison is left out once it passes.
+
+    Returns
+    -------
+    lookups : dict of 'prob_success', 'prob_success_fg', 'historical'
+              and 'degraded', the pieces skipped, plus 'drive_ep' when
+              data has the expected drive points table
+    """
+    degraded = []
+    lookups = {'prob_success': calc_prob_success(situation, data),
+               'prob_success_fg': fg_make_probability(situation, data,
+                                                      deadline, degraded)}
+    if data.get('drive_ep') is not None:
+        lookups['drive_ep'] = drive_expected_points(situation,
+                                                    data['drive_ep'])
+    if deadline is not None and deadline.expired():
+        lookups['historical'] = dict(NO_HISTORY)
+        degraded.append('historical')
+    else:
+        lookups['historical'] = historical_decision(situation, data)
+    lookups['degraded'] = degraded
+    return lookups
+
+
+def generate_decision(situation, data, probs, lookups=None, deadline=None,
+                      **kwargs):
     """Decide on optimal play based on game states and their associated
     win probabilities. Note the currently 'best play' is based purely
     on the outcome with the highest expected win probability. This
@@ -184,11 +297,22 @@ def generate_decision(situation, data, probs, **kwargs):
 
     For example, the win probabilty added by a certain play may be
     very small (0.0001), but that may be the 'best play.'
+
+    Returns a new decision dict and a copy of probs with the expected
+    values added; probs itself is not modified. Pass the result of
+    table_lookups as lookups to reuse them. Similar plays already found
+    for this exact situation can be passed as lookups['similar_plays'],
+    None if they were left out. With a deadline, the decision includes
+    the list of pieces skipped as 'degraded'.
     """
 
+    if lookups is None:
+        lookups = table_lookups(situation, data, deadline)
+
+    probs = dict(probs)
     decision = {}
 
-    decision['prob_success'] = calc_prob_success(situation, data)
+    decision['prob_success'] = lookups['prob_success']
 
     # Expected value of win probability of going for it
     wp_ev_goforit = expected_win_prob(decision['prob_success'],
@@ -197,8 +321,10 @@ def generate_decision(situation, data, probs, **kwargs):
     probs['wp_ev_goforit'] = wp_ev_goforit
 
     # Expected value of kick factors in probability of FG
-    probs['prob_success_fg'], probs['fg_ev_wp'] = expected_wp_fg(
-            situation, probs, data)
+    probs['prob_success_fg'] = lookups['prob_success_fg']
+    probs['fg_ev_wp'] = expected_win_prob(probs['prob_success_fg'],
+                                          probs['fg_wp'],
+                                          probs['missed_fg_wp'])
 
     # If the offense can end the game with a field goal, set the
     # expected win probability for a field goal attempt to the
@@ -231,7 +357,23 @@ def generate_decision(situation, data, probs, **kwargs):
     decision['best_play'] = decide_best_play(decision)
 
     # Only provide historical data outside of two-minute warning
-    decision = get_historical_decision(situation, data, decision)
+    decision.update(lookups['historical'])
+    decision.update(lookups.get('drive_ep', {}))
+    degraded = list(lookups.get('degraded', []))
+
+    # The most similar individual fourth downs, which unlike the
+    # historical rates depend on the clock and timeouts
+    if 'similar_plays' in lookups:
+        if lookups['similar_plays'] is not None:
+            decision['similar_plays'] = lookups['similar_plays']
+    elif data.get('fourths_index') is not None:
+        if deadline is None or not deadline.expired():
+            decision['similar_plays'] = data['fourths_index'].query(situation)
+        else:
+            degraded.append('similar_plays')
+
+    if deadline is not None:
+        decision['degraded'] = degraded
 
     return decision, probs
 
@@ -240,9 +382,20 @@ def get_historical_decision(situation, data, decision):
     """Compare current game situation to historically similar situations.
 
     Currently uses score difference and field position to provide
-    rough guides to what coaches have done in the past.
+    rough guides to what coaches have done in the past. Returns a copy
+    of decision with the historical fields added.
     """
 
+    decision = dict(decision)
+    decision.update(historical_decision(situation, data))
+    return decision
+
+
+def historical_decision(situation, data):
+    """What coaches have done in situations like this one, as a dict of
+    the historical_* decision fields."""
+
+    decision = {}
     historical_data = data['decisions']
 
     down_by_td = situation['score_diff'] <= -4
@@ -260,11 +413,8 @@ def get_historical_decision(situation, data, decision):
                                   (historical_data['long'] == long_tg)]
 
     # Check to see if no similar situations
-    if historical_data.shape[0] == 0:
-        decision['historical_goforit_pct'] = 'None'
-        decision['historical_punt_pct'] = 'None'
-        decision['historical_kick_pct'] = 'None'
-        decision['historical_N'] = 'None'
+    if history.shape[0] == 0:
+        decision.update(NO_HISTORY)
     else:
         decision['historical_punt_pct'] = (history.proportion_punted.values[0])
         decision['historical_kick_pct'] = (history.proportion_kicked.values[0])
@@ -273,6 +423,21 @@ def get_historical_decision(situation, data, decision):
     return decision
 
 
+def drive_expected_points(situation, table):
+    """Expected points of the drive from this 4th down, going by what
+    teams have historically done from here, and from the 1st down
+    gained by converting it (or the touchdown, on 4th & goal)."""
+
+    gained = situation['yfog'] + situation['ytg']
+    if gained >= 100:
+        success = float(TD_POINTS)
+    else:
+        success = table.lookup(1, min(10, 100 - gained), gained)
+    return {'drive_ep': table.lookup(situation['dwn'], situation['ytg'],
+                                     situation['yfog']),
+            'drive_ep_success': success}
+
+
 def expected_win_prob(pos_prob, pos_win_prob, neg_win_prob):
     """Expected value of win probability, factoring in p(success)."""
     return (pos_prob * pos_win_prob) + ((1 - pos_prob) * neg_win_prob)
@@ -280,23 +445,51 @@ def expected_win_prob(pos_prob, pos_win_prob, neg_win_prob):
 
 def expected_wp_fg(situation, probs, data):
     """Expected WP from kicking, factoring in p(FG made)."""
+    pos = fg_make_probability(situation, data)
+    return pos, expected_win_prob(pos, probs['fg_wp'], probs['missed_fg_wp'])
+
+
+def fg_make_probability(situation, data, deadline=None, degraded=None):
+    """Probability a field goal attempt from here is good.
+
+    Sources, best first: a probability passed in with the situation, the
+    external model in data['fg_model'] (called as fg_model(situation,
+    timeout)), the precomputed data['fg_table'] and the dome/open rates
+    in data['fgs']. With a Deadline, the external model gets only the
+    time remaining. Sources skipped or failed are appended to degraded.
+    """
+    if degraded is None:
+        degraded = []
+
     if 'fg_make_prob' in situation and isinstance(situation['fg_make_prob'], float):
-        pos = situation['fg_make_prob']
-    else:
-        fgs = data['fgs']
+        return situation['fg_make_prob']
 
-        # Set the probability of success of implausibly long kicks to 0.
-        if situation['yfog'] < 42:
-            pos = 0
-        else:
-            # Account for indoor vs. outdoor kicking
-            if situation['dome'] > 0:
-                pos = fgs.loc[fgs.yfog == situation['yfog'], 'dome_rate'].values[0]
-            else:
-                pos = fgs.loc[fgs.yfog == situation['yfog'], 'open_rate'].values[0]
+    if data.get('fg_model') is not None:
+        if deadline is None or not deadline.expired():
+            timeout = deadline.remaining() if deadline is not None else None
+            try:
+                return float(data['fg_model'](situation, timeout))
+            except Exception:
+                log.warning('External field goal model failed.',
+                            exc_info=True)
+        degraded.append('fg_model')
 
-    return pos, expected_win_prob(pos, probs['fg_wp'], probs['missed_fg_wp'])
-    return pos, expected_win_prob(pos, probs['fg_wp'], probs['missed_fg_wp'])
+    if (data.get('fg_table') is not None and
+            data['fg_table'].can_score(situation)):
+        if deadline is None or not deadline.expired():
+            return data['fg_table'].prob(situation)
+        degraded.append('fg_table')
+
+    fgs = data['fgs']
+
+    # Set the probability of success of implausibly long kicks to 0.
+    if situation['yfog'] < 42:
+        return 0
+
+    # Account for indoor vs. outdoor kicking
+    if situation['dome'] > 0:
+        return fgs.loc[fgs.yfog == situation['yfog'], 'dome_rate'].values[0]
+    return fgs.loc[fgs.yfog == situation['yfog'], 'open_rate'].values[0]
 
 
 def breakeven(probs):
@@ -378,22 +571,57 @@ def decide_best_play(decision):
         return 'go for it'
 
 
-def random_play(data):
-    """Generate a random play with plausible values for debugging purposes."""
+def random_situation(rng=random):
+    """Generate a random 4th down game state, before features, drawn to
+    look like real 4th downs: mostly short yardage, field position
+    centered between the 30s, more snaps late in halves, one-score
+    games most common and favorites no more than a couple of scores.
 
-    features = data['features']
-    situation = OrderedDict.fromkeys(features)
+    Parameters
+    ----------
+    rng : random.Random, optional. Pass a seeded instance for a
+          reproducible sequence.
 
-    situation['dwn'] = 4
-    situation['ytg'] = random.randint(1, 10)
-    situation['yfog'] = random.randint(1, (100 - situation['ytg']))
-    situation['secs_left'] = random.randint(1, 3600)
-    situation['score_diff'] = random.randint(-20, 20)
-    situation['timo'] = random.randint(0, 3)
-    situation['timd'] = random.randint(0, 3)
-    situation['spread'] = 0
+    Returns
+    -------
+    situation : Situation
+    """
 
-    situation = calculate_features(situation, data)
+    situation = Situation()
 
-    situation['dome'] = random.randint(0, 1)
+    situation['dwn'] = 4
+    ytg = min(int(rng.expovariate(1 / 4.)) + 1, 25)
+    yfog = int(round(rng.triangular(1, 99, 45)))
+    # Goal to go: the yards to go can't run past the goal line
+    situation['ytg'] = min(ytg, 100 - yfog)
+    situation['yfog'] = yfog
+
+    if rng.random() < .2:
+        # End of half
+        situation['secs_left'] = rng.choice([0, 1800]) + rng.randint(1, 300)
+    else:
+        situation['secs_left'] = rng.randint(1, 3600)
+
+    situation['score_diff'] = max(-35, min(35, int(round(rng.gauss(0, 9)))))
+    situation['timo'] = weighted_choice(rng, [0, 1, 2, 3], [1, 2, 3, 6])
+    situation['timd'] = weighted_choice(rng, [0, 1, 2, 3], [1, 2, 3, 6])
+    situation['spread'] = round(2 * rng.gauss(0, 5.5)) / 2
+    situation['dome'] = int(rng.random() < .25)
     return situation
+
+
+def weighted_choice(rng, values, weights):
+    """Pick one of values with probability proportional to weights."""
+    x = rng.random() * sum(weights)
+    for value, weight in zip(values, weights):
+        x -= weight
+        if x < 0:
+            return value
+    return values[-1]
+
+
+def random_play(data, rng=random):
+    """Generate a random play with plausible values for debugging
+    purposes, with features calculated."""
+
+    return calculate_features(random_situation(rng), data)
@@ -0,0 +1,138 @@
+from __future__ import division, print_function
+
+import os
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+import model_train as mt
+
+from situation import FEATURES
+
+
+# Columns written per play, besides the win probability itself.
+COLUMNS = ['gid', 'pid', 'qtr', 'secs_left', 'score_diff']
+
+READ_COLUMNS = (['pid', 'gid', 'seas', 'type'] +
+                [f for f in FEATURES if f != 'qtr_scorediff'])
+
+
+def score_chunk(chunk, scaler, model):
+    """Win probability for the offense on every play in chunk, with one
+    scaler/model call for the whole chunk."""
+    chunk = mt.add_features(chunk)
+    X = chunk[list(FEATURES)].values.astype(np.float64)
+    return model.predict_proba(scaler.transform(X))[:, 1]
+
+
+def export_timelines(pbp_fname, out_dir, scaler, model, seasons=None,
+                     gids=None, chunksize=200000):
+    """Score every play of the selected games and write a columnar
+    timeline sorted by game and play, plus a gid -> row range index.
+
+    Returns the number of plays written.
+    """
+
+    columns = dict((name, []) for name in COLUMNS + ['wp'])
+    reader = pd.read_csv(pbp_fname, usecols=READ_COLUMNS, index_col='pid',
+                         chunksize=chunksize)
+    for chunk in reader:
+        # Same plays the model is trained on
+        keep = (chunk['type'] != 'CONV').values
+        if seasons:
+            keep &= chunk.seas.isin(seasons).values
+        if gids:
+            keep &= chunk.gid.isin(gids).values
+        chunk = chunk.loc[keep].copy()
+        if chunk.shape[0] == 0:
+            continue
+
+        columns['wp'].append(score_chunk(chunk, scaler, model))
+        chunk['pid'] = chunk.index.values
+        for name in COLUMNS:
+            columns[name].append(chunk[name].values)
+
+    if not columns['wp']:
+        return 0
+    columns = dict((name, np.concatenate(parts))
+                   for name, parts in columns.items())
+
+    order = np.lexsort((columns['pid'], columns['gid']))
+    dtypes = {'gid': np.int32, 'pid': np.int32, 'qtr': np.int8,
+              'secs_left': np.int16, 'score_diff': np.int16,
+              'wp': np.float32}
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for name, values in columns.items():
+        values = values[order].astype(dtypes[name])
+        np.save(os.path.join(out_dir, name + '.npy'), values)
+
+    gid_sorted = columns['gid'][order]
+    game_ids, starts, counts = np.unique(gid_sorted, return_index=True,
+                                         return_counts=True)
+    index = np.zeros(game_ids.shape[0], dtype=[('gid', np.int32),
+                                               ('start', np.int64),
+                                               ('stop', np.int64)])
+    index['gid'] = game_ids
+    index['start'] = starts
+    index['stop'] = starts + counts
+    np.save(os.path.join(out_dir, 'index.npy'), index)
+    return gid_sorted.shape[0]
+
+
+def load_timeline(out_dir, gid):
+    """Read one game's timeline from an export without loading the rest.
+
+    Returns
+    -------
+    timeline : dict of column name -> ndarray, in play order
+    """
+    index = np.load(os.path.join(out_dir, 'index.npy'))
+    pos = np.searchsorted(index['gid'], gid)
+    if pos == index.shape[0] or index['gid'][pos] != gid:
+        raise KeyError(gid)
+    start, stop = index['start'][pos], index['stop'][pos]
+
+    timeline = {}
+    for name in COLUMNS + ['wp']:
+        values = np.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r')
+        timeline[name] = np.array(values[start:stop])
+    return timeline
+
+
+@click.command()
+@click.option('--pbp', 'pbp_fname', default='data/pbp_cleaned.csv')
+@click.option('--out', 'out_dir', default='data/wp_timelines')
+@click.option('--season', 'seasons', multiple=True, type=int,
+              help='Season to export, can be repeated. Default: all.')
+@click.option('--gid', 'gids', multiple=True, type=int,
+              help='Game to export, can be repeated. Default: all.')
+@click.option('--artifacts', 'artifact_dir', default=None,
+              help='Score with memory-mapped artifacts instead of the '
+                   'pickled model.')
+@click.option('--chunksize', default=200000)
+def main(pbp_fname, out_dir, seasons, gids, artifact_dir, chunksize):
+    """Export a win probability timeline for every play of the selected
+    games."""
+
+    if artifact_dir is not None:
+        import artifacts
+        data, model = artifacts.load_shared(artifact_dir)
+        scaler = data['scaler']
+    else:
+        from sklearn.externals import joblib
+        scaler = joblib.load('models/scaler.pkl')
+        model = joblib.load('models/win_probability.pkl')
+
+    start = time.time()
+    n_plays = export_timelines(pbp_fname, out_dir, scaler, model,
+                               list(seasons), list(gids), chunksize)
+    elapsed = time.time() - start
+    click.echo('Wrote {} plays to {} in {:.1f}s ({:,.0f} plays/min).'.format(
+            n_plays, out_dir, elapsed, 60 * n_plays / max(elapsed, 1e-9)))
+
+if __name__ == '__main__':
+    main()